@@ -1,12 +1,26 @@
 import os
 import sys
-import webbrowser
-from threading import Timer
-from flask import Flask, render_template, request, Response, jsonify
-from src.config import load_config
-from src.file_loader import get_prompt_list, load_prompt_by_filename
+import gzip
+import time
+from threading import Thread
+from flask import Flask, render_template, request, Response, jsonify, session, g
+from dotenv import dotenv_values
+from src.config import load_config, config_service
+from src.file_loader import get_prompt_list, load_prompt_by_filename, registry as prompt_registry
 from src.ai_engine import AIEngine
 from src.history_manager import HistoryManager
+from src.storage import message_window
+from src.context_manager import strip_message
+from src.prompt_store import MISSING_KEY, missing_prompt, missing_prompt_error
+from src.chat_session import ChatSessionStore
+from src.response_cache import ResponseCache
+from src.client_pool import ClientRegistry
+from src.router import UpstreamRouter
+from src.scheduler import Scheduler
+from src.jobs import JobExecutor, TitleBatcher
+from src.sse import format_event, coalesce
+from src.generations import GenerationStore, Comparison, COMPARE_TTL, parse_event_id, parse_offsets, valid_stream_id
+from src.metrics import metrics
 import json
 
 def resource_path(relative_path):
@@ -20,25 +34,65 @@ app = Flask(__name__,
             template_folder=resource_path('templates'), 
             static_folder=resource_path('static'))
 
-history_mgr = HistoryManager()
-CURRENT_CHAT_ID = None
-CURRENT_CHAT_DATA = None
+SECRET_KEY_FILE = ".flask_secret"
+
+def load_secret_key():
+    """session 签名密钥：优先读环境变量，否则在本地生成一次并复用 (多个 worker 共享同一份)"""
+    key = os.getenv("MY_SECRET_KEY")
+    if key: return key
+    if os.path.exists(SECRET_KEY_FILE):
+        with open(SECRET_KEY_FILE, 'r', encoding='utf-8') as f: return f.read().strip()
+    key = os.urandom(24).hex()
+    with open(SECRET_KEY_FILE, 'w', encoding='utf-8') as f: f.write(key)
+    return key
+
+app.secret_key = load_secret_key()
+
+# 启动时只读一次配置快照，历史记录和引擎的初始化都用它
+startup_config = load_config()
+history_mgr = HistoryManager(compress=startup_config.history_compress, memory=startup_config.memory)
+# 对话状态按 chat_id 保存，每个对话一把锁；浏览器 session 只记录“当前对话”的 id
+chat_store = ChatSessionStore(history_mgr)
 engine = None
-
-def init_engine():
+# 回复缓存跨引擎重建保留；是否启用由配置 MY_CACHE 决定
+response_cache = None
+
+def get_response_cache(cfg):
+    global response_cache
+    if not cfg["cache"]: return None
+    if response_cache is None:
+        response_cache = ResponseCache(
+            memory_items=cfg["cache_memory_items"],
+            disk_max_bytes=int(cfg["cache_max_mb"] * 1024 * 1024),
+            ttl=cfg["cache_ttl"]
+        )
+    return response_cache
+
+# 上游客户端注册表：重建引擎、获取模型列表时复用已建立的连接
+client_registry = ClientRegistry()
+# 多上游路由：配置了 endpoints.json 或开启对冲时启用，上游的延迟统计跨引擎重建保留
+upstream_router = UpstreamRouter(client_registry)
+# 上游准入控制：按上游 / 模型限制并发和速率，交互对话优先于标题、摘要等后台请求；排队状态跨引擎重建保留
+upstream_scheduler = Scheduler()
+metrics.gauge("upstream_queue_depth", "在准入队列里等待的上游请求数", upstream_scheduler.depth)
+metrics.gauge("upstream_inflight", "已放行、进行中的上游请求数", upstream_scheduler.inflight)
+
+def init_engine(cfg=None):
     global engine
-    cfg = load_config()
+    if cfg is None:
+        cfg = load_config()
+    client_registry.configure(cfg.http_max_connections, cfg.http_keepalive,
+                              cfg.http_keepalive_expiry, cfg.models_ttl)
+    metrics.configure(cfg.metrics, cfg.trace_file)
+    upstream_router.configure(cfg)
+    upstream_scheduler.configure(cfg, upstream_router.endpoints)
     # 只有当 key 和 url 都存在时才尝试初始化
-    if cfg["api_key"] and cfg["base_url"]:
+    if cfg.api_key and cfg.base_url:
         try:
-            engine = AIEngine(
-                api_key=cfg["api_key"], 
-                base_url=cfg["base_url"], 
-                model_name=cfg["model"],
-                temperature=cfg["temperature"],
-                max_tokens=cfg["max_tokens"],
-                stream=cfg["stream"]
-            )
+            # 引擎持有自己的配置快照：重建引擎只是替换全局引用，进行中的流不受影响
+            engine = AIEngine.from_config(cfg, cache=get_response_cache(cfg), clients=client_registry,
+                                          router=upstream_router if upstream_router.enabled else None,
+                                          scheduler=upstream_scheduler)
             print("✅ AI 引擎初始化成功")
             return True
         except Exception as e:
@@ -48,7 +102,56 @@ def init_engine():
     engine = None
     return False
 
-init_engine()
+init_engine(startup_config)
+
+# ================= 回合结束后的后台任务 =================
+# 标题生成、摘要更新放到后台线程池，SSE 流在最后一个 token 发出后立即结束
+jobs = JobExecutor()
+
+def apply_title(chat_id, new_title):
+    """后台生成的标题落地：只追加元数据、更新索引，不重写对话内容"""
+    if not new_title or new_title == "新对话": return
+    state = chat_store.peek(chat_id)
+    if state:
+        # 用户可能已经手动重命名，此时不覆盖
+        if state.data.get("title") != "新对话": return
+        state.data["title"] = new_title
+    history_mgr.update_title(chat_id, new_title)
+    print(f"✨ 自动命名成功: {new_title}")
+
+title_batcher = TitleBatcher(jobs, lambda: engine, apply_title)
+metrics.gauge("jobs_pending", "排队中的后台任务数", jobs.pending)
+
+def update_summary_job(chat_id, chat_model):
+    """summary 策略：把被挤出上下文窗口的旧消息并入滚动摘要"""
+    eng, state = engine, chat_store.peek(chat_id)
+    if not eng or not state: return
+    with state.lock:
+        prepared = eng.prepare_summary(state.data, chat_model)
+    if not prepared: return
+    span, kwargs = prepared
+    # 上游请求在锁外进行，不阻塞该对话的下一轮
+    text = eng.run_summary(kwargs)
+    with state.lock:
+        old = state.data.get("summary") or {}
+        if old.get("upto", 0) >= span[1]: return
+        state.data["summary"] = {"text": text, "upto": span[1]}
+        chat_store.save(state)
+
+def recall_memory(eng, chat_id, query):
+    """长期记忆 (MY_MEMORY)：从其他对话里取回与本轮提问相关的片段，未开启时返回 None"""
+    cfg = eng.config
+    if cfg is None or not cfg.memory: return None
+    return history_mgr.recall(query, exclude=chat_id, top_k=cfg.memory_top_k, budget=cfg.memory_budget)
+
+def schedule_post_turn(state, user_input, full_response, chat_model):
+    """一轮对话保存后调用 (持有 state.lock)：提交标题 / 摘要等后台任务"""
+    chat_data = state.data
+    # 自动生成标题 (仅在第一轮对话后触发，即消息数为 3)
+    if len(chat_data["messages"]) == 3 and chat_data["title"] == "新对话":
+        title_batcher.add(state.chat_id, user_input, full_response)
+    if engine is not None and engine.context.policy == "summary":
+        jobs.submit(f"summary:{state.chat_id}", update_summary_job, state.chat_id, chat_model)
 
 # 默认主题定义
 DEFAULT_THEME_IDS = ["dark", "light", "ocean", "forest", "coffee", "cyber"]
@@ -58,6 +161,58 @@ if not os.path.exists(THEME_FILE):
     # 可以在这里增加创建默认 themes.json 的逻辑，确保应用首次运行时有主题
     pass 
 
+def resolve_chat(payload=None):
+    """优先使用请求里显式传入的 chat_id，否则回退到当前 session 的对话"""
+    chat_id = (payload or {}).get('chat_id') or session.get('chat_id')
+    return chat_store.get(chat_id)
+
+# ================= 请求指标 =================
+HTTP_REQUESTS = metrics.counter("http_requests_total", "HTTP 请求数", ("route", "method", "status"))
+HTTP_SECONDS = metrics.histogram("http_request_duration_seconds",
+                                 "路由处理耗时 (流式接口只计到开始返回响应)", ("route", "method"))
+
+def route_label():
+    # 用路由规则而不是实际路径做标签，避免 /static/... 之类的路径撑爆标签数
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+def metrics_before_request():
+    if not metrics.enabled: return
+    g.metrics_start = time.perf_counter()
+    g.metrics_trace = metrics.start_trace("http", route=route_label(), method=request.method)
+
+@app.after_request
+def metrics_after_request(response):
+    start = g.get("metrics_start")
+    if start is not None:
+        route = route_label()
+        HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        HTTP_SECONDS.observe(time.perf_counter() - start, route, request.method)
+        if g.get("metrics_trace"):
+            g.metrics_trace[0].attrs["status"] = response.status_code
+    return response
+
+@app.teardown_request
+def metrics_teardown_request(exc):
+    metrics.finish_trace(g.pop("metrics_trace", None))
+
+# ================= 响应压缩 =================
+# 客户端声明支持 gzip 时压缩较大的 JSON 响应 (对话内容、历史列表)；SSE 流和静态文件不经过这里
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype != 'application/json' or response.is_streamed
+            or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip'] or (response.content_length or 0) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(response.get_data(), GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 # ================= 路由接口 =================
 
 @app.route('/')
@@ -82,8 +237,8 @@ def create_prompt():
         
     full_content = f"## Greeting: {greeting}\n\n{content}"
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(full_content)
+        # 写入文件的同时更新角色注册表，新助手立即出现在列表里
+        prompt_registry.save(filename, full_content)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -131,35 +286,40 @@ def delete_theme():
 # --- 聊天控制接口 ---
 @app.route('/api/chat/update_settings', methods=['POST'])
 def update_chat_settings():
-    global CURRENT_CHAT_DATA
-    if not CURRENT_CHAT_DATA: return jsonify({"status": "error", "error": "当前未加载任何对话"}), 400
-    
     data = request.json
+    state = resolve_chat(data)
+    if not state: return jsonify({"status": "error", "error": "当前未加载任何对话"}), 400
+    
     new_model = data.get('model')
     new_prompt_file = data.get('prompt_file')
     
-    if new_model:
-        CURRENT_CHAT_DATA['model'] = new_model
-    
-    if new_prompt_file:
-        sys_content, _ = load_prompt_by_filename(new_prompt_file)
-        if sys_content:
-            # 替换 system prompt
-            if len(CURRENT_CHAT_DATA['messages']) > 0 and CURRENT_CHAT_DATA['messages'][0]['role'] == 'system':
-                CURRENT_CHAT_DATA['messages'][0]['content'] = sys_content
-            else:
-                CURRENT_CHAT_DATA['messages'].insert(0, {"role": "system", "content": sys_content})
-            
-            CURRENT_CHAT_DATA['prompt_file'] = new_prompt_file
-
-    history_mgr.save_chat(CURRENT_CHAT_ID, CURRENT_CHAT_DATA)
-    return jsonify({"status": "success", "data": CURRENT_CHAT_DATA})
+    with state.lock:
+        chat_data = state.data
+        if new_model:
+            chat_data['model'] = new_model
+        
+        if new_prompt_file:
+            sys_content, _ = load_prompt_by_filename(new_prompt_file)
+            if sys_content:
+                # 替换 system prompt
+                if len(chat_data['messages']) > 0 and chat_data['messages'][0]['role'] == 'system':
+                    chat_data['messages'][0]['content'] = sys_content
+                    chat_data['messages'][0].pop(MISSING_KEY, None)
+                else:
+                    chat_data['messages'].insert(0, {"role": "system", "content": sys_content})
+                
+                chat_data['prompt_file'] = new_prompt_file
+
+        chat_store.save(state)
+        return jsonify({"status": "success", "data": client_page(chat_data)})
 
 # --- 常规接口 ---
 @app.route('/api/check_config')
 def check_config():
-    is_configured = (engine is not None)
-    cfg = load_config()
+    eng = engine
+    is_configured = (eng is not None)
+    # 引擎已建立时直接使用它的配置快照，不再读取 .env
+    cfg = eng.config if eng is not None else load_config()
     return jsonify({
         "configured": is_configured,
         "api_key": cfg["api_key"], "base_url": cfg["base_url"], "model": cfg["model"],
@@ -172,15 +332,18 @@ def save_config():
     api_key = data.get('api_key', '').strip()
     base_url = data.get('base_url', '').strip()
     
-    # 构造 .env 内容
-    env_content = (
-        f"MY_API_KEY={api_key}\nMY_API_URL={base_url}\nMY_MODEL_NAME={data.get('model', '')}\n"
-        f"MY_TEMPERATURE={data.get('temperature', 0.7)}\nMY_MAX_TOKENS={data.get('max_tokens', 2000)}\n"
-        f"MY_STREAM={data.get('stream', True)}\n"
-    )
+    # 构造 .env 内容：只覆盖界面上可设置的项，保留用户手动添加的其他配置 (如上下文策略)
+    env_values = dotenv_values('.env') if os.path.exists('.env') else {}
+    env_values.update({
+        "MY_API_KEY": api_key, "MY_API_URL": base_url, "MY_MODEL_NAME": data.get('model', ''),
+        "MY_TEMPERATURE": data.get('temperature', 0.7), "MY_MAX_TOKENS": data.get('max_tokens', 2000),
+        "MY_STREAM": data.get('stream', True),
+    })
+    env_content = "".join(f"{k}={v}\n" for k, v in env_values.items())
     try:
         with open('.env', 'w', encoding='utf-8') as f: f.write(env_content)
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
+    config_service.invalidate()
     
     # 重新初始化引擎，如果成功返回 success，否则返回 error
     if init_engine(): return jsonify({"status": "success"})
@@ -190,24 +353,69 @@ def save_config():
 def fetch_models_api():
     data = request.json
     try:
-        # 确保 engine 存在，否则使用 AIEngine 的静态方法
-        if engine:
-            models = engine.fetch_available_models(data.get('api_key'), data.get('base_url'))
-        else:
-            models = AIEngine.fetch_available_models(data.get('api_key'), data.get('base_url'))
-            
+        # 通过客户端注册表获取：复用连接，短时间内重复打开设置页直接返回缓存的列表
+        # 前端点击“获取”按钮时传 refresh=true 强制刷新
+        models = AIEngine.fetch_available_models(data.get('api_key'), data.get('base_url'),
+                                                 clients=client_registry, refresh=bool(data.get('refresh')))
         return jsonify({"status": "success", "models": models})
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/cache/stats')
+def cache_stats():
+    if response_cache is None: return jsonify({"enabled": False})
+    stats = response_cache.snapshot()
+    stats["enabled"] = engine is not None and engine.cache is not None
+    return jsonify(stats)
+
+@app.route('/api/upstream/stats')
+def upstream_stats():
+    # 上游连接复用率、模型列表缓存命中情况，以及多上游路由的延迟 / 错误率
+    stats = client_registry.snapshot()
+    stats["router"] = upstream_router.snapshot()
+    stats["scheduler"] = upstream_scheduler.snapshot()
+    return jsonify(stats)
+
+@app.route('/api/metrics')
+def metrics_api():
+    # Prometheus 文本格式；MY_METRICS=off 时只剩指标定义
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics/traces')
+def metrics_traces():
+    # 最近的请求 span (需要 MY_METRICS=trace)：/api/metrics/traces?limit=50
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({"mode": metrics.mode, "traces": metrics.recent_traces(limit)})
+
+@app.route('/api/metrics/traces/dump', methods=['POST'])
+def metrics_dump_traces():
+    # 把缓冲区里的 span 追加写入 MY_TRACE_FILE (JSON Lines)
+    try:
+        path, count = metrics.dump_traces()
+        return jsonify({"status": "success", "path": path, "count": count})
+    except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/api/prompts')
 def get_prompts(): return jsonify(get_prompt_list())
 
 @app.route('/api/history')
-def get_history(): return jsonify(history_mgr.list_all_chats())
+def get_history():
+    # 支持分页: /api/history?offset=0&limit=50，不传则返回全部
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    return jsonify(history_mgr.list_all_chats(offset=offset, limit=limit))
+
+@app.route('/api/history/search')
+def search_history():
+    # 全文搜索：/api/history/search?q=关键词&offset=0&limit=20，支持 "短语" 和 前缀*
+    query = request.args.get('q', '').strip()
+    if not query: return jsonify({"query": query, "results": []})
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    results = history_mgr.search_chats(query, offset, limit)
+    return jsonify({"query": query, "results": results, "indexing": history_mgr.search_backfilling()})
 
 @app.route('/api/new_chat', methods=['POST'])
 def new_chat():
-    global CURRENT_CHAT_ID, CURRENT_CHAT_DATA
     data = request.json
     filename = data.get('filename')
     
@@ -219,106 +427,290 @@ def new_chat():
     chat_id, chat_data = history_mgr.create_new_chat(filename, system_content, greeting)
     
     # 继承当前全局模型设置
-    cfg = load_config()
-    chat_data['model'] = cfg['model']
+    eng = engine
+    chat_data['model'] = eng.config.model if eng is not None else load_config().model
     
-    CURRENT_CHAT_ID = chat_id
-    CURRENT_CHAT_DATA = chat_data
+    chat_store.create(chat_id, chat_data)
+    session['chat_id'] = chat_id
     
     # 注意：这里不立即存盘，存盘发生在用户发送第一条消息之后 (在 chat_stream 路由中)
     return jsonify({"greeting": greeting, "chat_id": chat_id, "messages": chat_data['messages'], "model": chat_data['model']})
 
+# 长对话分页：打开对话时只返回最新一页，更早的消息通过 /api/chat_messages 向前翻页
+MESSAGE_PAGE = 50
+MAX_MESSAGE_PAGE = 200
+
+def page_limit(value):
+    try: return min(max(int(value), 1), MAX_MESSAGE_PAGE)
+    except (TypeError, ValueError): return MESSAGE_PAGE
+
+def client_page(data):
+    """返回给前端的对话 / 分页：去掉消息上的内部字段；角色提示词文件丢失时附带 warning"""
+    messages = data["messages"]
+    page = dict(data, messages=[strip_message(m) for m in messages])
+    ref = missing_prompt(messages)
+    if ref: page["warning"] = missing_prompt_error(ref)
+    return page
+
 @app.route('/api/load_chat', methods=['POST'])
 def load_chat():
-    global CURRENT_CHAT_ID, CURRENT_CHAT_DATA
     data = request.json
-    loaded_data = history_mgr.load_chat(data.get('chat_id'))
-    if loaded_data:
-        CURRENT_CHAT_ID = data.get('chat_id')
-        CURRENT_CHAT_DATA = loaded_data
-        return jsonify(loaded_data)
-    return jsonify({"error": "Not found"}), 404
+    chat_id = data.get('chat_id')
+    # 传 limit 时只返回最后 limit 条消息 (附带 start/total)；不在内存里的对话只读存储末尾，不加载全文
+    limit = data.get('limit')
+    state = chat_store.peek(chat_id) if limit else chat_store.get(chat_id)
+    if state is None:
+        page = history_mgr.load_window(chat_id, limit=page_limit(limit)) if limit else None
+        if page is None: return jsonify({"error": "Not found"}), 404
+        session['chat_id'] = chat_id
+        return jsonify(client_page(page))
+    session['chat_id'] = chat_id
+    gen = generations.active_for(chat_id)
+    if gen is not None:
+        # 正在生成回复：不等对话锁 (要等到生成结束)，返回到本轮用户消息为止的内容，
+        # 并附上 stream_id，前端据此接上正在进行的生成
+        messages = list(state.data["messages"])
+        if gen.message_count: messages = messages[:gen.message_count]
+        else: messages.append({"role": "user", "content": gen.user_input})
+        payload = dict(state.data, messages=messages, active_stream=gen.id)
+    else:
+        with state.lock:
+            payload = dict(state.data, messages=list(state.data["messages"]))
+    payload = client_page(payload)
+    return jsonify(message_window(payload, limit=page_limit(limit)) if limit else payload)
+
+@app.route('/api/chat_messages')
+def chat_messages():
+    # 向前翻页：/api/chat_messages?chat_id=...&before=<已显示的第一条消息的序号>&limit=50
+    chat_id = request.args.get('chat_id')
+    before = request.args.get('before', None, type=int)
+    limit = page_limit(request.args.get('limit'))
+    state = chat_store.peek(chat_id)
+    page = message_window(state.data, before, limit) if state else history_mgr.load_window(chat_id, before, limit)
+    if page is None: return jsonify({"error": "Not found"}), 404
+    page = client_page(page)
+    return jsonify({"messages": page["messages"], "start": page["start"], "total": page["total"]})
 
 @app.route('/api/delete_chat', methods=['POST'])
 def delete_chat():
     chat_id_to_delete = request.json.get('chat_id')
     if history_mgr.delete_chat(chat_id_to_delete):
-        global CURRENT_CHAT_ID, CURRENT_CHAT_DATA
-        # 如果删除的是当前正在聊天的对话，清空内存中的当前状态
-        if CURRENT_CHAT_ID == chat_id_to_delete: 
-            CURRENT_CHAT_ID = None
-            CURRENT_CHAT_DATA = None
+        # 清理内存中的对话状态；如果删除的是当前 session 的对话，一并清空
+        chat_store.drop(chat_id_to_delete)
+        if session.get('chat_id') == chat_id_to_delete:
+            session.pop('chat_id', None)
         return jsonify({"status": "success"})
     return jsonify({"status": "error"}), 404
 
 @app.route('/api/rename_chat', methods=['POST'])
 def rename_chat():
     data = request.json
-    history_mgr.update_title(data.get('chat_id'), data.get('new_title'))
+    chat_id, new_title = data.get('chat_id'), data.get('new_title')
+    # 已加载到内存的对话先同步标题，避免下次保存时被旧标题覆盖
+    # (单个字段赋值，不必等待该对话正在进行的流式生成)
+    state = chat_store.peek(chat_id)
+    if state: state.data['title'] = new_title
+    history_mgr.update_title(chat_id, new_title)
     return jsonify({"status": "success"})
 
+# ================= 流式生成 =================
+# 每轮回复在后台线程里生成并写入缓冲区，SSE 连接只负责读取：
+# 断线重连、刷新页面、多个页面同时查看都接到同一个生成上，不会重复请求上游
+generations = GenerationStore()
+metrics.gauge("chat_generations_active", "进行中的回复生成数", generations.active_count)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def run_turn(eng, state, user_input, gen):
+    """生成一轮回复：调用 AI 引擎、写入生成缓冲区、保存历史 (在后台线程中运行)"""
+    full_response = ""
+    with metrics.trace("chat_stream", chat_id=state.chat_id):
+        # 同一对话的多轮请求串行执行，不同对话之间互不阻塞
+        with metrics.span("chat_lock"):
+            state.lock.acquire()
+        try:
+            chat_data = state.data
+            chat_data["messages"].append({"role": "user", "content": user_input})
+            gen.message_count = len(chat_data["messages"])
+            # 获取当前对话的模型，用于覆盖默认模型
+            chat_model = chat_data.get('model')
+            try:
+                # 1. 调用 AI 引擎获取流式响应
+                # (开启缓存时，相同请求直接从缓存按流的形式回放；上游繁忙排队时把位置推给前端)
+                chunks = eng.stream_text(chat_data["messages"], model_override=chat_model,
+                                         summary=chat_data.get("summary"),
+                                         memory=recall_memory(eng, state.chat_id, user_input),
+                                         on_wait=gen.set_queue)
+                # 2. 逐字的增量按时间 / 字节阈值合并后写入缓冲区，由各个连接读取
+                for content in coalesce(chunks, eng.config.sse_flush_ms, eng.config.sse_flush_bytes):
+                    full_response += content
+                    gen.append(content)
+
+                # 3. AI 响应结束后，保存历史
+                chat_data["messages"].append({"role": "assistant", "content": full_response})
+                chat_store.save(state)
+
+                # 4. 标题生成、摘要更新交给后台任务，不阻塞流的结束
+                schedule_post_turn(state, user_input, full_response, chat_model)
+
+            except Exception as e:
+                # 5. 传输错误信息
+                error_message = f"❌ API请求失败: {str(e)}"
+                print(error_message, file=sys.stderr)
+                gen.append(error_message)
+        finally:
+            state.lock.release()
+            gen.finish()
+
+def sse_error(text, status=200):
+    # 附带 done 事件，浏览器收到后不再自动重连
+    return Response(format_event({'text': text}) + format_event({}, event="done"),
+                    status=status, mimetype='text/event-stream')
+
 @app.route('/api/chat_stream')
 def chat_stream():
-    global CURRENT_CHAT_DATA
-    if not engine: 
-        return Response(f"data: {json.dumps({'text': '❌ AI 引擎未配置或连接失败。请检查设置。'}, ensure_ascii=False)}\n\n", mimetype='text/event-stream')
-    if not CURRENT_CHAT_DATA: 
-        return Response(f"data: {json.dumps({'text': '❌ 当前未加载任何对话。请开启新对话。'}, ensure_ascii=False)}\n\n", status=400, mimetype='text/event-stream')
-    
+    # 带 stream_id 时先找已有的生成：断线重连 (Last-Event-ID) 或另一个页面查看同一个回复
+    stream_id = valid_stream_id(request.args.get('stream_id'))
+    last_event_id = request.headers.get('Last-Event-ID')
     user_input = request.args.get('message')
-    CURRENT_CHAT_DATA["messages"].append({"role": "user", "content": user_input})
-
-    # 获取当前对话的模型，用于覆盖默认模型
-    chat_model = CURRENT_CHAT_DATA.get('model')
-
-    def generate():
-        full_response = ""
-        try:
-            # 1. 调用 AI 引擎获取流式响应
-            response = engine.chat_stream(CURRENT_CHAT_DATA["messages"], model_override=chat_model)
-            
-            if engine.stream:
-                for chunk in response:
-                    content = chunk.choices[0].delta.content
-                    if content:
-                        full_response += content
-                        # 2. 实时传输数据
-                        yield f"data: {json.dumps({'text': content}, ensure_ascii=False)}\n\n"
-            else:
-                # 非流式模式
-                content = response.choices[0].message.content or ""
-                full_response = content
-                yield f"data: {json.dumps({'text': content}, ensure_ascii=False)}\n\n"
-
-            # 3. AI 响应结束后，保存历史
-            CURRENT_CHAT_DATA["messages"].append({"role": "assistant", "content": full_response})
-            history_mgr.save_chat(CURRENT_CHAT_ID, CURRENT_CHAT_DATA)
-            
-            # 4. 修复：自动生成标题的逻辑 (仅在第一轮对话后触发，即消息数为 3)
-            if len(CURRENT_CHAT_DATA["messages"]) == 3 and CURRENT_CHAT_DATA["title"] == "新对话":
-                 try:
-                    new_title = engine.generate_title(user_input, full_response)
-                    # 同时更新磁盘和内存中的标题
-                    history_mgr.update_title(CURRENT_CHAT_ID, new_title)
-                    CURRENT_CHAT_DATA["title"] = new_title 
-                    print(f"✨ 自动命名成功: {new_title}")
-                 except Exception as e:
-                    # 打印错误，但不中断流程
-                    print(f"❌ 自动生成标题失败: {e}", file=sys.stderr)
-                    pass 
-
-        except Exception as e:
-            # 5. 传输错误信息
-            error_message = f"❌ API请求失败: {str(e)}"
-            print(error_message, file=sys.stderr)
-            yield f"data: {json.dumps({'text': error_message}, ensure_ascii=False)}\n\n"
-
-    return Response(generate(), mimetype='text/event-stream')
-
-def open_browser(): webbrowser.open_new("http://127.0.0.1:5000")
+    gen = generations.get(request.args.get('chat_id') or session.get('chat_id'), stream_id)
+    if gen is None:
+        if last_event_id or not user_input:
+            # 要接上的生成已经过期：让客户端结束，从历史记录加载完整回复
+            return Response(format_event({}, event="done"), mimetype='text/event-stream')
+        # 取当前引擎的引用：生成过程中即使 /api/save_config 替换了全局 engine 也不受影响
+        eng = engine
+        if not eng:
+            return sse_error('❌ AI 引擎未配置或连接失败。请检查设置。')
+        state = resolve_chat(request.args)
+        if not state:
+            return sse_error('❌ 当前未加载任何对话。请开启新对话。', 400)
+        # 角色提示词文件丢失：不带着空的 system 消息发给上游，提示用户重新选择角色
+        ref = missing_prompt(state.data["messages"])
+        if ref:
+            return sse_error(missing_prompt_error(ref), 409)
+        gen, created = generations.create(state.chat_id, stream_id, user_input)
+        if created:
+            Thread(target=run_turn, args=(eng, state, user_input, gen), daemon=True).start()
+    offset = parse_event_id(last_event_id, gen.id) if last_event_id else request.args.get('offset', 0, type=int)
+    return Response(gen.events(offset), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# ================= 多模型对比 =================
+# 同一轮用户消息并发发给多个模型，各自的回复在一个 SSE 连接里按模型标记交替输出，
+# 总耗时取决于最慢的模型；用户挑选其中一个回答后才写入历史
+comparisons = GenerationStore(ttl=COMPARE_TTL, factory=Comparison)
+MAX_COMPARE_MODELS = 4
+
+def run_compare_model(eng, comp, i, messages, summary, memory):
+    """对比模式中单个模型的生成 (每个模型一个后台线程)"""
+    model, gen, stats = comp.models[i], comp.results[i], comp.stats[i]
+    start = time.perf_counter()
+
+    def first_piece(chunks):
+        for chunk in chunks:
+            if "ttft_ms" not in stats:
+                stats["ttft_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            yield chunk
+
+    full_response = ""
+    try:
+        chunks = first_piece(eng.stream_text(messages, model_override=model, summary=summary, memory=memory,
+                                             on_wait=gen.set_queue))
+        for content in coalesce(chunks, eng.config.sse_flush_ms, eng.config.sse_flush_bytes):
+            full_response += content
+            gen.append(content)
+    except Exception as e:
+        stats["error"] = str(e)
+        print(f"❌ 对比模式 {model} 请求失败: {e}", file=sys.stderr)
+        gen.append(f"❌ API请求失败: {e}")
+    finally:
+        elapsed = time.perf_counter() - start
+        stats["total_ms"] = round(elapsed * 1000, 1)
+        stats["chars"] = len(full_response)
+        stats["chars_per_sec"] = round(len(full_response) / elapsed, 1) if elapsed > 0 else None
+        comp.texts[i] = full_response
+        gen.finish()
+
+@app.route('/api/compare_stream')
+def compare_stream():
+    # /api/compare_stream?chat_id=...&stream_id=...&models=a,b,c&message=...
+    stream_id = valid_stream_id(request.args.get('stream_id'))
+    last_event_id = request.headers.get('Last-Event-ID')
+    user_input = request.args.get('message')
+    comp = comparisons.get(request.args.get('chat_id') or session.get('chat_id'), stream_id)
+    if comp is None:
+        if last_event_id or not user_input:
+            return Response(format_event({}, event="done"), mimetype='text/event-stream')
+        models = list(dict.fromkeys(m.strip() for m in request.args.get('models', '').split(',') if m.strip()))
+        if not 2 <= len(models) <= MAX_COMPARE_MODELS:
+            return sse_error(f'❌ 对比模式需要选择 2 到 {MAX_COMPARE_MODELS} 个模型。', 400)
+        eng = engine
+        if not eng:
+            return sse_error('❌ AI 引擎未配置或连接失败。请检查设置。')
+        state = resolve_chat(request.args)
+        if not state:
+            return sse_error('❌ 当前未加载任何对话。请开启新对话。', 400)
+        # 角色提示词文件丢失：不带着空的 system 消息发给上游，提示用户重新选择角色
+        ref = missing_prompt(state.data["messages"])
+        if ref:
+            return sse_error(missing_prompt_error(ref), 409)
+        comp, created = comparisons.create(state.chat_id, stream_id, user_input, models=models)
+        if created:
+            # 只在发起时短暂持有对话锁，拷贝一份上下文；生成期间不修改对话
+            with state.lock:
+                messages = state.data["messages"] + [{"role": "user", "content": user_input}]
+                summary = state.data.get("summary")
+                comp.base_count = len(state.data["messages"])
+            # 各模型看到同一份长期记忆片段，对比才公平
+            memory = recall_memory(eng, state.chat_id, user_input)
+            for i in range(len(models)):
+                Thread(target=run_compare_model, args=(eng, comp, i, messages, summary, memory), daemon=True).start()
+    offsets = parse_offsets(last_event_id, comp.id, len(comp.models))
+    return Response(comp.events(offsets), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/api/compare/choose', methods=['POST'])
+def compare_choose():
+    """把对比结果中选中的回答 (连同本轮用户消息) 写入历史"""
+    data = request.json or {}
+    comp = comparisons.get(data.get('chat_id') or session.get('chat_id'), valid_stream_id(data.get('stream_id')))
+    if comp is None: return jsonify({"error": "对比结果已过期，请重新发送"}), 404
+    if not comp.done: return jsonify({"error": "还有模型在生成中"}), 409
+    i = data.get('index')
+    if i is None and data.get('model') in comp.models: i = comp.models.index(data['model'])
+    if not isinstance(i, int) or not 0 <= i < len(comp.models): return jsonify({"error": "未知的模型"}), 400
+    if comp.stats[i].get("error"): return jsonify({"error": "这个模型的请求失败了，不能采用"}), 400
+    state = chat_store.get(comp.chat_id)
+    if not state: return jsonify({"error": "Not found"}), 404
+    with state.lock:
+        if comp.chosen is not None or len(state.data["messages"]) != comp.base_count:
+            return jsonify({"error": "对话已经发生变化，不能再采用这次对比的回答"}), 409
+        state.data["messages"].append({"role": "user", "content": comp.user_input})
+        state.data["messages"].append({"role": "assistant", "content": comp.texts[i]})
+        chat_store.save(state)
+        comp.chosen = i
+        schedule_post_turn(state, comp.user_input, comp.texts[i], state.data.get('model'))
+    return jsonify({"status": "success", "model": comp.models[i]})
+
+HOST, PORT = "127.0.0.1", 5000
+
+def warm_up():
+    """服务已经开始监听后再在后台导入 openai SDK，启动时不用等它，第一次对话也不用等"""
+    if engine is not None:
+        engine.warm_up()
+
+def open_browser():
+    import webbrowser
+    webbrowser.open_new(f"http://{HOST}:{PORT}")
 
 if __name__ == '__main__':
-    # 确保在启动前初始化 engine，以便在命令行输出状态
-    init_engine() 
-    Timer(1.5, open_browser).start()
-    app.run(debug=False, port=5000)
\ No newline at end of file
+    # engine 在导入本模块时已经初始化过一次，这里不再重复
+    from werkzeug.serving import make_server
+    # threaded=True：多个对话 / 标签页可以同时流式生成
+    # make_server 返回时端口已经在监听，此时打开浏览器不会连不上，也不用固定等待
+    server = make_server(HOST, PORT, app, threaded=True)
+    print(f"✅ 服务已启动: http://{HOST}:{PORT}")
+    Thread(target=open_browser, daemon=True).start()
+    Thread(target=warm_up, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
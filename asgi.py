@@ -0,0 +1,237 @@
+"""ASGI 入口：/api/chat_stream 走 asyncio + AsyncOpenAI，其余接口仍由 Flask 处理
+
+WSGI 模式下每个 SSE 连接都要占住一个线程等上游；这里流式接口跑在事件循环上，
+一个进程可以同时挂住几百个流。对话状态、历史存储与 app.py 共用同一份。
+
+运行 (需要额外安装 uvicorn 和 asgiref):
+    pip install uvicorn asgiref
+    uvicorn asgi:application --port 5000
+"""
+import sys
+import time
+import asyncio
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+import app as web
+from src.ai_engine import AsyncAIEngine
+from src.sse import format_event, acoalesce
+from src.generations import parse_event_id, valid_stream_id
+from src.metrics import metrics
+from src.prompt_store import missing_prompt, missing_prompt_error
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    flask_asgi = WsgiToAsgi(web.app)
+except ImportError:
+    flask_asgi = None
+
+_async_engine = None
+_engine_source = None
+
+
+async def get_async_engine():
+    """跟随 app.py 的全局 engine：/api/save_config 重建引擎后，这里也重建异步引擎"""
+    global _async_engine, _engine_source
+    sync_engine = web.engine
+    if sync_engine is None:
+        return None
+    if sync_engine is not _engine_source:
+        old = _async_engine
+        # 与同步引擎使用同一份配置快照
+        cfg = sync_engine.config
+        _async_engine = AsyncAIEngine.from_config(cfg, cache=web.get_response_cache(cfg),
+                                                  clients=web.client_registry, router=sync_engine.router,
+                                                  scheduler=sync_engine.scheduler)
+        _engine_source = sync_engine
+        if old is not None:
+            await old.close()
+    return _async_engine
+
+
+def request_header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def session_chat_id(scope):
+    """解析 Flask 的 session cookie，取出当前 session 记录的 chat_id"""
+    raw = request_header(scope, b"cookie") or ""
+    cookie = SimpleCookie()
+    try:
+        cookie.load(raw)
+    except Exception:
+        return None
+    morsel = cookie.get(web.app.config["SESSION_COOKIE_NAME"])
+    serializer = web.app.session_interface.get_signing_serializer(web.app)
+    if morsel is None or serializer is None:
+        return None
+    try:
+        return serializer.loads(morsel.value).get("chat_id")
+    except Exception:
+        return None
+
+
+async def acquire_chat_lock(state):
+    # 没有竞争时直接拿到锁；有竞争时到线程里等待，不阻塞事件循环
+    if state.lock.acquire(blocking=False):
+        return
+    waiter = asyncio.ensure_future(asyncio.to_thread(state.lock.acquire))
+    try:
+        await asyncio.shield(waiter)
+    except asyncio.CancelledError:
+        # 等锁期间客户端断开：线程拿到锁后立即释放，避免锁泄漏
+        waiter.add_done_callback(lambda _: state.lock.release())
+        raise
+
+
+# 进行中的生成任务 (保留引用，避免被垃圾回收)
+_turn_tasks = set()
+
+
+async def run_turn(eng, state, user_input, gen):
+    """app.run_turn 的异步版本：在事件循环上生成回复，与 SSE 连接解耦"""
+    full_response = ""
+    with metrics.trace("chat_stream", chat_id=state.chat_id):
+        # 同一对话的多轮请求串行执行，不同对话之间互不阻塞
+        try:
+            with metrics.span("chat_lock"):
+                await acquire_chat_lock(state)
+        except asyncio.CancelledError:
+            gen.finish()
+            raise
+        try:
+            chat_data = state.data
+            chat_data["messages"].append({"role": "user", "content": user_input})
+            gen.message_count = len(chat_data["messages"])
+            chat_model = chat_data.get('model')
+            try:
+                memory = await asyncio.to_thread(web.recall_memory, eng, state.chat_id, user_input)
+                chunks = eng.stream_text(chat_data["messages"], model_override=chat_model,
+                                         summary=chat_data.get("summary"), memory=memory, on_wait=gen.set_queue)
+                # 增量按时间 / 字节阈值合并；上游停顿时到点也会发出攒着的文本
+                async for content in acoalesce(chunks, eng.config.sse_flush_ms, eng.config.sse_flush_bytes):
+                    full_response += content
+                    gen.append(content)
+
+                chat_data["messages"].append({"role": "assistant", "content": full_response})
+                await asyncio.to_thread(web.chat_store.save, state)
+
+                # 标题生成、摘要更新交给后台任务，不阻塞流的结束
+                web.schedule_post_turn(state, user_input, full_response, chat_model)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error_message = f"❌ API请求失败: {str(e)}"
+                print(error_message, file=sys.stderr)
+                gen.append(error_message)
+        finally:
+            state.lock.release()
+            gen.finish()
+
+
+async def chat_stream(scope, receive, send):
+    started = time.perf_counter()
+    params = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    chat_id = params.get("chat_id", [None])[0] or session_chat_id(scope)
+    user_input = params.get("message", [None])[0]
+    stream_id = valid_stream_id(params.get("stream_id", [None])[0])
+    last_event_id = request_header(scope, b"last-event-id")
+
+    async def start(status=200):
+        # 与 Flask 路由相同的请求指标 (耗时只计到开始返回响应)
+        web.HTTP_REQUESTS.inc("/api/chat_stream", "GET", str(status))
+        web.HTTP_SECONDS.observe(time.perf_counter() - started, "/api/chat_stream", "GET")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache")],
+        })
+
+    async def respond(body, status=200):
+        await start(status)
+        await send({"type": "http.response.body", "body": body.encode('utf-8')})
+
+    # 带 stream_id 时先找已有的生成：断线重连 (Last-Event-ID) 或另一个页面查看同一个回复
+    gen = web.generations.get(chat_id, stream_id)
+    if gen is None:
+        if last_event_id or not user_input:
+            # 要接上的生成已经过期：让客户端结束，从历史记录加载完整回复
+            return await respond(format_event({}, event="done"))
+        eng = await get_async_engine()
+        if not eng:
+            return await respond(format_event({'text': '❌ AI 引擎未配置或连接失败。请检查设置。'})
+                                 + format_event({}, event="done"))
+        state = await asyncio.to_thread(web.chat_store.get, chat_id)
+        if not state:
+            return await respond(format_event({'text': '❌ 当前未加载任何对话。请开启新对话。'})
+                                 + format_event({}, event="done"), 400)
+        ref = missing_prompt(state.data["messages"])
+        if ref:
+            return await respond(format_event({'text': missing_prompt_error(ref)})
+                                 + format_event({}, event="done"), 409)
+        gen, created = web.generations.create(state.chat_id, stream_id, user_input)
+        if created:
+            task = asyncio.ensure_future(run_turn(eng, state, user_input, gen))
+            _turn_tasks.add(task)
+            task.add_done_callback(_turn_tasks.discard)
+
+    if last_event_id:
+        offset = parse_event_id(last_event_id, gen.id)
+    else:
+        try:
+            offset = max(int(params.get("offset", ["0"])[0]), 0)
+        except ValueError:
+            offset = 0
+    await start()
+
+    async def pump():
+        async for frame in gen.aevents(offset):
+            await send({"type": "http.response.body", "body": frame.encode('utf-8'), "more_body": True})
+
+    async def watch_disconnect(task):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                task.cancel()
+                return
+
+    task = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(watch_disconnect(task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        # 客户端断开：生成在后台继续，重连后从断点接着读
+        return
+    finally:
+        watcher.cancel()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def not_found(send):
+    await send({"type": "http.response.start", "status": 404,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": "需要安装 asgiref 才能在 ASGI 模式下提供其他接口".encode('utf-8')})
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _async_engine is not None:
+                    await _async_engine.close()
+                await web.client_registry.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["path"] == "/api/chat_stream":
+        return await chat_stream(scope, receive, send)
+    if flask_asgi is not None:
+        return await flask_asgi(scope, receive, send)
+    if scope["type"] == "http":
+        return await not_found(send)
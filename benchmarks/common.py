@@ -0,0 +1,112 @@
+"""基准测试脚本共用的小工具：端口、假服务器进程、内存统计、结果输出"""
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"端口 {port} 没有在 {timeout}s 内开始监听")
+
+
+def rss_kb(pid="self"):
+    """进程常驻内存 (KB)，Linux 读 /proc，其它平台返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize_ms(values):
+    """秒为单位的耗时列表 -> p50 / p95 / max (毫秒)"""
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3),
+    }
+
+
+def start_fake_server(tokens=100, token_rate=0.0, latency=0.0, fail_rate=0.0, fail_status=500, port=None):
+    """在子进程里启动 fake_openai_server.py，返回 (进程, base_url)"""
+    port = port or free_port()
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_openai_server.py"),
+        "--port", str(port), "--tokens", str(tokens), "--token-rate", str(token_rate),
+        "--latency", str(latency), "--fail-rate", str(fail_rate), "--fail-status", str(fail_status),
+    ], stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except Exception:
+        proc.terminate()
+        raise
+    return proc, f"http://127.0.0.1:{port}/v1"
+
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_info():
+    """每条结果都附带的运行环境信息，方便对比不同提交 / 机器的结果"""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def write_results(path, records):
+    """以 JSON Lines 追加写入结果文件 (相对路径相对于仓库根目录)"""
+    if not path:
+        return
+    if not os.path.isabs(path):
+        path = os.path.join(ROOT, path)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
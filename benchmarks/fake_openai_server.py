@@ -0,0 +1,182 @@
+"""本地的 OpenAI 兼容假服务器，用于压测和基准测试 (只依赖标准库)
+
+支持:
+    POST /v1/chat/completions   (stream=true 时按 SSE 逐 token 返回)
+    GET  /v1/models
+
+可配置首 token 延迟、token 速率、回复长度和失败注入，例如:
+    python benchmarks/fake_openai_server.py --port 8900 --latency 0.2 --token-rate 50 --tokens 200
+然后把 MY_API_URL 指向 http://127.0.0.1:8900/v1 即可。
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+MODELS = ["fake-model", "fake-model-large", "fake-model-mini"]
+# 回复内容：中英混合，贴近真实对话
+WORDS = ["你好", "，", "这是", "一个", "测试", "回复", "。", " hello", " world", " token", "\n"]
+
+
+class FakeOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=8900, latency=0.0, token_rate=0.0,
+                 tokens=100, fail_rate=0.0, fail_status=500, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency          # 首 token 之前的延迟 (秒)
+        self.token_rate = token_rate    # 每秒输出多少 token，0 表示不限速
+        self.tokens = tokens            # 每个回复的 token 数
+        self.fail_rate = fail_rate      # 失败概率 (0~1)
+        self.fail_status = fail_status  # 注入失败时返回的状态码，例如 429 / 500
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.active_streams = 0
+        self.peak_streams = 0
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    # ---------- 生命周期 ----------
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    # ---------- HTTP ----------
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                self.requests += 1
+                await self._route(method, path, body, writer)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def _route(self, method, path, body, writer):
+        path = path.split("?", 1)[0]
+        if self.fail_rate and self.random.random() < self.fail_rate:
+            return self._write_json(writer, self.fail_status,
+                                    {"error": {"message": "injected failure", "type": "fake_error"}})
+        if method == "GET" and path.endswith("/models"):
+            data = [{"id": m, "object": "model", "created": 0, "owned_by": "fake"} for m in MODELS]
+            return self._write_json(writer, 200, {"object": "list", "data": data})
+        if method == "POST" and path.endswith("/chat/completions"):
+            payload = json.loads(body or b"{}")
+            if payload.get("stream"):
+                return await self._stream_completion(payload, writer)
+            return await self._completion(payload, writer)
+        return self._write_json(writer, 404, {"error": {"message": "not found"}})
+
+    def _write_json(self, writer, status, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+        )
+
+    def _pieces(self, payload):
+        n = min(self.tokens, int(payload.get("max_tokens") or self.tokens))
+        return [WORDS[i % len(WORDS)] for i in range(n)]
+
+    async def _completion(self, payload, writer):
+        pieces = self._pieces(payload)
+        await asyncio.sleep(self.latency + (len(pieces) / self.token_rate if self.token_rate else 0))
+        obj = {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+            "model": payload.get("model", MODELS[0]),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(pieces)}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(pieces), "total_tokens": len(pieces)},
+        }
+        self._write_json(writer, 200, obj)
+        await writer.drain()
+
+    async def _stream_completion(self, payload, writer):
+        self.active_streams += 1
+        self.peak_streams = max(self.peak_streams, self.active_streams)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Transfer-Encoding: chunked\r\n\r\n")
+            await asyncio.sleep(self.latency)
+            model = payload.get("model", MODELS[0])
+            interval = 1.0 / self.token_rate if self.token_rate else 0
+            for piece in self._pieces(payload):
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                self._write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                await writer.drain()
+                if interval:
+                    await asyncio.sleep(interval)
+            self._write_chunk(writer, "data: [DONE]\n\n")
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            self.active_streams -= 1
+
+    @staticmethod
+    def _write_chunk(writer, text):
+        data = text.encode("utf-8")
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地假服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="首 token 延迟 (秒)")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="每秒 token 数，0 为不限速")
+    parser.add_argument("--tokens", type=int, default=100, help="每个回复的 token 数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="注入失败的概率 (0~1)")
+    parser.add_argument("--fail-status", type=int, default=500, help="注入失败时的状态码")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.token_rate,
+                              args.tokens, args.fail_rate, args.fail_status)
+    print(f"🧪 假 OpenAI 服务器: {server.base_url}", flush=True)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""ASGI 流式接口压测：一个进程能同时挂住多少个 SSE 流，每个流占多少内存
+
+会在子进程里启动 fake_openai_server.py，然后在本进程内直接调用 asgi.application
+(不需要 uvicorn)，同时打开 N 个 /api/chat_stream 流。
+
+    python benchmarks/load_test_async.py --streams 300 --tokens 40 --token-rate 10
+    python benchmarks/load_test_async.py --streams 500 --tracemalloc --output bench_output.txt
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from common import ROOT, rss_kb, percentile, start_fake_server, stop_process, run_info, write_results
+
+sys.path.insert(0, ROOT)
+
+
+class StreamProbe:
+    """模拟一个 SSE 客户端：记录首字节时间和收到的帧数"""
+
+    def __init__(self, app, chat_id, stats):
+        self.app = app
+        self.chat_id = chat_id
+        self.stats = stats
+        self.started = None
+        self.first_byte = None
+        self.frames = 0
+        self.finished = False
+        self._closed = asyncio.Event()
+
+    async def receive(self):
+        await self._closed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        if message["type"] != "http.response.body":
+            return
+        if not message.get("more_body", False):
+            self.finished = True
+        # 只统计正文帧 (start / done 事件不算)
+        frames = message.get("body", b"").count(b'data: {"text"')
+        if not frames:
+            return
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+            self.stats["first_token"] += 1
+        self.frames += frames
+
+    async def run(self):
+        scope = {
+            "type": "http", "method": "GET", "path": "/api/chat_stream", "headers": [],
+            "query_string": f"chat_id={self.chat_id}&message=hello".encode(),
+        }
+        self.started = time.perf_counter()
+        self.stats["active"] += 1
+        self.stats["peak"] = max(self.stats["peak"], self.stats["active"])
+        try:
+            await self.app(scope, self.receive, self.send)
+        finally:
+            self.stats["active"] -= 1
+            self._closed.set()
+
+
+async def run_load(args, asgi):
+    stats = {"active": 0, "peak": 0, "first_token": 0}
+    store = asgi.web.chat_store
+
+    def make_chat(i):
+        chat_id = f"load{i:05d}"
+        store.create(chat_id, {
+            "id": chat_id, "title": "压测", "prompt_file": "bench.md", "updated_at": "",
+            "model": "fake-model", "messages": [{"role": "system", "content": "你是一个测试助手。"}],
+        })
+        return chat_id
+
+    # 预热：建立连接池、导入延迟加载的模块
+    await StreamProbe(asgi.application, make_chat(99999), dict(stats)).run()
+
+    probes = [StreamProbe(asgi.application, make_chat(i), stats) for i in range(args.streams)]
+    # tracemalloc 能精确统计 Python 对象内存，但会明显拖慢事件循环，默认只看 RSS
+    if args.tracemalloc:
+        tracemalloc.start()
+    base_traced = tracemalloc.get_traced_memory()[0]
+    base_rss = rss_kb()
+
+    t0 = time.perf_counter()
+    tasks = [asyncio.ensure_future(p.run()) for p in probes]
+
+    # 等所有流都收到首个 token，此时所有流都处于“挂起中”，测量内存
+    peak_traced, peak_rss = 0, base_rss
+    while stats["first_token"] < args.streams and not all(t.done() for t in tasks):
+        await asyncio.sleep(0.05)
+        peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[0] - base_traced)
+        if base_rss is not None:
+            peak_rss = max(peak_rss, rss_kb())
+    held = stats["active"]
+    held_traced = tracemalloc.get_traced_memory()[0] - base_traced
+    held_rss = rss_kb()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    wall = time.perf_counter() - t0
+    tracemalloc.stop()
+
+    ttft = [p.first_byte - p.started for p in probes if p.first_byte]
+    # 增量会被合并成较少的帧，按流是否正常结束统计完成数
+    completed = sum(1 for p in probes if p.finished)
+    return {
+        "benchmark": "async_stream_load",
+        "streams": args.streams,
+        "tokens_per_stream": args.tokens,
+        "token_rate": args.token_rate,
+        "frames_per_stream": round(sum(p.frames for p in probes) / max(len(probes), 1), 1),
+        "held_concurrently": held,
+        "peak_concurrent": stats["peak"],
+        "completed": completed,
+        "ttft_p50_ms": round(percentile(ttft, 0.5) * 1000, 2) if ttft else None,
+        "ttft_p95_ms": round(percentile(ttft, 0.95) * 1000, 2) if ttft else None,
+        "wall_time_s": round(wall, 3),
+        "py_mem_per_stream_kb": (round(max(held_traced, 0) / 1024 / max(held, 1), 2)
+                                 if args.tracemalloc else None),
+        "py_mem_peak_kb": round(peak_traced / 1024, 1) if args.tracemalloc else None,
+        "rss_per_stream_kb": (round((held_rss - base_rss) / max(held, 1), 2)
+                              if base_rss is not None and held_rss is not None else None),
+        "threads": len(sys._current_frames()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ASGI 流式接口并发压测")
+    parser.add_argument("--streams", type=int, default=200, help="并发流数量")
+    parser.add_argument("--tokens", type=int, default=40, help="每个回复的 token 数")
+    parser.add_argument("--token-rate", type=float, default=10, help="假服务器每秒输出 token 数")
+    parser.add_argument("--latency", type=float, default=0.1, help="假服务器首 token 延迟")
+    parser.add_argument("--tracemalloc", action="store_true", help="额外用 tracemalloc 统计 Python 内存 (较慢)")
+    parser.add_argument("--output", help="把结果 (JSON) 追加写入该文件")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency)
+    workdir = tempfile.mkdtemp(prefix="asgi_load_")
+    try:
+        # 在临时目录运行，历史记录不会写进仓库；配置通过环境变量注入
+        os.chdir(workdir)
+        os.environ.update({
+            "MY_API_KEY": "sk-fake", "MY_API_URL": base_url,
+            "MY_MODEL_NAME": "fake-model", "MY_STREAM": "True",
+        })
+        import asgi
+        result = asyncio.run(run_load(args, asgi))
+    finally:
+        stop_process(server)
+
+    result.update(run_info())
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    write_results(args.output, [result])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,627 @@
+"""基准测试套件：用本地假 OpenAI 服务器驱动 app.py 的接口和 main.py 命令行
+
+    python benchmarks/run_benchmarks.py                       # 全部测试
+    python benchmarks/run_benchmarks.py --suites stream,storage --sizes 10,1000
+    python benchmarks/run_benchmarks.py --token-rate 200 --latency 0.2 --fail-rate 0.05
+
+测试项 (--suites)：
+    stream   通过真实 HTTP 调用 app.py：首 token 延迟 (TTFT)、客户端收到的 token/s、其它接口耗时
+    memory   N 个并发流同时挂起时 app.py 进程的内存增量 (每个流)
+    storage  10 / 1k / 10k 个历史对话下 save_chat / load_chat / list_all_chats 的耗时和磁盘占用，
+             分别测 旧版 JSON / 追加日志 / 压缩快照 三种格式 (--storage-formats)
+    cli      main.py：启动到菜单出现的时间、首 token 延迟、一轮对话耗时
+    startup  冷启动：用 python -X importtime 导入 app / main 的耗时、最重的直接依赖、
+             openai / httpx (httpx2) / numpy 是否在启动时就被导入，以及 app.py 从启动到端口可连接的时间
+    recall   长期记忆：10 万个片段 (--recall-chunks) 的建索引速度、取回延迟和召回率 (需要 numpy)；
+             查询取某个片段里的几个词加上随机词，统计该片段排在第 1 / 前 k 位的比例
+
+所有子测试都在临时目录里运行，不会改动仓库里的 history/ 和 .env。
+结果以 JSON Lines 追加到 --output (默认 benchmarks/results.jsonl)，每个测试项一行，便于比较不同提交。
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import quote
+
+from common import (ROOT, free_port, wait_for_port, rss_kb, summarize_ms, start_fake_server,
+                    stop_process, run_info, write_results)
+
+SUITES = ("stream", "memory", "storage", "cli", "startup", "recall")
+SERVER_SNIPPET = "import sys; sys.path.insert(0, sys.argv[1]); import app; app.app.run(port=int(sys.argv[2]), threaded=True)"
+
+
+# ================= 公共 =================
+def make_workdir():
+    """临时运行目录：只带 prompts/，历史记录和缓存都写在这里"""
+    workdir = tempfile.mkdtemp(prefix="ai_bench_")
+    shutil.copytree(os.path.join(ROOT, "prompts"), os.path.join(workdir, "prompts"))
+    return workdir
+
+
+def bench_env(base_url, extra=None):
+    env = dict(os.environ)
+    env.update({
+        "MY_API_KEY": "sk-fake", "MY_API_URL": base_url, "MY_MODEL_NAME": "fake-model",
+        "MY_STREAM": "True", "PYTHONUNBUFFERED": "1", "PYTHONIOENCODING": "utf-8",
+    })
+    env.update(extra or {})
+    return env
+
+
+def start_app_server(workdir, env):
+    """在子进程里启动 app.py (Flask 多线程服务器)，返回 (进程, 端口)"""
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_SNIPPET, ROOT, str(port)],
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, timeout=30)
+    except Exception:
+        stop_process(proc)
+        raise
+    return proc, port
+
+
+class AppClient:
+    """最小的 HTTP 客户端：每个请求一个连接，流式读取 SSE"""
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, payload=None, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = dict(headers or {})
+        if body:
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp.status, data
+
+    def new_chat(self, prompt):
+        status, data = self.request("POST", "/api/new_chat", {"filename": prompt})
+        return json.loads(data)["chat_id"]
+
+    def stream(self, chat_id, message="hello", on_first=None, hold=None):
+        """打开一个 /api/chat_stream，返回 (首帧时间, 结束时间, 帧数, 文本, 是否出错)"""
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+        started = time.perf_counter()
+        conn.request("GET", f"/api/chat_stream?chat_id={chat_id}&message={quote(message)}")
+        resp = conn.getresponse()
+        first, frames, parts, error = None, 0, [], False
+        buf = b""
+        while True:
+            chunk = resp.read1(65536)
+            if not chunk:
+                break
+            buf += chunk
+            while b"\n\n" in buf:
+                frame, buf = buf.split(b"\n\n", 1)
+                fields = dict(line.split(b": ", 1) for line in frame.split(b"\n") if b": " in line)
+                # 只统计正文帧 (跳过 start / done 等命名事件和保活注释)
+                if b"data" not in fields or b"event" in fields:
+                    continue
+                text = json.loads(fields[b"data"]).get("text", "")
+                if first is None:
+                    first = time.perf_counter()
+                    if on_first:
+                        on_first()
+                    if hold:
+                        hold.wait()
+                frames += 1
+                parts.append(text)
+                if text.startswith("❌"):
+                    error = True
+        conn.close()
+        return first - started if first else None, time.perf_counter() - started, frames, "".join(parts), error
+
+
+# ================= stream：TTFT / token 吞吐 / 接口耗时 =================
+def bench_stream(args, base_url):
+    workdir = make_workdir()
+    proc, port = start_app_server(workdir, bench_env(base_url))
+    client = AppClient(port)
+    prompt = sorted(os.listdir(os.path.join(workdir, "prompts")))[0]
+    try:
+        ttft, rates, totals, frames, errors = [], [], [], [], 0
+        for i in range(args.requests + 1):
+            chat_id = client.new_chat(prompt)
+            first, total, n, text, error = client.stream(chat_id)
+            if i == 0:
+                continue  # 预热：建立上游连接、导入延迟加载的模块
+            if error or first is None:
+                errors += 1
+                continue
+            ttft.append(first)
+            totals.append(total)
+            frames.append(n)
+            if total > first:
+                rates.append(args.tokens / (total - first))
+
+        routes = {}
+        for name, method, path, payload in [
+            ("check_config", "GET", "/api/check_config", None),
+            ("prompts", "GET", "/api/prompts", None),
+            ("history", "GET", "/api/history", None),
+            ("fetch_models", "POST", "/api/fetch_models", {"api_key": "sk-fake", "base_url": base_url}),
+            ("new_chat", "POST", "/api/new_chat", {"filename": prompt}),
+        ]:
+            samples = []
+            for _ in range(args.route_samples):
+                t = time.perf_counter()
+                client.request(method, path, payload)
+                samples.append(time.perf_counter() - t)
+            routes[name] = summarize_ms(samples)
+
+        # JSON 响应压缩：同一个接口 不带 / 带 Accept-Encoding: gzip 的响应大小和耗时
+        compression = {}
+        for name, method, path, payload in [
+            ("history", "GET", "/api/history", None),
+            ("load_chat", "POST", "/api/load_chat", {"chat_id": chat_id}),
+        ]:
+            for encoding in ("identity", "gzip"):
+                samples, size = [], 0
+                for _ in range(args.route_samples):
+                    t = time.perf_counter()
+                    status, data = client.request(method, path, payload, {"Accept-Encoding": encoding})
+                    samples.append(time.perf_counter() - t)
+                    size = len(data)
+                compression[f"{name}_{encoding}"] = dict(summarize_ms(samples), bytes=size)
+    finally:
+        stop_process(proc)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "suite": "stream",
+        "requests": args.requests,
+        "errors": errors,
+        "ttft": summarize_ms(ttft),
+        "stream_total": summarize_ms(totals),
+        "tokens_per_sec_p50": round(sorted(rates)[len(rates) // 2], 1) if rates else None,
+        "frames_per_stream_avg": round(sum(frames) / len(frames), 1) if frames else None,
+        "routes": routes,
+        "response_compression": compression,
+    }
+
+
+# ================= memory：并发流的内存开销 =================
+def bench_memory(args, base_url):
+    workdir = make_workdir()
+    proc, port = start_app_server(workdir, bench_env(base_url))
+    client = AppClient(port)
+    prompt = sorted(os.listdir(os.path.join(workdir, "prompts")))[0]
+    try:
+        chat_ids = [client.new_chat(prompt) for _ in range(args.streams + 1)]
+        client.stream(chat_ids.pop())  # 预热
+        base_rss = rss_kb(proc.pid)
+
+        # 所有流都收到首帧后暂停读取，此时全部流都挂在服务端，测量服务进程的内存
+        arrived = threading.Semaphore(0)
+        hold = threading.Event()
+        results = []
+
+        def worker(chat_id):
+            results.append(client.stream(chat_id, on_first=arrived.release, hold=hold))
+
+        threads = [threading.Thread(target=worker, args=(c,), daemon=True) for c in chat_ids]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        held = 0
+        deadline = time.monotonic() + 120
+        while held < len(threads) and time.monotonic() < deadline:
+            if arrived.acquire(timeout=1):
+                held += 1
+        held_rss = rss_kb(proc.pid)
+        hold.set()
+        for t in threads:
+            t.join(timeout=300)
+        wall = time.perf_counter() - t0
+    finally:
+        stop_process(proc)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "suite": "memory",
+        "server": "app.py (threaded WSGI)",
+        "streams": args.streams,
+        "held_concurrently": held,
+        "completed": sum(1 for r in results if r[0] is not None and not r[4]),
+        "rss_base_kb": base_rss,
+        "rss_held_kb": held_rss,
+        "rss_per_stream_kb": (round((held_rss - base_rss) / max(held, 1), 2)
+                              if base_rss is not None and held_rss is not None else None),
+        "wall_time_s": round(wall, 3),
+    }
+
+
+# ================= storage：不同历史规模下的读写耗时 =================
+def fake_messages(rng, turns):
+    words = ["机器学习", "数据", "模型", "你好", "今天", "天气", "代码", "Python", "Flask", "接口", "。", "，", " "]
+    messages = [{"role": "system", "content": "你是一个测试助手。" * 20}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": "".join(rng.choices(words, k=30))})
+        messages.append({"role": "assistant", "content": "".join(rng.choices(words, k=120))})
+    return messages
+
+
+# 存储格式 -> (HistoryManager 后端, 是否压缩)
+STORAGE_FORMATS = {
+    "json": ("json", False),
+    "journal": ("journal", False),
+    "compressed": ("journal", True),
+}
+
+
+def chat_files_bytes():
+    # 只算对话文件 (和压缩字典)，不含元数据索引、全文索引
+    total = 0
+    for root, _, files in os.walk("history"):
+        for name in files:
+            if name.endswith((".json", ".jsonl", ".z", ".zdict")) and not name.startswith("."):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def bench_storage_size(size, args, fmt):
+    from src.history_manager import HistoryManager
+    backend, compress = STORAGE_FORMATS[fmt]
+    rng = random.Random(size)
+    workdir = tempfile.mkdtemp(prefix=f"ai_bench_hist{size}_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        mgr = HistoryManager(backend, compress=compress)
+        t = time.perf_counter()
+        ids = []
+        for _ in range(size):
+            chat_id, data = mgr.create_new_chat("bench.md", "你是一个测试助手。", "hi")
+            data["messages"] = fake_messages(rng, args.turns)
+            mgr.save_chat(chat_id, data)
+            ids.append(chat_id)
+        generate_s = time.perf_counter() - t
+        retrain_s = None
+        if compress:
+            # 用生成的对话训练预置字典，再用新字典重写所有快照 (对应运行一段时间后的状态)
+            t = time.perf_counter()
+            if mgr.storage.train_dictionary():
+                for chat_id in ids:
+                    mgr.storage.compact(chat_id)
+            retrain_s = round(time.perf_counter() - t, 3)
+        disk_bytes = chat_files_bytes()
+
+        # 冷启动：新建 HistoryManager，第一次列表需要对照文件签名刷新索引
+        mgr = HistoryManager(backend, compress=compress)
+        t = time.perf_counter()
+        mgr.list_all_chats()
+        list_cold = time.perf_counter() - t
+
+        samples = min(args.samples, size)
+        picks = [rng.choice(ids) for _ in range(samples)]
+        load, window, save, list_all, list_page = [], [], [], [], []
+        for chat_id in picks:
+            t = time.perf_counter()
+            mgr.load_window(chat_id, limit=10)
+            window.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            data = mgr.load_chat(chat_id)
+            load.append(time.perf_counter() - t)
+
+            data["messages"].append({"role": "user", "content": "再来一轮"})
+            data["messages"].append({"role": "assistant", "content": "好的，" * 50})
+            t = time.perf_counter()
+            mgr.save_chat(chat_id, data)
+            save.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            mgr.list_all_chats()
+            list_all.append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            mgr.list_all_chats(limit=50)
+            list_page.append(time.perf_counter() - t)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "format": fmt,
+        "chats": size,
+        "turns_per_chat": args.turns,
+        "disk_bytes": disk_bytes,
+        "generate_s": round(generate_s, 3),
+        "retrain_s": retrain_s,
+        "save_chat": summarize_ms(save),
+        "load_chat": summarize_ms(load),
+        "load_window10": summarize_ms(window),
+        "list_all_chats_cold_ms": round(list_cold * 1000, 3),
+        "list_all_chats": summarize_ms(list_all),
+        "list_all_chats_page50": summarize_ms(list_page),
+    }
+
+
+def bench_storage(args, base_url=None):
+    sys.path.insert(0, ROOT)
+    return {
+        "suite": "storage",
+        "sizes": [bench_storage_size(size, args, fmt) for size in args.sizes for fmt in args.storage_formats],
+    }
+
+
+# ================= recall：长期记忆的取回延迟和召回率 =================
+def fake_vocab(rng, size):
+    """按 Zipf 分布取词的词表：一半是 2~3 个汉字的词，一半是英文单词"""
+    words = set()
+    while len(words) < size:
+        if rng.random() < 0.5:
+            words.add("".join(chr(rng.randint(0x4e00, 0x4e00 + 3000)) for _ in range(rng.randint(2, 3))))
+        else:
+            words.add("".join(chr(rng.randint(97, 122)) for _ in range(rng.randint(3, 8))))
+    words = sorted(words)
+    rng.shuffle(words)
+    weights = [1 / (i + 1) for i in range(size)]
+    return words, weights
+
+
+def bench_recall(args, base_url=None):
+    sys.path.insert(0, ROOT)
+    from src import memory
+    if memory.load_numpy() is None:
+        return {"suite": "recall", "skipped": "numpy 未安装"}
+    rng = random.Random(21)
+    words, weights = fake_vocab(rng, 20000)
+    per_chat = 10
+    workdir = tempfile.mkdtemp(prefix="ai_bench_recall_")
+    try:
+        index = memory.MemoryIndex(workdir)
+        chunks = {}
+        t = time.perf_counter()
+        for c in range(args.recall_chunks // per_chat):
+            chat_id = f"c{c}"
+            messages = []
+            for i in range(per_chat):
+                text = " ".join(rng.choices(words, weights, k=rng.randint(20, 60)))
+                messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": text})
+                chunks[(chat_id, i)] = text.split(" ")
+            index.update(chat_id, messages)
+        build_s = time.perf_counter() - t
+        count = index.count()
+        disk_bytes = sum(os.path.getsize(os.path.join(index.directory, n)) for n in os.listdir(index.directory))
+
+        t = time.perf_counter()
+        index = memory.MemoryIndex(workdir)
+        open_s = time.perf_counter() - t
+
+        # 查询取目标片段里的 6 个词 (顺序打乱) 加 2 个随机词，看目标能否排进前 k
+        keys = rng.sample(list(chunks), args.recall_queries)
+        latencies, hit1, hitk = [], 0, 0
+        for chat_id, i in keys:
+            target = chunks[(chat_id, i)]
+            query = rng.sample(target, min(6, len(target))) + rng.choices(words, weights, k=2)
+            t = time.perf_counter()
+            found = index.recall(" ".join(query), top_k=args.recall_k, budget=10 ** 9, min_score=-1)
+            latencies.append(time.perf_counter() - t)
+            ranks = [(r["chat_id"], r["index"]) for r in found]
+            hit1 += bool(ranks) and ranks[0] == (chat_id, i)
+            hitk += (chat_id, i) in ranks
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "suite": "recall",
+        "embedder": index.embedder.name,
+        "chunks": count,
+        "disk_bytes": disk_bytes,
+        "build_s": round(build_s, 2),
+        "build_chunks_per_sec": round(count / build_s, 1) if build_s > 0 else None,
+        "open_ms": round(open_s * 1000, 3),
+        "recall": summarize_ms(latencies),
+        "top_k": args.recall_k,
+        "recall_at_1": round(hit1 / len(keys), 3),
+        "recall_at_k": round(hitk / len(keys), 3),
+    }
+
+
+# ================= cli：main.py =================
+def bench_cli(args, base_url):
+    workdir = make_workdir()
+    timings = {"startup": [], "ttft": [], "turn": [], "process": []}
+    errors = 0
+    try:
+        for _ in range(args.cli_runs):
+            t0 = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=workdir,
+                                    env=bench_env(base_url), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            # 新对话 -> 选第一个角色 -> 发一句话 -> 退出
+            proc.stdin.write("\n1\nhello\nq\n".encode("utf-8"))
+            proc.stdin.close()
+            out, marks = b"", {}
+            while True:
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                now = time.perf_counter() - t0
+                out += chunk
+                text = out.decode("utf-8", errors="ignore")
+                if "startup" not in marks and "请选择" in text:
+                    marks["startup"] = now
+                if "生成中" in text:
+                    marks.setdefault("request", now)
+                    after = text.split("生成中", 1)[1].split("\n", 1)
+                    if len(after) > 1 and after[1].strip() and "ttft" not in marks:
+                        marks["ttft"] = now
+                    if len(after) > 1 and "-" * 50 in after[1] and "turn" not in marks:
+                        marks["turn"] = now
+                    # 上游出错时 main.py 打印 "❌ 发生错误: API请求失败: ..." 后退出，和 stream 一样算失败
+                    if len(after) > 1 and "❌" in after[1]:
+                        marks["error"] = now
+            proc.wait()
+            timings["process"].append(time.perf_counter() - t0)
+            if "startup" in marks:
+                timings["startup"].append(marks["startup"])
+            if "error" in marks or "ttft" not in marks:
+                errors += 1
+                continue
+            if "request" in marks and "ttft" in marks:
+                timings["ttft"].append(marks["ttft"] - marks["request"])
+            if "request" in marks and "turn" in marks:
+                timings["turn"].append(marks["turn"] - marks["request"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "suite": "cli",
+        "runs": args.cli_runs,
+        "errors": errors,
+        "startup_to_menu": summarize_ms(timings["startup"]),
+        "ttft": summarize_ms(timings["ttft"]),
+        "turn": summarize_ms(timings["turn"]),
+        "process_total": summarize_ms(timings["process"]),
+    }
+
+
+# ================= startup：冷启动 =================
+IMPORT_SNIPPET = "import sys; sys.path.insert(0, sys.argv[1]); import {}"
+# 这些库导入慢，启动时不应该被导入 (第一次用到时才导入)
+DEFERRED_MODULES = ("openai", "httpx", "httpx2", "numpy")
+
+
+def parse_importtime(stderr, target):
+    """解析 -X importtime 的输出：返回 (target 的累计导入耗时 µs, {直接依赖: 累计 µs}, 导入过的模块集合)"""
+    total, children, pending, modules = None, {}, {}, set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # 表头
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        name = name.strip()
+        modules.add(name.split(".")[0])
+        # 子模块先于父模块输出：遇到第 0 层的模块时，之前收集的第 1 层就是它的直接依赖
+        if depth == 1:
+            pending[name] = int(cumulative)
+        elif depth == 0:
+            if name == target:
+                total, children = int(cumulative), pending
+            pending = {}
+    return total, children, modules
+
+
+def bench_startup(args, base_url):
+    workdir = make_workdir()
+    env = bench_env(base_url)
+    result = {"suite": "startup", "runs": args.startup_runs}
+    try:
+        for target in ("app", "main"):
+            imports, walls, children, modules = [], [], {}, set()
+            for _ in range(args.startup_runs):
+                t = time.perf_counter()
+                proc = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SNIPPET.format(target), ROOT],
+                                      cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                      text=True, encoding="utf-8", errors="replace")
+                walls.append(time.perf_counter() - t)
+                total, children, modules = parse_importtime(proc.stderr, target)
+                if total is not None:
+                    imports.append(total / 1e6)
+            heaviest = sorted(children.items(), key=lambda kv: -kv[1])[:args.startup_top]
+            result[target] = {
+                "import": summarize_ms(imports),
+                "process_total": summarize_ms(walls),
+                "heaviest_imports_ms": {name: round(us / 1000, 1) for name, us in heaviest},
+                "deferred_loaded": [m for m in DEFERRED_MODULES if m in modules],
+            }
+
+        # app.py：启动子进程到端口可以连接
+        ready = []
+        for _ in range(args.startup_runs):
+            t = time.perf_counter()
+            proc, _ = start_app_server(workdir, env)
+            ready.append(time.perf_counter() - t)
+            stop_process(proc)
+        result["app"]["ready"] = summarize_ms(ready)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+BENCHES = {"stream": bench_stream, "memory": bench_memory, "storage": bench_storage, "cli": bench_cli,
+           "startup": bench_startup, "recall": bench_recall}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AI 助手基准测试套件")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"逗号分隔，可选 {','.join(SUITES)}")
+    parser.add_argument("--output", default="benchmarks/results.jsonl", help="结果追加写入的 JSON Lines 文件")
+    # 假服务器
+    parser.add_argument("--tokens", type=int, default=200, help="每个回复的 token 数")
+    parser.add_argument("--token-rate", type=float, default=0, help="假服务器每秒输出 token 数，0 为不限速")
+    parser.add_argument("--latency", type=float, default=0.05, help="假服务器首 token 延迟 (秒)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="假服务器注入失败的概率")
+    parser.add_argument("--fail-status", type=int, default=500)
+    # stream / memory
+    parser.add_argument("--requests", type=int, default=20, help="stream：顺序发起的对话轮数")
+    parser.add_argument("--route-samples", type=int, default=50, help="stream：其它接口各测多少次")
+    parser.add_argument("--streams", type=int, default=50, help="memory：并发流数量")
+    # storage
+    parser.add_argument("--sizes", default="10,1000,10000", help="storage：历史对话数量，逗号分隔")
+    parser.add_argument("--turns", type=int, default=5, help="storage：每个对话的轮数")
+    parser.add_argument("--samples", type=int, default=200, help="storage：每种操作的采样次数")
+    parser.add_argument("--storage-formats", default=",".join(STORAGE_FORMATS),
+                        help=f"storage：对比的存储格式，可选 {','.join(STORAGE_FORMATS)}")
+    # cli
+    parser.add_argument("--cli-runs", type=int, default=5, help="cli：运行 main.py 的次数")
+    # startup
+    parser.add_argument("--startup-runs", type=int, default=5, help="startup：每项测量的次数")
+    parser.add_argument("--startup-top", type=int, default=8, help="startup：列出最重的几个直接依赖")
+    # recall
+    parser.add_argument("--recall-chunks", type=int, default=100000, help="recall：索引中的片段数")
+    parser.add_argument("--recall-queries", type=int, default=200, help="recall：查询次数")
+    parser.add_argument("--recall-k", type=int, default=4, help="recall：每次取回的片段数")
+    args = parser.parse_args(argv)
+    args.suites = [s.strip() for s in args.suites.split(",") if s.strip()]
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    args.storage_formats = [s.strip() for s in args.storage_formats.split(",") if s.strip()]
+    if set(args.storage_formats) - set(STORAGE_FORMATS):
+        parser.error(f"未知的存储格式: {args.storage_formats}")
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"未知的测试项: {','.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake, base_url = start_fake_server(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency,
+                                       fail_rate=args.fail_rate, fail_status=args.fail_status)
+    info = run_info()
+    params = {k: getattr(args, k) for k in ("tokens", "token_rate", "latency", "fail_rate")}
+    records = []
+    try:
+        for name in args.suites:
+            print(f"▶ {name} ...", flush=True)
+            t = time.perf_counter()
+            result = BENCHES[name](args, base_url)
+            result.update(info, fake_server=params, elapsed_s=round(time.perf_counter() - t, 2))
+            records.append(result)
+            print(json.dumps(result, ensure_ascii=False, indent=2), flush=True)
+    finally:
+        stop_process(fake)
+    write_results(args.output, records)
+    if args.output:
+        print(f"✅ 结果已追加到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,66 @@
 # main.py
 import sys
+import threading
 from src.config import load_config
 from src.file_loader import get_prompt_list, load_prompt_by_filename
 from src.ai_engine import AIEngine
 from src.history_manager import HistoryManager # 导入新模块
+from src.response_cache import ResponseCache
+from src.jobs import JobExecutor, TitleBatcher
+from src.router import UpstreamRouter
+from src.scheduler import Scheduler
+from src.batch import parse_args as parse_batch_args, run_batch
+from src.prompt_store import missing_prompt, missing_prompt_error
+
+def build_engine(config):
+    cache = None
+    if config["cache"]:
+        cache = ResponseCache(memory_items=config["cache_memory_items"],
+                              disk_max_bytes=int(config["cache_max_mb"] * 1024 * 1024),
+                              ttl=config["cache_ttl"])
+    # 配置了 endpoints.json 或开启对冲时，对话请求经多上游路由发送
+    router = UpstreamRouter()
+    router.configure(config)
+    # 准入控制：批量处理的并发再高也不超过 MY_MAX_CONCURRENCY 等上游限制
+    scheduler = Scheduler()
+    scheduler.configure(config, router.endpoints)
+    return AIEngine.from_config(config, cache=cache, router=router if router.enabled else None,
+                                scheduler=scheduler)
+
+def batch(argv):
+    """python main.py batch 输入文件 --prompt 角色.md ...：批量处理，不进入交互界面"""
+    args = parse_batch_args(argv)
+    system_content = None
+    if args.prompt:
+        system_content, _ = load_prompt_by_filename(args.prompt)
+        if not system_content:
+            print(f"❌ 角色文件加载失败: {args.prompt}")
+            return
+    run_batch(build_engine(load_config()), args, system_content)
 
 def main():
-    # 1. 初始化
+    if sys.argv[1:2] == ["batch"]:
+        return batch(sys.argv[2:])
+
+    # 1. 初始化：先读配置和历史索引，openai SDK 的导入不挡在首页前面
     config = load_config()
-    engine = AIEngine(config["api_key"], config["base_url"], config["model"])
-    history_mgr = HistoryManager()
+    history_mgr = HistoryManager(compress=config["history_compress"], memory=config["memory"])
 
     print("="*50)
     print(f" 🧠 AI 记忆助手 (模型: {config['model']})")
     print("="*50)
 
     # 2. 首页：选择“新对话”还是“历史记录”
-    all_chats = history_mgr.list_all_chats()
+    # 列出最近的 5 条历史 (只取索引中的前 5 条)
+    all_chats = history_mgr.list_all_chats(limit=5)
     
     print("\n[+] 创建新对话 (New Chat)")
-    # 列出最近的 5 条历史
-    for i, chat in enumerate(all_chats[:5]):
+    for i, chat in enumerate(all_chats):
         print(f"[{i+1}] 🕒 {chat['updated_at'][5:-3]} | {chat['title']} ({chat['prompt_file']})")
+
+    # 首页已经显示出来，用户选择的同时在后台创建上游客户端
+    engine = build_engine(config)
+    threading.Thread(target=engine.warm_up, daemon=True).start()
     
     choice = input("\n👉 请选择 (直接回车=新对话): ").strip()
     
@@ -33,6 +72,10 @@ def main():
         selected_chat = all_chats[int(choice)-1]
         chat_id = selected_chat["id"]
         current_chat_data = history_mgr.load_chat(chat_id)
+        ref = missing_prompt(current_chat_data["messages"])
+        if ref:
+            print(missing_prompt_error(ref))
+            return
         print(f"\n✅ 已恢复对话：{current_chat_data['title']}")
         # 打印最后两句让用户想起来聊到哪了
         if len(current_chat_data["messages"]) > 1:
@@ -61,6 +104,28 @@ def main():
             print("❌ 选择无效")
             return
 
+    # 标题生成、摘要更新放到后台线程，回复打印完马上可以输入下一句
+    jobs = JobExecutor(workers=1)
+    data_lock = threading.Lock()
+
+    def apply_title(cid, new_title):
+        if not new_title or new_title == "新对话": return
+        with data_lock:
+            current_chat_data["title"] = new_title # 更新内存里的标题
+        history_mgr.update_title(cid, new_title)
+
+    def update_summary(cid):
+        with data_lock:
+            prepared = engine.prepare_summary(current_chat_data)
+        if not prepared: return
+        span, kwargs = prepared
+        text = engine.run_summary(kwargs)
+        with data_lock:
+            current_chat_data["summary"] = {"text": text, "upto": span[1]}
+            history_mgr.save_chat(cid, current_chat_data)
+
+    title_batcher = TitleBatcher(jobs, lambda: engine, apply_title)
+
     # 3. 进入聊天循环 (Context Loop)
     while True:
         try:
@@ -71,35 +136,38 @@ def main():
             if not user_input: continue
 
             # A. 把用户的话加入历史
-            current_chat_data["messages"].append({"role": "user", "content": user_input})
+            with data_lock:
+                current_chat_data["messages"].append({"role": "user", "content": user_input})
             
             print("-" * 20 + " 生成中 " + "-" * 20)
             
             # B. 发送完整历史给 AI
-            stream = engine.chat_stream(current_chat_data["messages"])
-            
             ai_response_content = ""
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    print(content, end="", flush=True)
-                    ai_response_content += content
+            # 长期记忆 (MY_MEMORY)：从其他对话里取回相关片段一起发送
+            memory = history_mgr.recall(user_input, exclude=chat_id, top_k=config["memory_top_k"],
+                                        budget=config["memory_budget"])
+            for content in engine.stream_text(current_chat_data["messages"], summary=current_chat_data.get("summary"),
+                                              memory=memory):
+                print(content, end="", flush=True)
+                ai_response_content += content
             
             print("\n" + "-" * 50)
 
-            # C. 把 AI 的话加入历史
-            current_chat_data["messages"].append({"role": "assistant", "content": ai_response_content})
-            
-            # D. 实时保存
-            history_mgr.save_chat(chat_id, current_chat_data)
+            with data_lock:
+                # C. 把 AI 的话加入历史
+                current_chat_data["messages"].append({"role": "assistant", "content": ai_response_content})
 
-            # E. 彩蛋：如果是新对话的第一轮，自动生成标题
-            # 判断条件：目前只有 3 条消息 (System + User + AI) 且标题还是初始值
-            if len(current_chat_data["messages"]) == 3 and current_chat_data["title"] == "新对话":
-                new_title = engine.generate_title(user_input, ai_response_content)
-                history_mgr.update_title(chat_id, new_title)
-                current_chat_data["title"] = new_title # 更新内存里的标题
-                print(f"✨ [自动命名] 对话标题已更新为: {new_title}")
+                # D. 实时保存
+                history_mgr.save_chat(chat_id, current_chat_data)
+
+                # E. 彩蛋：如果是新对话的第一轮，后台自动生成标题
+                # 判断条件：目前只有 3 条消息 (System + User + AI) 且标题还是初始值
+                if len(current_chat_data["messages"]) == 3 and current_chat_data["title"] == "新对话":
+                    title_batcher.add(chat_id, user_input, ai_response_content)
+
+            # summary 策略：旧消息被挤出上下文窗口后，后台并入滚动摘要
+            if engine.context.policy == "summary":
+                jobs.submit(f"summary:{chat_id}", update_summary, chat_id)
 
         except KeyboardInterrupt:
             print("\n\n💾 强制退出，进度已保存。")
@@ -108,5 +176,14 @@ def main():
             print(f"\n❌ 发生错误: {e}")
             break
 
+    # 退出前把还没落地的标题 / 摘要做完
+    try:
+        title_batcher.drain()
+        jobs.shutdown()
+    except KeyboardInterrupt:
+        pass
+    if current_chat_data["title"] != "新对话":
+        print(f"✨ 对话标题: {current_chat_data['title']}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
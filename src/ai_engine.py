@@ -1,51 +1,391 @@
-from openai import OpenAI
+import json
+import time
+import asyncio
+import threading
+from contextlib import nullcontext
+from src.context_manager import ContextManager, count_tokens, MESSAGE_OVERHEAD
+from src.scheduler import INTERACTIVE, BACKGROUND, DEFAULT_ENDPOINT
+from src.response_cache import replay_chunks
+from src.metrics import metrics, RATE_BUCKETS
+from src.router import response_pieces, aresponse_pieces
+
+TITLE_PROMPT = "请根据以下对话生成一个极短的标题(5-8字)，不要包含标点：\n用户：{user}\nAI：{ai}"
+BATCH_TITLE_PROMPT = ("请分别为下面 {n} 段对话各生成一个极短的标题(5-8字)，不要包含标点。"
+                      "只输出一个 JSON 字符串数组，按顺序对应每段对话，不要输出其他内容。\n\n{dialogs}")
+
+# 上游请求指标 (token 数按流式增量计数，一段增量通常就是一个 token)
+CHAT_REQUESTS = metrics.counter("ai_chat_requests_total", "对话请求数 (result: ok / error / aborted / cache_hit)",
+                                ("model", "result"))
+UPSTREAM_ERRORS = metrics.counter("ai_upstream_errors_total", "上游请求失败次数", ("model", "error"))
+RESPONSE_SECONDS = metrics.histogram("ai_response_seconds", "发出请求到收到上游响应头的时间", ("model",))
+TTFT = metrics.histogram("ai_time_to_first_token_seconds", "发出请求到收到第一段回复的时间", ("model",))
+STREAM_SECONDS = metrics.histogram("ai_stream_duration_seconds", "一次回复从请求到结束的总时间", ("model",))
+TOKENS = metrics.counter("ai_stream_tokens_total", "收到的流式增量数", ("model",))
+TOKENS_PER_SECOND = metrics.histogram("ai_tokens_per_second", "首个增量之后的生成速度", ("model",),
+                                      buckets=RATE_BUCKETS)
+BACKGROUND_SECONDS = metrics.histogram("ai_background_request_seconds", "标题 / 摘要等后台请求耗时", ("kind",))
+
+
+class StreamMeter:
+    """记录一次对话请求的首字延迟、生成速度和结果
+
+    用作上下文管理器包住整个流：正常结束记 ok，消费方中途关闭生成器记 aborted，
+    其他异常记 error (已经用 error() 记过的不重复记)。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.start = time.perf_counter()
+        self.first = None
+        self.tokens = 0
+        self.failed = False
+
+    def token(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            TTFT.observe(self.first - self.start, self.model)
+        self.tokens += 1
+
+    def error(self, e):
+        self.failed = True
+        UPSTREAM_ERRORS.inc(self.model, type(e).__name__)
+        self._finish("error")
+
+    def _finish(self, result):
+        end = time.perf_counter()
+        CHAT_REQUESTS.inc(self.model, result)
+        STREAM_SECONDS.observe(end - self.start, self.model)
+        if self.tokens:
+            TOKENS.inc(self.model, value=self.tokens)
+            if self.tokens > 1 and end > self.first:
+                TOKENS_PER_SECOND.observe((self.tokens - 1) / (end - self.first), self.model)
+        metrics.add_span("upstream", self.start, end - self.start, model=self.model, result=result,
+                         tokens=self.tokens,
+                         ttft_ms=round((self.first - self.start) * 1000, 3) if self.first else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.failed:
+            return False
+        if exc_type is None:
+            self._finish("ok")
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            self._finish("aborted")
+        else:
+            self.error(exc)
+        return False
 
 class AIEngine:
-    def __init__(self, api_key, base_url, model_name, temperature=0.7, max_tokens=2000, stream=True):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(self, api_key, base_url, model_name, temperature=0.7, max_tokens=2000, stream=True,
+                 context_policy="sliding", context_budget=0, cache=None, clients=None, router=None,
+                 scheduler=None):
+        # 可选的客户端注册表 (ClientRegistry)：重建引擎时复用已有的连接池
+        self.clients = clients
+        # 可选的多上游路由 (UpstreamRouter)：设置后对话请求由它选择上游、重试和对冲
+        self.router = router
+        # 可选的准入控制 (Scheduler)：按上游 / 模型限制并发和速率，超出时按优先级排队
+        self.scheduler = scheduler
+        # 构造引擎所用的配置快照 (from_config 时设置)，进行中的请求始终看到同一份配置
+        self.config = None
+        # 上游客户端在第一次使用时才创建：openai SDK 导入较慢，不放在启动路径上
+        self._credentials = (api_key, base_url)
+        self._client = None
+        self._client_lock = threading.Lock()
         self.model = model_name
         self.temperature = float(temperature)
         self.max_tokens = int(max_tokens)
         self.stream = stream
+        # 上下文窗口管理：发送前把历史裁剪到模型的 token 预算内
+        self.context = ContextManager(context_policy, context_budget)
+        # 可选的回复缓存 (ResponseCache)，为 None 时不缓存
+        self.cache = cache
 
-    def chat_stream(self, messages_history, model_override=None):
-        """发送完整的对话历史 (流式)，支持模型覆盖"""
-        try:
-            # 如果有指定模型，就用指定的，否则用默认的
-            target_model = model_override if model_override else self.model
-            
-            response = self.client.chat.completions.create(
-                model=target_model,
-                messages=messages_history,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=self.stream,
-            )
+    @classmethod
+    def from_config(cls, cfg, cache=None, clients=None, router=None, scheduler=None):
+        """按配置快照 (src.config.Config) 构造引擎"""
+        engine = cls(
+            api_key=cfg.api_key,
+            base_url=cfg.base_url,
+            model_name=cfg.model,
+            temperature=cfg.temperature,
+            max_tokens=cfg.max_tokens,
+            stream=cfg.stream,
+            context_policy=cfg.context_policy,
+            context_budget=cfg.context_budget,
+            cache=cache,
+            clients=clients,
+            router=router,
+            scheduler=scheduler
+        )
+        engine.config = cfg
+        return engine
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._make_client(*self._credentials)
+        return self._client
+
+    def warm_up(self):
+        """提前创建上游客户端 (导入 openai SDK)，可放在后台线程里，让第一次请求不再等导入"""
+        try:
+            self.client
+        except Exception as e:
+            print(f"❌ 预热 AI 客户端失败: {e}")
+
+    def _make_client(self, api_key, base_url):
+        if self.clients is not None:
+            return self.clients.get(api_key, base_url)
+        from openai import OpenAI
+        return OpenAI(api_key=api_key, base_url=base_url)
+
+    def _chat_kwargs(self, messages_history, model_override=None, summary=None, memory=None):
+        """组装 chat.completions.create 的参数，同步 / 异步引擎共用；memory 为长期记忆取回的片段"""
+        # 如果有指定模型，就用指定的，否则用默认的
+        target_model = model_override if model_override else self.model
+        return dict(
+            model=target_model,
+            messages=self.context.select(messages_history, target_model, self.max_tokens, summary, memory),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=self.stream,
+        )
+
+    def _cache_key(self, kwargs):
+        if self.cache is None:
+            return None
+        return self.cache.make_key(kwargs["model"], kwargs["temperature"], kwargs["max_tokens"], kwargs["messages"])
+
+    def _admission(self, kwargs):
+        """准入控制的参数：(可以发往的上游, 预留的 token 数 = 输入估算 + max_tokens)"""
+        if self.router is not None:
+            endpoints = [ep.name for ep in self.router.plan(kwargs["model"])]
+        else:
+            endpoints = [DEFAULT_ENDPOINT]
+        tokens = sum(count_tokens(m.get("content") or "") + MESSAGE_OVERHEAD for m in kwargs["messages"])
+        return endpoints, tokens + kwargs.get("max_tokens", 0)
+
+    def _background(self, kwargs):
+        """标题 / 摘要等非流式后台请求的放行上下文 (经 self.client 发往主上游)"""
+        if self.scheduler is None:
+            return nullcontext()
+        _, tokens = self._admission(kwargs)
+        return self.scheduler.slot(kwargs["model"], [DEFAULT_ENDPOINT], tokens, BACKGROUND)
+
+    def _title_kwargs(self, user_msg, ai_msg):
+        prompt = TITLE_PROMPT.format(user=user_msg[:100], ai=ai_msg[:100])
+        return dict(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.5,
+            max_tokens=20
+        )
+
+    def _summary_kwargs(self, chat_data, span, model_override=None):
+        return dict(
+            model=model_override if model_override else self.model,
+            messages=self.context.summary_request(chat_data, span),
+            temperature=0.3,
+            max_tokens=800
+        )
+
+    def chat_stream(self, messages_history, model_override=None, summary=None, memory=None):
+        """发送对话历史 (流式)，支持模型覆盖；历史会先按上下文策略裁剪"""
+        kwargs = self._chat_kwargs(messages_history, model_override, summary, memory)
+        try:
+            # 流由调用方消费，这里只能记录到拿到响应为止；首字延迟 / 生成速度由 stream_text 记录
+            with metrics.timer(RESPONSE_SECONDS, kwargs["model"], span="upstream", model=kwargs["model"]):
+                response = self.client.chat.completions.create(**kwargs)
             return response
         except Exception as e:
+            UPSTREAM_ERRORS.inc(kwargs["model"], type(e).__name__)
             raise Exception(f"API请求失败: {e}")
 
+    def stream_text(self, messages_history, model_override=None, summary=None, memory=None,
+                    priority=INTERACTIVE, on_wait=None):
+        """逐段返回回复文本 (兼容流式 / 非流式)；开启缓存时命中直接按流的形式回放
+
+        开启准入控制时先按 priority 排队，排队期间位置变化时调用 on_wait(位置)，放行时调用 on_wait(0)。
+        """
+        kwargs = self._chat_kwargs(messages_history, model_override, summary, memory)
+        key = self._cache_key(kwargs)
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                CHAT_REQUESTS.inc(kwargs["model"], "cache_hit")
+                yield from replay_chunks(cached)
+                return
+
+        ticket = None
+        if self.scheduler is not None:
+            endpoints, tokens = self._admission(kwargs)
+            with metrics.span("queue", model=kwargs["model"]):
+                ticket = self.scheduler.acquire(kwargs["model"], endpoints, tokens, priority, on_wait)
+        parts = []
+        try:
+            with StreamMeter(kwargs["model"]) as meter:
+                try:
+                    if self.router is not None:
+                        # 多上游：选最快的健康上游，失败时重试 / 换上游，拿到第一段回复才返回
+                        pieces = self.router.open(kwargs, self.stream, prefer=ticket and ticket.endpoint)
+                    else:
+                        pieces = response_pieces(self.client.chat.completions.create(**kwargs), self.stream)
+                except Exception as e:
+                    meter.error(e)
+                    raise Exception(f"API请求失败: {e}")
+
+                for content in pieces:
+                    meter.token()
+                    parts.append(content)
+                    yield content
+        finally:
+            if ticket is not None:
+                # 实际输出少于 max_tokens 时，把多预留的 token 还给限速桶
+                self.scheduler.release(ticket, ticket.tokens - kwargs["max_tokens"] + len(parts))
+
+        # 只缓存完整结束的回复 (中途断开时不会走到这里)
+        if key and parts:
+            self.cache.put(key, "".join(parts))
+
+    def prepare_summary(self, chat_data, model_override=None):
+        """summary 策略下，返回 (被挤出窗口的消息区间, 摘要请求参数)；不需要更新摘要时返回 None
+
+        只读取对话内容，调用方可以在持有对话锁时调用，然后在锁外执行 run_summary。
+        """
+        span = self.context.pending_summary(chat_data, model_override or self.model, self.max_tokens)
+        if not span:
+            return None
+        return span, self._summary_kwargs(chat_data, span, model_override)
+
+    def run_summary(self, kwargs):
+        with self._background(kwargs), metrics.timer(BACKGROUND_SECONDS, "summary", span="summary"):
+            response = self.client.chat.completions.create(**kwargs)
+        return response.choices[0].message.content.strip()
+
     def generate_title(self, user_msg, ai_msg):
         """生成标题"""
-        prompt = f"请根据以下对话生成一个极短的标题(5-8字)，不要包含标点：\n用户：{user_msg[:100]}\nAI：{ai_msg[:100]}"
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.5,
-                max_tokens=20
-            )
+            kwargs = self._title_kwargs(user_msg, ai_msg)
+            with self._background(kwargs), metrics.timer(BACKGROUND_SECONDS, "title", span="title"):
+                response = self.client.chat.completions.create(**kwargs)
             return response.choices[0].message.content.strip()
         except:
             return "新对话"
 
+    def generate_titles(self, pairs):
+        """为多段 (用户消息, AI 回复) 生成标题，多段时合并成一次请求，解析失败再逐个生成"""
+        if len(pairs) == 1:
+            return [self.generate_title(*pairs[0])]
+        dialogs = "\n\n".join(
+            f"[{i + 1}]\n用户：{u[:100]}\nAI：{a[:100]}" for i, (u, a) in enumerate(pairs)
+        )
+        try:
+            kwargs = dict(
+                model=self.model,
+                messages=[{"role": "user", "content": BATCH_TITLE_PROMPT.format(n=len(pairs), dialogs=dialogs)}],
+                temperature=0.5,
+                max_tokens=30 * len(pairs) + 20
+            )
+            with self._background(kwargs), \
+                    metrics.timer(BACKGROUND_SECONDS, "title_batch", span="title_batch", n=len(pairs)):
+                response = self.client.chat.completions.create(**kwargs)
+            text = response.choices[0].message.content.strip()
+            titles = json.loads(text[text.index("["):text.rindex("]") + 1])
+            if len(titles) == len(pairs) and all(isinstance(t, str) and t.strip() for t in titles):
+                return [t.strip() for t in titles]
+        except Exception:
+            pass
+        return [self.generate_title(u, a) for u, a in pairs]
+
     @staticmethod
-    def fetch_available_models(api_key, base_url):
+    def fetch_available_models(api_key, base_url, clients=None, refresh=False):
+        """获取模型列表；传入 clients 时复用连接并使用其模型列表缓存"""
         try:
+            if clients is not None:
+                return clients.list_models(api_key, base_url, refresh=refresh)
+            from openai import OpenAI
             client = OpenAI(api_key=api_key, base_url=base_url)
             models_response = client.models.list()
             model_list = [m.id for m in models_response.data]
             model_list.sort()
             return model_list
         except Exception as e:
-            raise Exception(str(e))
\ No newline at end of file
+            raise Exception(str(e))
+
+
+class AsyncAIEngine(AIEngine):
+    """AIEngine 的异步版本 (AsyncOpenAI)，供 asgi.py 在事件循环里使用
+
+    等待上游时不占用线程，一个进程可以同时挂住大量流式请求。
+    """
+
+    def _make_client(self, api_key, base_url):
+        if self.clients is not None:
+            return self.clients.get_async(api_key, base_url)
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=api_key, base_url=base_url)
+
+    def warm_up(self):
+        # 异步客户端要在事件循环里创建，这里只提前导入 SDK
+        import openai  # noqa: F401
+
+    async def chat_stream(self, messages_history, model_override=None, summary=None, memory=None):
+        """发送对话历史 (流式)，返回 AsyncStream 或完整响应"""
+        kwargs = self._chat_kwargs(messages_history, model_override, summary, memory)
+        try:
+            with metrics.timer(RESPONSE_SECONDS, kwargs["model"], span="upstream", model=kwargs["model"]):
+                return await self.client.chat.completions.create(**kwargs)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(kwargs["model"], type(e).__name__)
+            raise Exception(f"API请求失败: {e}")
+
+    async def stream_text(self, messages_history, model_override=None, summary=None, memory=None,
+                          priority=INTERACTIVE, on_wait=None):
+        """逐段返回回复文本 (异步生成器)；开启缓存时命中直接按流的形式回放"""
+        kwargs = self._chat_kwargs(messages_history, model_override, summary, memory)
+        key = self._cache_key(kwargs)
+        if key:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                CHAT_REQUESTS.inc(kwargs["model"], "cache_hit")
+                for piece in replay_chunks(cached):
+                    yield piece
+                return
+
+        ticket = None
+        if self.scheduler is not None:
+            endpoints, tokens = self._admission(kwargs)
+            with metrics.span("queue", model=kwargs["model"]):
+                ticket = await self.scheduler.aacquire(kwargs["model"], endpoints, tokens, priority, on_wait)
+        parts = []
+        try:
+            with StreamMeter(kwargs["model"]) as meter:
+                try:
+                    if self.router is not None:
+                        pieces = await self.router.aopen(kwargs, self.stream, prefer=ticket and ticket.endpoint)
+                    else:
+                        pieces = aresponse_pieces(await self.client.chat.completions.create(**kwargs),
+                                                  self.stream)
+                except Exception as e:
+                    meter.error(e)
+                    raise Exception(f"API请求失败: {e}")
+
+                async for content in pieces:
+                    meter.token()
+                    parts.append(content)
+                    yield content
+        finally:
+            if ticket is not None:
+                self.scheduler.release(ticket, ticket.tokens - kwargs["max_tokens"] + len(parts))
+
+        if key and parts:
+            await asyncio.to_thread(self.cache.put, key, "".join(parts))
+
+    async def close(self):
+        # 共享的连接池由 ClientRegistry 统一关闭
+        if self.clients is None and self._client is not None:
+            await self._client.close()
@@ -0,0 +1,316 @@
+"""批量处理：python main.py batch 把 JSONL / CSV 里的每条输入用同一个角色跑一遍
+
+    python main.py batch inputs.jsonl --prompt 翻译官.md --output results.jsonl --workers 8 --rate 5
+
+输出文件本身就是检查点：每完成一条立即追加一行 JSON；中途被杀掉后用同样的命令重新运行，
+已成功的条目会被跳过 (失败的条目会重试)，只处理剩下的部分。
+"""
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+from src.scheduler import BATCH
+
+DEFAULT_WORKERS = 4
+# 进度输出的间隔 (秒) 和输出文件 fsync 的间隔 (条)
+PROGRESS_INTERVAL = 2.0
+FSYNC_EVERY = 50
+# 输入记录里没有指定 --field 时依次尝试这些字段
+INPUT_FIELDS = ("input", "text", "content", "message")
+
+
+def _pick_text(record, field):
+    if not isinstance(record, dict):
+        # 字符串直接用；数字、数组等不是对象的 JSON 值按原样转成文本
+        return record if isinstance(record, str) else json.dumps(record, ensure_ascii=False)
+    if field:
+        return record.get(field)
+    for name in INPUT_FIELDS:
+        if record.get(name):
+            return record[name]
+    return None
+
+
+def read_inputs(path, field=None):
+    """打开输入文件并返回逐条产出 (id, 文本, 原始记录) 的生成器；记录里没有 id 字段时用行号
+
+    文件在这里 (调用方所在的线程) 就打开，路径不对时立即抛出 OSError，而不是在读取线程里才出错。
+    """
+    if path.lower().endswith(".csv"):
+        return _read_csv(open(path, 'r', encoding='utf-8-sig', newline=''), field)
+    return _read_jsonl(open(path, 'r', encoding='utf-8'), field)
+
+
+def _read_csv(f, field):
+    with f:
+        for n, row in enumerate(csv.DictReader(f), 1):
+            yield str(row.get("id") or n), _pick_text(row, field), row
+
+
+def _read_jsonl(f, field):
+    with f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line  # 不是 JSON 的行按纯文本处理
+            item_id = record.get("id") if isinstance(record, dict) else None
+            yield str(item_id if item_id is not None else n), _pick_text(record, field), record
+
+
+def load_checkpoint(path):
+    """读取已有的输出文件，返回已成功的 id；被杀掉时写了一半的最后一行会被截掉"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in rec:
+            done.add(str(rec.get("id")))
+    return done
+
+
+class RateLimiter:
+    """客户端限速 (令牌桶)：平均每秒 rate 个请求，最多攒 burst 个"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 1)
+
+
+class BatchRunner:
+    """有界并发的工作线程池：输入按需读取 (队列有上限)，结果按输入顺序或完成顺序写入 JSONL"""
+
+    def __init__(self, engine, system_content, output, workers=DEFAULT_WORKERS, rate=0, ordered=True,
+                 model=None, template=None):
+        self.engine = engine
+        self.system_content = system_content
+        self.output = output
+        self.workers = max(int(workers), 1)
+        self.limiter = RateLimiter(rate, burst=max(1, rate))
+        self.ordered = ordered
+        self.model = model
+        self.template = template
+        self._stop = threading.Event()
+
+    def _messages(self, text, record):
+        content = self.template.format_map(record) if self.template and isinstance(record, dict) else text
+        messages = [{"role": "user", "content": content}]
+        if self.system_content:
+            messages.insert(0, {"role": "system", "content": self.system_content})
+        return messages
+
+    def _process(self, item_id, text, record):
+        result = {"id": item_id, "input": text}
+        start = time.perf_counter()
+        try:
+            if not text:
+                raise ValueError("输入为空")
+            self.limiter.acquire()
+            result["output"] = "".join(self.engine.stream_text(self._messages(text, record),
+                                                               model_override=self.model, priority=BATCH))
+        except Exception as e:
+            result["error"] = str(e)
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    def _worker(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            seq, item_id, text, record = task
+            results.put((seq, self._process(item_id, text, record)))
+
+    def _feed(self, items, done, tasks, counts):
+        try:
+            for item_id, text, record in items:
+                if self._stop.is_set():
+                    break
+                if item_id in done:
+                    counts["skipped"] += 1
+                    continue
+                tasks.put((counts["queued"], item_id, text, record))
+                counts["queued"] += 1
+        except Exception as e:
+            # 读到一半出错 (编码错误等)：已派发的条目照常完成，剩下的下次重跑
+            counts["error"] = str(e)
+            print(f"❌ 读取输入失败: {e}", file=sys.stderr, flush=True)
+        finally:
+            # 无论如何都要通知主线程和工作线程，否则 run() 会一直等下去
+            counts["fed"] = True
+            for _ in range(self.workers):
+                tasks.put(None)
+
+    def run(self, items):
+        """处理全部输入，返回统计信息；Ctrl+C 时停止派发新任务并写完手上的结果"""
+        done = load_checkpoint(self.output)
+        tasks = queue.Queue(maxsize=self.workers * 2)
+        results = queue.Queue()
+        counts = {"queued": 0, "skipped": 0, "fed": False, "error": None}
+        stats = {"ok": 0, "errors": 0, "chars": 0, "latencies": []}
+        feeder = threading.Thread(target=self._feed, args=(items, done, tasks, counts), daemon=True)
+        feeder.start()
+        threads = [threading.Thread(target=self._worker, args=(tasks, results), daemon=True)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+
+        pending, next_seq, written, dropped = {}, 0, 0, 0
+        ordered = self.ordered
+        start = last_report = time.perf_counter()
+        interrupted = False
+        with open(self.output, 'a', encoding='utf-8') as out:
+            while not (counts["fed"] and written + dropped == counts["queued"]):
+                try:
+                    seq, rec = results.get(timeout=0.5)
+                except queue.Empty:
+                    seq = None
+                except KeyboardInterrupt:
+                    if interrupted:
+                        break  # 再按一次：不等手上的请求，直接退出 (这些条目下次重跑)
+                    # 不再派发新任务；已经在跑的请求结束后照常写入，顺序被打断后改为完成一条写一条
+                    interrupted = True
+                    self._stop.set()
+                    dropped += self._drain(tasks)
+                    ordered = False
+                    seq, rec = -1, None
+                if seq is not None:
+                    if rec is not None:
+                        pending[seq] = rec
+                    # 按输入顺序写入时，等前面的结果都到了再写；否则完成一条写一条
+                    ready = []
+                    if ordered:
+                        while next_seq in pending:
+                            ready.append(pending.pop(next_seq))
+                            next_seq += 1
+                    else:
+                        ready.extend(pending.pop(k) for k in sorted(pending))
+                    for r in ready:
+                        out.write(json.dumps(r, ensure_ascii=False) + "\n")
+                        written += 1
+                        if "error" in r:
+                            stats["errors"] += 1
+                        else:
+                            stats["ok"] += 1
+                            stats["chars"] += len(r.get("output", ""))
+                            stats["latencies"].append(r["latency_ms"] / 1000)
+                    out.flush()
+                    if written % FSYNC_EVERY == 0:
+                        os.fsync(out.fileno())
+                now = time.perf_counter()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    self._report(written, counts, stats, now - start)
+            out.flush()
+            os.fsync(out.fileno())
+
+        elapsed = time.perf_counter() - start
+        summary = {
+            "processed": written,
+            "ok": stats["ok"],
+            "errors": stats["errors"],
+            "skipped": counts["skipped"],
+            "elapsed_s": round(elapsed, 2),
+            "items_per_sec": round(written / elapsed, 2) if elapsed > 0 else None,
+            "chars_per_sec": round(stats["chars"] / elapsed, 1) if elapsed > 0 else None,
+            "latency_p50_ms": _percentile(stats["latencies"], 0.5),
+            "latency_p95_ms": _percentile(stats["latencies"], 0.95),
+            "interrupted": interrupted,
+            "input_error": counts["error"],
+        }
+        return summary
+
+    @staticmethod
+    def _drain(tasks):
+        """丢弃还没开始的任务，返回丢弃的条数"""
+        n = 0
+        while True:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                return n
+            if task is not None:
+                n += 1
+
+    def _report(self, written, counts, stats, elapsed):
+        total = "?" if not counts["fed"] else counts["queued"]
+        rate = written / elapsed if elapsed > 0 else 0
+        print(f"⏳ {written}/{total} 完成 (失败 {stats['errors']}, 跳过 {counts['skipped']}) "
+              f"| {rate:.2f} 条/秒", file=sys.stderr, flush=True)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="用一个角色批量处理 JSONL / CSV 输入")
+    parser.add_argument("input", help="输入文件 (.jsonl 每行一个 JSON 对象或字符串；.csv 需要表头)")
+    parser.add_argument("--prompt", help="prompts/ 下的角色文件，如 翻译官.md")
+    parser.add_argument("--output", help="结果 JSONL (默认 <输入文件名>.results.jsonl)，同时作为断点续跑的检查点")
+    parser.add_argument("--field", help=f"输入文本所在的字段 (默认依次尝试 {', '.join(INPUT_FIELDS)})")
+    parser.add_argument("--template", help="用输入记录的字段拼出用户消息，如 \"请翻译成英文：{text}\"")
+    parser.add_argument("--model", help="覆盖配置里的模型")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="并发请求数")
+    parser.add_argument("--rate", type=float, default=0, help="每秒最多发起多少个请求，0 为不限")
+    parser.add_argument("--unordered", action="store_true", help="按完成顺序写结果 (默认按输入顺序)")
+    args = parser.parse_args(argv)
+    if not args.output:
+        args.output = os.path.splitext(args.input)[0] + ".results.jsonl"
+    return args
+
+
+def run_batch(engine, args, system_content=None):
+    """main.py batch 的入口：处理输入并打印吞吐统计"""
+    runner = BatchRunner(engine, system_content, args.output, workers=args.workers, rate=args.rate,
+                         ordered=not args.unordered, model=args.model, template=args.template)
+    try:
+        items = read_inputs(args.input, args.field)
+    except OSError as e:
+        print(f"❌ 无法读取输入文件 {args.input}: {e}")
+        return None
+    print(f"🚀 批量处理 {args.input} -> {args.output} (并发 {runner.workers}"
+          + (f", 限速 {args.rate}/秒" if args.rate else "") + ")")
+    summary = runner.run(items)
+    if summary["interrupted"]:
+        print("💾 已中断，进度已保存；重新运行同一命令即可继续。")
+    print(f"✅ 完成 {summary['ok']} 条，失败 {summary['errors']} 条，跳过 (已完成) {summary['skipped']} 条，"
+          f"耗时 {summary['elapsed_s']} 秒，{summary['items_per_sec']} 条/秒")
+    print(json.dumps(summary, ensure_ascii=False))
+    return summary
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+# 内存中最多缓存多少个空闲对话，超出后按最近最少使用淘汰
+MAX_CACHED_CHATS = 256
+
+
+class ChatState:
+    """单个对话在内存中的状态，每个对话一把锁"""
+
+    def __init__(self, chat_id, data, persisted=True):
+        self.chat_id = chat_id
+        self.data = data
+        # 新建对话在用户发出第一条消息前不落盘，这类对话不能被淘汰
+        self.persisted = persisted
+        self.lock = threading.Lock()
+
+
+class ChatSessionStore:
+    """按 chat_id 管理对话状态，取代 app.py 里的全局 CURRENT_CHAT_DATA
+
+    不同对话互不干扰，可以同时流式生成；同一个对话的修改通过 ChatState.lock 串行。
+    """
+
+    def __init__(self, history_mgr, max_cached=MAX_CACHED_CHATS):
+        self.history_mgr = history_mgr
+        self.max_cached = max_cached
+        self._chats = OrderedDict()
+        self._guard = threading.Lock()
+
+    def create(self, chat_id, data):
+        """登记一个新建 (尚未存盘) 的对话"""
+        state = ChatState(chat_id, data, persisted=False)
+        with self._guard:
+            self._chats[chat_id] = state
+            self._evict()
+        return state
+
+    def get(self, chat_id):
+        """取得对话状态，内存中没有时从磁盘加载"""
+        if not chat_id:
+            return None
+        with self._guard:
+            state = self._chats.get(chat_id)
+            if state is not None:
+                self._chats.move_to_end(chat_id)
+                return state
+        # 读盘放在全局锁外，加载大对话时不阻塞其他对话
+        data = self.history_mgr.load_chat(chat_id)
+        if data is None:
+            return None
+        with self._guard:
+            # 并发加载同一对话时，以先放入的那份为准
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = ChatState(chat_id, data)
+                self._evict()
+            return state
+
+    def peek(self, chat_id):
+        """只查内存，不触发读盘"""
+        with self._guard:
+            return self._chats.get(chat_id)
+
+    def save(self, state):
+        """在持有 state.lock 时调用，把对话写回磁盘"""
+        self.history_mgr.save_chat(state.chat_id, state.data)
+        state.persisted = True
+
+    def drop(self, chat_id):
+        with self._guard:
+            self._chats.pop(chat_id, None)
+
+    def _evict(self):
+        if len(self._chats) <= self.max_cached:
+            return
+        for chat_id in list(self._chats):
+            if len(self._chats) <= self.max_cached:
+                break
+            state = self._chats[chat_id]
+            if not state.persisted:
+                continue
+            # 正在被使用 (例如正在生成回复) 的对话不淘汰
+            if not state.lock.acquire(blocking=False):
+                continue
+            try:
+                del self._chats[chat_id]
+            finally:
+                state.lock.release()
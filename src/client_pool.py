@@ -0,0 +1,208 @@
+import time
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+
+# 连接池默认参数 (可在 .env 里用 MY_HTTP_* 覆盖)
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+# 模型列表缓存时间 (秒)
+DEFAULT_MODELS_TTL = 600.0
+# 最多保留多少个不同 base_url 的连接池 / 多少组 (base_url, api_key) 客户端
+MAX_POOLS = 8
+MAX_CLIENTS = 32
+
+
+class ConnectionStats:
+    """统计请求数与新建连接数：响应所在的底层连接之前出现过，就算一次复用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = weakref.WeakSet()
+        self.requests = 0
+        self.reused = 0
+        self.new_connections = 0
+
+    def record(self, response):
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self.requests += 1
+            if stream is None:
+                return
+            try:
+                if stream in self._seen:
+                    self.reused += 1
+                else:
+                    self._seen.add(stream)
+                    self.new_connections += 1
+            except TypeError:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            stats = {"requests": self.requests, "reused": self.reused, "new_connections": self.new_connections}
+        stats["reuse_rate"] = round(stats["reused"] / stats["requests"], 4) if stats["requests"] else 0.0
+        return stats
+
+
+class ClientRegistry:
+    """上游客户端注册表：按 base_url 共享 HTTP 连接池，按 (base_url, api_key) 复用 OpenAI 客户端
+
+    重建引擎、获取模型列表都从这里取客户端，保留已建立的 keep-alive 连接和 TLS 会话。
+    模型列表按 (base_url, api_key) 缓存 models_ttl 秒。
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_keepalive=DEFAULT_MAX_KEEPALIVE,
+                 keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY, models_ttl=DEFAULT_MODELS_TTL):
+        self.limits = None
+        self.models_ttl = float(models_ttl)
+        self.stats = ConnectionStats()
+        self._lock = threading.Lock()
+        self._pools = OrderedDict()         # base_url -> httpx.Client
+        self._clients = OrderedDict()       # (base_url, api_key) -> OpenAI
+        self._async_pools = OrderedDict()   # base_url -> (事件循环, httpx.AsyncClient)
+        self._async_clients = OrderedDict() # (base_url, api_key) -> AsyncOpenAI
+        self._models = {}                   # (base_url, api_key) -> (获取时间, 模型列表)
+        self.model_stats = {"hits": 0, "misses": 0}
+        self.configure(max_connections, max_keepalive, keepalive_expiry, models_ttl)
+
+    def configure(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_keepalive=DEFAULT_MAX_KEEPALIVE,
+                  keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY, models_ttl=DEFAULT_MODELS_TTL):
+        """更新连接池参数；参数变化时之后新建的连接池才生效，已有的同步连接池会被关闭重建"""
+        # 只记下参数，openai SDK 到第一次创建连接池时才导入
+        limits = (int(max_connections), int(max_keepalive), float(keepalive_expiry))
+        self.models_ttl = float(models_ttl)
+        with self._lock:
+            if limits == self.limits:
+                return
+            self.limits = limits
+            old = list(self._pools.values())
+            self._pools.clear()
+            self._clients.clear()
+        for pool in old:
+            pool.close()
+
+    @staticmethod
+    def _key(api_key, base_url):
+        return ((base_url or "").rstrip("/"), api_key or "")
+
+    def _httpx_limits(self):
+        # 用 openai SDK 自己依赖的 HTTP 库 (旧版为 httpx，新版为 httpx2) 的 Limits 类型，不直接导入 httpx
+        from openai._constants import DEFAULT_CONNECTION_LIMITS
+        max_connections, max_keepalive, keepalive_expiry = self.limits
+        return type(DEFAULT_CONNECTION_LIMITS)(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                               keepalive_expiry=keepalive_expiry)
+
+    # ---------- 同步客户端 ----------
+    def _pool(self, base_url):
+        pool = self._pools.get(base_url)
+        if pool is not None:
+            self._pools.move_to_end(base_url)
+            return pool, None
+        from openai import DefaultHttpxClient
+        pool = DefaultHttpxClient(limits=self._httpx_limits(), event_hooks={"response": [self.stats.record]})
+        self._pools[base_url] = pool
+        evicted = None
+        if len(self._pools) > MAX_POOLS:
+            old_url, evicted = self._pools.popitem(last=False)
+            for key in [k for k in self._clients if k[0] == old_url]:
+                del self._clients[key]
+        return pool, evicted
+
+    def get(self, api_key, base_url, max_retries=None):
+        """max_retries 不为 None 时返回关闭 / 调整了 SDK 自带重试的客户端 (由 UpstreamRouter 自己重试)"""
+        from openai import OpenAI
+        key = self._key(api_key, base_url) + (max_retries,)
+        evicted = None
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            pool, evicted = self._pool(key[0])
+            options = {} if max_retries is None else {"max_retries": max_retries}
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=pool, **options)
+            self._clients[key] = client
+            if len(self._clients) > MAX_CLIENTS:
+                self._clients.popitem(last=False)
+        if evicted is not None:
+            evicted.close()
+        return client
+
+    # ---------- 异步客户端 ----------
+    def get_async(self, api_key, base_url, max_retries=None):
+        """异步客户端的连接池绑定在当前事件循环上，换了事件循环会新建"""
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        key = self._key(api_key, base_url) + (max_retries,)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._async_pools.get(key[0])
+            if entry is not None and entry[0] is not loop:
+                entry = None
+                for k in [k for k in self._async_clients if k[0] == key[0]]:
+                    del self._async_clients[k]
+            client = self._async_clients.get(key)
+            if client is not None:
+                self._async_clients.move_to_end(key)
+                return client
+            if entry is None:
+                entry = (loop, DefaultAsyncHttpxClient(limits=self._httpx_limits(),
+                                                       event_hooks={"response": [self._record_async]}))
+                self._async_pools[key[0]] = entry
+            self._async_pools.move_to_end(key[0])
+            options = {} if max_retries is None else {"max_retries": max_retries}
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=entry[1], **options)
+            self._async_clients[key] = client
+            if len(self._async_clients) > MAX_CLIENTS:
+                self._async_clients.popitem(last=False)
+        return client
+
+    async def _record_async(self, response):
+        self.stats.record(response)
+
+    async def aclose(self):
+        """关闭当前事件循环上的异步连接池 (ASGI lifespan 关闭时调用)"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pools = [(url, p) for url, (l, p) in self._async_pools.items() if l is loop]
+            for url, _ in pools:
+                del self._async_pools[url]
+                for k in [k for k in self._async_clients if k[0] == url]:
+                    del self._async_clients[k]
+        for _, pool in pools:
+            await pool.aclose()
+
+    # ---------- 模型列表 ----------
+    def list_models(self, api_key, base_url, refresh=False):
+        """获取可用模型列表 (已排序)，ttl 内直接返回缓存；refresh=True 时强制重新获取"""
+        key = self._key(api_key, base_url)
+        now = time.time()
+        cached = self._models.get(key)
+        if not refresh and cached and now - cached[0] < self.models_ttl:
+            self.model_stats["hits"] += 1
+            return list(cached[1])
+        self.model_stats["misses"] += 1
+        models_response = self.get(api_key, base_url).models.list()
+        model_list = sorted(m.id for m in models_response.data)
+        self._models[key] = (now, model_list)
+        return list(model_list)
+
+    def snapshot(self):
+        """连接复用率、模型列表缓存命中等统计"""
+        stats = self.stats.snapshot()
+        with self._lock:
+            stats["pools"] = len(self._pools)
+            stats["clients"] = len(self._clients)
+            stats["async_pools"] = len(self._async_pools)
+        stats["models_cache"] = dict(self.model_stats)
+        return stats
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+            self._clients.clear()
+        for pool in pools:
+            pool.close()
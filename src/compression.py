@@ -0,0 +1,168 @@
+"""对话历史的压缩格式：按帧压缩的快照 + 用已有对话训练的 zlib 预置字典 (zdict)
+
+快照文件布局：[帧 0][帧 1]...[目录][目录长度 4 字节 + MAGIC]
+每帧是若干条消息 (JSON Lines) 用同一个预置字典独立压缩的结果；目录记录元数据、字典 id
+和每帧的 [首条消息序号, 偏移, 长度]，分页读取时只解压需要的帧。
+"""
+import os
+import json
+import zlib
+import bisect
+import struct
+from collections import Counter
+
+# 每帧最多多少条消息 / 多少字符 (压缩前)
+FRAME_MESSAGES = 32
+FRAME_CHARS = 64 * 1024
+LEVEL = 6
+# zlib 的窗口只有 32KB，更长的字典用不上
+DICT_SIZE = 32 * 1024
+# 训练字典最多读取的样本字节数；样本少于 MIN_TRAIN_BYTES 时只用内置的种子字典
+TRAIN_SAMPLE_BYTES = 1024 * 1024
+MIN_TRAIN_BYTES = 64 * 1024
+# 训练时统计的子串长度 (字节，约 4 个汉字) 与最少出现次数
+NGRAM = 12
+MIN_COUNT = 4
+
+MAGIC = b"CHZ1"
+_TRAILER = struct.Struct(">I4s")
+_POINTER_FILE = "current"
+
+# 每条消息都有的 JSON 骨架和常见的 Markdown 片段；放在字典末尾 (距离最近，匹配最省)
+SEED = (
+    "\n\n```\n", "```python\n", "```bash\n", "\n- ", "\n1. ", "\n## ", "**", "。\n\n", "：\n\n",
+    '"}\n{"role":"user","content":"', '"}\n{"role":"assistant","content":"',
+)
+
+
+def train_dictionary(samples, size=DICT_SIZE):
+    """从样本 (bytes 列表) 里挑出现次数最多的子串拼成预置字典，出现越多的越靠后"""
+    counts = Counter()
+    for sample in samples:
+        counts.update(sample[i:i + NGRAM] for i in range(len(sample) - NGRAM + 1))
+    seed = "".join(SEED).encode("utf-8")
+    picked, total = bytearray(), len(seed)
+    pieces = []
+    for gram, n in counts.most_common():
+        if n < MIN_COUNT or total + len(gram) > size:
+            break
+        # 和已选的子串重叠时只补上多出来的部分
+        if gram in picked:
+            continue
+        if picked.endswith(gram[:-1]):
+            piece = gram[-1:]
+        else:
+            piece = gram
+        picked.extend(piece)
+        pieces.append(piece)
+        total += len(piece)
+    return b"".join(reversed(_merge(pieces))) + seed
+
+
+def _merge(pieces):
+    # 把补出来的单字节接回它前面的子串，保证反转顺序时子串内部不被打乱
+    merged = []
+    for piece in pieces:
+        if len(piece) == 1 and merged:
+            merged[-1] += piece
+        else:
+            merged.append(piece)
+    return merged
+
+
+class DictionaryStore:
+    """预置字典按内容的 crc32 命名保存在同一个目录里；压缩文件记录字典 id，换了新字典后旧文件仍能读取"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._cache = {}
+        self._current = None
+
+    def _path(self, dict_id):
+        return os.path.join(self.directory, dict_id + ".zdict")
+
+    def trained(self):
+        return os.path.exists(os.path.join(self.directory, _POINTER_FILE))
+
+    def current(self):
+        """返回 (字典 id, 字典)：最近训练的字典，还没训练过时用内置种子"""
+        if self._current is None:
+            try:
+                with open(os.path.join(self.directory, _POINTER_FILE), 'r', encoding='utf-8') as f:
+                    dict_id = f.read().strip()
+                self._current = dict_id, self.get(dict_id)
+            except OSError:
+                self._current = self.add("".join(SEED).encode("utf-8"), make_current=False)
+        return self._current
+
+    def get(self, dict_id):
+        data = self._cache.get(dict_id)
+        if data is None:
+            with open(self._path(dict_id), 'rb') as f:
+                data = self._cache[dict_id] = f.read()
+        return data
+
+    def add(self, data, make_current=True):
+        """保存一个字典并返回 (id, 字典)；make_current 时之后写入的快照都使用它"""
+        os.makedirs(self.directory, exist_ok=True)
+        dict_id = "%08x" % zlib.crc32(data)
+        path = self._path(dict_id)
+        if not os.path.exists(path):
+            with open(path + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        self._cache[dict_id] = data
+        if make_current:
+            with open(os.path.join(self.directory, _POINTER_FILE), 'w', encoding='utf-8') as f:
+                f.write(dict_id)
+            self._current = dict_id, data
+        return dict_id, data
+
+
+def encode_snapshot(meta, lines, dict_id, zdict, level=LEVEL):
+    """把元数据和消息行 (每行一条 JSON，以换行结尾) 编码成压缩快照"""
+    body = bytearray()
+    frames = []
+    first, chunk, chars = 0, [], 0
+    for i, line in enumerate(lines):
+        chunk.append(line)
+        chars += len(line)
+        if len(chunk) >= FRAME_MESSAGES or chars >= FRAME_CHARS or i == len(lines) - 1:
+            comp = zlib.compressobj(level, zdict=zdict)
+            data = comp.compress("".join(chunk).encode("utf-8")) + comp.flush()
+            frames.append([first, len(body), len(data)])
+            body.extend(data)
+            first, chunk, chars = i + 1, [], 0
+    footer = json.dumps({"meta": meta, "dict": dict_id, "frames": frames}, ensure_ascii=False)
+    footer = zlib.compress(footer.encode("utf-8"))
+    body.extend(footer)
+    body.extend(_TRAILER.pack(len(footer), MAGIC))
+    return bytes(body)
+
+
+def read_footer(f):
+    """读取压缩快照末尾的目录：{"meta", "dict", "frames"}"""
+    f.seek(-_TRAILER.size, os.SEEK_END)
+    length, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError("不是压缩快照文件")
+    f.seek(-_TRAILER.size - length, os.SEEK_END)
+    return json.loads(zlib.decompress(f.read(length)))
+
+
+def read_messages(f, footer, zdict, start=0, end=None):
+    """只解压覆盖序号 [start, end) 的帧，返回这些消息"""
+    frames = footer["frames"]
+    end = footer["meta"]["count"] if end is None else end
+    if start >= end:
+        return []
+    i = bisect.bisect_right([fr[0] for fr in frames], start) - 1
+    base = frames[i][0]
+    lines = []
+    for first, offset, length in frames[i:]:
+        if first >= end:
+            break
+        f.seek(offset)
+        d = zlib.decompressobj(zdict=zdict)
+        lines.extend((d.decompress(f.read(length)) + d.flush()).splitlines())
+    return [json.loads(line) for line in lines[start - base:end - base]]
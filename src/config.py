@@ -1,23 +1,162 @@
 import os
-from dotenv import load_dotenv
+import time
+import threading
+from dataclasses import dataclass, fields
+from dotenv import dotenv_values
+
+ENV_FILE = ".env"
+# 两次检查 .env 是否被修改之间的最短间隔 (秒)
+CHECK_INTERVAL = 1.0
+
+
+@dataclass(frozen=True)
+class Config:
+    """一份不可变的配置快照；兼容旧代码的 cfg["key"] 写法"""
+    api_key: str = ""
+    base_url: str = ""
+    model: str = "gpt-3.5-turbo"
+    temperature: float = 0.7
+    max_tokens: int = 2000
+    stream: bool = True
+    # 上下文窗口：策略 none / sliding / first_last / summary，预算为 0 时按模型上下文长度自动计算
+    context_policy: str = "sliding"
+    context_budget: int = 0
+    # 回复缓存 (默认关闭)：内存条目数、磁盘上限 (MB)、过期时间 (秒)
+    cache: bool = False
+    cache_memory_items: int = 256
+    cache_max_mb: float = 64.0
+    cache_ttl: float = 604800.0
+    # 上游连接池：最大连接数、保持空闲连接数、空闲连接保留时间 (秒)；模型列表缓存时间 (秒)
+    http_max_connections: int = 100
+    http_keepalive: int = 20
+    http_keepalive_expiry: float = 60.0
+    models_ttl: float = 600.0
+    # 流式输出：上游增量合并成一帧的时间间隔 (毫秒，0 表示不合并) 和字节阈值
+    sse_flush_ms: float = 50.0
+    sse_flush_bytes: int = 1024
+    # 指标：off / basic (默认，只有计数器和直方图) / trace (额外记录每个请求的 span)；span 导出文件
+    metrics: str = "basic"
+    trace_file: str = "traces.jsonl"
+    # 多上游路由：额外上游列表文件、可重试错误的重试次数与退避基数 (毫秒)、首字超时对冲及其最短等待 (毫秒)
+    endpoints_file: str = "endpoints.json"
+    retry_max: int = 2
+    retry_backoff_ms: float = 250.0
+    hedge: bool = False
+    hedge_min_ms: float = 200.0
+    # 历史记录快照压缩 (zlib + 用已有对话训练的预置字典)
+    history_compress: bool = True
+    # 长期记忆 (默认关闭，需要 numpy)：每轮从其他对话取回的片段数和 token 预算
+    memory: bool = False
+    memory_top_k: int = 4
+    memory_budget: int = 600
+    # 上游准入控制 (默认不限，按需开启)：每个上游的最大并发、每分钟请求数 / token 数 (0 为不限)，按模型的限制 "模型=并发:rpm:tpm,..."
+    max_concurrency: int = 0
+    rate_rpm: float = 0.0
+    rate_tpm: float = 0.0
+    model_limits: str = ""
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+def parse_config(values):
+    """从 MY_* 键值对构造 Config"""
+    def get(name, default):
+        value = values.get(name)
+        return default if value is None else value
+
+    return Config(
+        api_key=get("MY_API_KEY", ""),
+        base_url=get("MY_API_URL", ""),
+        model=get("MY_MODEL_NAME", "gpt-3.5-turbo"),
+        temperature=float(get("MY_TEMPERATURE", "0.7")),
+        max_tokens=int(get("MY_MAX_TOKENS", "2000")),
+        stream=str(get("MY_STREAM", "True")).lower() == 'true',
+        context_policy=get("MY_CONTEXT_POLICY", "sliding").strip().lower(),
+        context_budget=int(get("MY_CONTEXT_BUDGET", "0") or 0),
+        cache=str(get("MY_CACHE", "False")).lower() == 'true',
+        cache_memory_items=int(get("MY_CACHE_MEMORY_ITEMS", "256")),
+        cache_max_mb=float(get("MY_CACHE_MAX_MB", "64")),
+        cache_ttl=float(get("MY_CACHE_TTL", "604800")),
+        http_max_connections=int(get("MY_HTTP_MAX_CONNECTIONS", "100")),
+        http_keepalive=int(get("MY_HTTP_KEEPALIVE", "20")),
+        http_keepalive_expiry=float(get("MY_HTTP_KEEPALIVE_EXPIRY", "60")),
+        models_ttl=float(get("MY_MODELS_TTL", "600")),
+        sse_flush_ms=float(get("MY_SSE_FLUSH_MS", "50")),
+        sse_flush_bytes=int(get("MY_SSE_FLUSH_BYTES", "1024")),
+        metrics=get("MY_METRICS", "basic").strip().lower(),
+        trace_file=get("MY_TRACE_FILE", "traces.jsonl"),
+        endpoints_file=get("MY_ENDPOINTS_FILE", "endpoints.json"),
+        retry_max=int(get("MY_RETRY_MAX", "2")),
+        retry_backoff_ms=float(get("MY_RETRY_BACKOFF_MS", "250")),
+        hedge=str(get("MY_HEDGE", "False")).lower() == 'true',
+        hedge_min_ms=float(get("MY_HEDGE_MIN_MS", "200")),
+        history_compress=str(get("MY_HISTORY_COMPRESS", "True")).lower() == 'true',
+        memory=str(get("MY_MEMORY", "False")).lower() == 'true',
+        memory_top_k=int(get("MY_MEMORY_TOP_K", "4")),
+        memory_budget=int(get("MY_MEMORY_BUDGET", "600")),
+        max_concurrency=int(get("MY_MAX_CONCURRENCY", "0")),
+        rate_rpm=float(get("MY_RATE_RPM", "0")),
+        rate_tpm=float(get("MY_RATE_TPM", "0")),
+        model_limits=get("MY_MODEL_LIMITS", ""),
+    )
+
+
+class ConfigService:
+    """配置只在 .env 变化或被显式 invalidate 时重新解析，其余时候直接返回同一份快照
+
+    .env 中的值优先于同名环境变量 (与之前 load_dotenv(override=True) 的行为一致)，但不再修改 os.environ。
+    """
+
+    def __init__(self, env_file=ENV_FILE, check_interval=CHECK_INTERVAL):
+        self.env_file = env_file
+        self.check_interval = float(check_interval)
+        self._snapshot = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.env_file)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def get(self):
+        """返回当前配置快照 (Config)"""
+        now = time.time()
+        snapshot = self._snapshot
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        with self._lock:
+            signature = self._file_signature()
+            if self._snapshot is None or signature != self._signature:
+                values = {k: v for k, v in os.environ.items() if k.startswith("MY_")}
+                if signature is not None:
+                    values.update({k: v for k, v in dotenv_values(self.env_file).items() if v is not None})
+                try:
+                    self._snapshot = parse_config(values)
+                except ValueError as e:
+                    print(f"❌ 配置解析失败，继续使用旧配置: {e}")
+                    if self._snapshot is None:
+                        self._snapshot = Config()
+                self._signature = signature
+            self._checked_at = now
+            return self._snapshot
+
+    def invalidate(self):
+        """下次 get() 时重新读取 .env (/api/save_config 写入后调用)"""
+        with self._lock:
+            self._signature = False
+            self._checked_at = 0.0
+
+
+config_service = ConfigService()
+
 
 def load_config():
-    load_dotenv(override=True)
-
-    api_key = os.getenv("MY_API_KEY", "")
-    base_url = os.getenv("MY_API_URL", "")
-    model_name = os.getenv("MY_MODEL_NAME", "gpt-3.5-turbo")
-    
-    # 新增参数，带默认值
-    temperature = os.getenv("MY_TEMPERATURE", "0.7")
-    max_tokens = os.getenv("MY_MAX_TOKENS", "2000")
-    stream = os.getenv("MY_STREAM", "True")
-
-    return {
-        "api_key": api_key,
-        "base_url": base_url,
-        "model": model_name,
-        "temperature": float(temperature),
-        "max_tokens": int(max_tokens),
-        "stream": stream.lower() == 'true'
-    }
\ No newline at end of file
+    return config_service.get()
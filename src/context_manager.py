@@ -0,0 +1,192 @@
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 各模型的上下文长度 (按模型名前缀匹配，越具体的写在越前面)
+MODEL_CONTEXT_LIMITS = [
+    ("gpt-4o", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4.1", 1000000),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-3.5-turbo", 16385),
+    ("o1", 128000),
+    ("o3", 200000),
+    ("deepseek", 64000),
+    ("claude", 200000),
+    ("qwen", 32768),
+    ("glm", 128000),
+    ("moonshot", 128000),
+]
+DEFAULT_CONTEXT_LIMIT = 16000
+
+POLICIES = ("none", "sliding", "first_last", "summary")
+# 每条消息的格式开销 (role、分隔符等) 和回复起始的固定开销
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+# 按消息内容缓存 token 数的条目数 (LRU)
+TOKEN_CACHE_SIZE = 4096
+
+SUMMARY_PROMPT = ("请把以下对话压缩成一段简洁的摘要，保留关键事实、用户偏好、已做出的决定和尚未解决的问题，"
+                  "不要添加对话中没有的信息。\n\n{previous}对话内容：\n{transcript}")
+SUMMARY_PREFIX = "以下是之前对话的摘要：\n"
+# 一次摘要最多送给模型多少字的对话原文
+SUMMARY_INPUT_CHARS = 12000
+MEMORY_PREFIX = "以下是过往对话中与当前问题可能相关的片段，仅在有帮助时参考：\n"
+
+_CJK_RE = re.compile(r'[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]')
+_encoding = None
+
+
+def count_tokens(text):
+    """估算文本的 token 数：装了 tiktoken 就精确计算，否则按 中日韩字符≈1、其他≈4 字符 1 个估算"""
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _content_tokens(content):
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+
+def message_tokens(message):
+    """单条消息的 token 数：按内容缓存 (不往消息上写字段，这些消息会被保存和返回给前端)"""
+    return _content_tokens(message.get("content") or "")
+
+
+def strip_message(message):
+    """去掉内部字段 (以 _ 开头)，只把上游认识的字段发出去"""
+    return {k: v for k, v in message.items() if not k.startswith("_")}
+
+
+def memory_message(snippets):
+    """长期记忆取回的片段合成一条 system 消息"""
+    lines = []
+    for s in snippets:
+        role = "用户" if s.get("role") == "user" else "AI"
+        title = f"[{s['title']}] " if s.get("title") else ""
+        lines.append(f"- {title}{role}：{s['text']}")
+    return {"role": "system", "content": MEMORY_PREFIX + "\n".join(lines)}
+
+
+def context_limit(model):
+    name = (model or "").lower()
+    for prefix, limit in MODEL_CONTEXT_LIMITS:
+        if name.startswith(prefix) or f"/{prefix}" in name:
+            return limit
+    return DEFAULT_CONTEXT_LIMIT
+
+
+class ContextManager:
+    """在发送前把对话历史裁剪到模型的上下文预算内
+
+    策略：
+    - none: 原样发送全部历史
+    - sliding: 保留 system + 尽可能多的最近消息
+    - first_last: 保留 system + 开头 keep_first 条 + 尽可能多的最近消息
+    - summary: 保留 system + 滚动摘要 + 尽可能多的最近消息；被挤出窗口的旧消息在回合结束后并入摘要
+    长期记忆取回的片段 (memory) 作为一条 system 消息跟在 system 后面，占用同一份预算。
+    始终保留 system 和最后一条消息；从后往前累加缓存好的 token 数，耗时只和保留的消息数有关。
+    """
+
+    def __init__(self, policy="sliding", budget=0, keep_first=2):
+        if policy not in POLICIES:
+            print(f"❌ 未知的上下文策略 {policy}，改用 sliding")
+            policy = "sliding"
+        self.policy = policy
+        self.budget = int(budget or 0)
+        self.keep_first = int(keep_first)
+
+    def budget_for(self, model, max_tokens):
+        """留给输入的 token 预算：手动配置优先，否则按模型上下文长度减去回复长度"""
+        if self.budget > 0:
+            return self.budget
+        return max(context_limit(model) - int(max_tokens), 1024)
+
+    def _window_start(self, messages, head, budget):
+        """从后往前放消息，返回窗口中第一条消息的下标 (不会越过 head)"""
+        used = 0
+        start = len(messages)
+        while start > head:
+            n = message_tokens(messages[start - 1])
+            if used + n > budget and start < len(messages):
+                break
+            used += n
+            start -= 1
+        return start
+
+    def _head(self, messages):
+        return 1 if messages and messages[0].get("role") == "system" else 0
+
+    def select(self, messages, model, max_tokens, summary=None, memory=None):
+        """返回实际发送给上游的消息列表 (已去掉内部字段)"""
+        head = self._head(messages)
+        prefix = list(messages[:head])
+        if memory:
+            prefix.append(memory_message(memory))
+        if self.policy == "none" or not messages:
+            return [strip_message(m) for m in prefix + messages[head:]]
+
+        budget = self.budget_for(model, max_tokens) - REPLY_OVERHEAD
+        budget -= sum(message_tokens(m) for m in prefix)
+
+        if self.policy == "first_last":
+            first = messages[head:head + self.keep_first]
+            first_cost = sum(message_tokens(m) for m in first)
+            # 开头几条本身就超预算时退化为滑动窗口
+            if first_cost < budget and len(messages) > head + len(first):
+                start = self._window_start(messages, head + len(first), budget - first_cost)
+                return [strip_message(m) for m in prefix + first + messages[start:]]
+        elif self.policy == "summary" and summary and summary.get("text"):
+            summary_msg = {"role": "system", "content": SUMMARY_PREFIX + summary["text"]}
+            budget -= message_tokens(summary_msg)
+            start = self._window_start(messages, max(head, min(summary.get("upto", head), len(messages) - 1)), budget)
+            return [strip_message(m) for m in prefix + [summary_msg] + messages[start:]]
+
+        start = self._window_start(messages, head, budget)
+        return [strip_message(m) for m in prefix + messages[start:]]
+
+    # ---------- 滚动摘要 ----------
+    def pending_summary(self, chat_data, model, max_tokens):
+        """summary 策略下，返回已被挤出窗口、尚未并入摘要的消息区间 (start, end)，没有则返回 None"""
+        if self.policy != "summary":
+            return None
+        messages = chat_data.get("messages", [])
+        summary = chat_data.get("summary") or {}
+        head = self._head(messages)
+        upto = max(summary.get("upto", head), head)
+        budget = self.budget_for(model, max_tokens) - REPLY_OVERHEAD
+        budget -= sum(message_tokens(m) for m in messages[:head])
+        if summary.get("text"):
+            budget -= message_tokens({"content": SUMMARY_PREFIX + summary["text"]})
+        # 为下一轮的提问预留空间：窗口按预算的 3/4 计算，避免每轮都触发摘要
+        start = self._window_start(messages, head, budget * 3 // 4)
+        if start <= upto:
+            return None
+        return upto, start
+
+    def summary_request(self, chat_data, span):
+        """组装生成摘要的请求消息"""
+        start, end = span
+        previous = (chat_data.get("summary") or {}).get("text")
+        lines = []
+        for m in chat_data["messages"][start:end]:
+            role = "用户" if m.get("role") == "user" else "AI"
+            lines.append(f"{role}：{m.get('content') or ''}")
+        transcript = "\n".join(lines)[-SUMMARY_INPUT_CHARS:]
+        prompt = SUMMARY_PROMPT.format(
+            previous=f"已有摘要：\n{previous}\n\n" if previous else "",
+            transcript=transcript
+        )
+        return [{"role": "user", "content": prompt}]
@@ -1,31 +1,132 @@
 import os
+import time
+import threading
 
 PROMPT_DIR = "prompts"
+# 两次检查磁盘之间的最短间隔 (秒)：间隔内直接使用内存中的结果
+CHECK_INTERVAL = 2.0
+GREETING_HEADER = "## Greeting:"
+
+
+def parse_prompt(filename, text):
+    """解析角色文件：第一行是 ## Greeting: 时作为开场白，其余为 system 内容"""
+    lines = text.splitlines(keepends=True)
+    if not lines: return None, None
+
+    greeting = f"✅ 已加载角色: {filename}"
+    content = text
+
+    # 解析第一行的 Greeting
+    if lines[0].strip().startswith(GREETING_HEADER):
+        greeting = lines[0].replace(GREETING_HEADER, "").strip()
+        content = "".join(lines[1:])
+
+    return content, greeting
+
+
+class PromptRegistry:
+    """角色文件注册表：每个 .md 只解析一次，开场白和正文常驻内存
+
+    目录的 mtime 变化 (增删文件) 或距上次检查超过 check_interval 时才重新扫描目录；
+    单个文件按 (mtime, size) 判断是否需要重新解析。
+    """
+
+    def __init__(self, prompt_dir=PROMPT_DIR, check_interval=CHECK_INTERVAL):
+        self.prompt_dir = prompt_dir
+        self.check_interval = float(check_interval)
+        self._entries = {}     # 文件名 -> [mtime_ns, size, content, greeting, 上次检查时间]
+        self._names = []
+        self._dir_mtime = None
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """按需重新扫描目录，返回文件名列表"""
+        if not os.path.exists(self.prompt_dir):
+            os.makedirs(self.prompt_dir)
+        now = time.time()
+        try:
+            dir_mtime = os.stat(self.prompt_dir).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime == self._dir_mtime and now - self._scanned_at < self.check_interval:
+            return self._names
+
+        names, seen = [], set()
+        with os.scandir(self.prompt_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.md'):
+                    continue
+                names.append(entry.name)
+                seen.add(entry.name)
+                try:
+                    self._load(entry.name, entry.stat(), now)
+                except Exception as e:
+                    print(f"❌ 读取文件失败: {e}")
+        with self._lock:
+            for name in [n for n in self._entries if n not in seen]:
+                del self._entries[name]
+            self._names = names
+            self._dir_mtime = dir_mtime
+            self._scanned_at = now
+        return names
+
+    def _load(self, filename, st, now):
+        """文件没变时只更新检查时间，变了才重新读取解析"""
+        cached = self._entries.get(filename)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            cached[4] = now
+            return cached
+        path = os.path.join(self.prompt_dir, filename)
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        content, greeting = parse_prompt(filename, text)
+        entry = [st.st_mtime_ns, st.st_size, content, greeting, now]
+        with self._lock:
+            self._entries[filename] = entry
+        return entry
+
+    def list(self):
+        """获取所有 .md 文件名"""
+        return list(self._scan())
+
+    def get(self, filename):
+        """返回 (content, greeting)，文件不存在或读取失败时返回 (None, None)"""
+        if not filename or os.path.basename(filename) != filename:
+            return None, None
+        now = time.time()
+        cached = self._entries.get(filename)
+        if cached and now - cached[4] < self.check_interval:
+            return cached[2], cached[3]
+        try:
+            st = os.stat(os.path.join(self.prompt_dir, filename))
+            entry = self._load(filename, st, now)
+            return entry[2], entry[3]
+        except Exception as e:
+            print(f"❌ 读取文件失败: {e}")
+            with self._lock:
+                self._entries.pop(filename, None)
+            return None, None
+
+    def save(self, filename, text):
+        """写入角色文件并立即更新注册表"""
+        path = os.path.join(self.prompt_dir, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        self._load(filename, os.stat(path), time.time())
+        with self._lock:
+            if filename not in self._names:
+                self._names = self._names + [filename]
+
+
+registry = PromptRegistry()
+
 
 def get_prompt_list():
     """获取所有 .md 文件名"""
-    if not os.path.exists(PROMPT_DIR):
-        os.makedirs(PROMPT_DIR)
-    return [f for f in os.listdir(PROMPT_DIR) if f.endswith('.md')]
+    return registry.list()
+
 
 def load_prompt_by_filename(filename):
-    """读取单个文件并解析"""
-    path = os.path.join(PROMPT_DIR, filename)
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            
-        if not lines: return None, None
-        
-        greeting = f"✅ 已加载角色: {filename}"
-        content = "".join(lines)
-        
-        # 解析第一行的 Greeting
-        if lines[0].strip().startswith("## Greeting:"):
-            greeting = lines[0].replace("## Greeting:", "").strip()
-            content = "".join(lines[1:])
-            
-        return content, greeting
-    except Exception as e:
-        print(f"❌ 读取文件失败: {e}")
-        return None, None
\ No newline at end of file
+    """读取单个文件并解析 (命中注册表时不访问磁盘)"""
+    return registry.get(filename)
@@ -0,0 +1,317 @@
+import re
+import time
+import uuid
+import bisect
+import asyncio
+import threading
+from collections import OrderedDict
+from src.sse import format_event
+
+# 每个生成最多缓存多少字符，超出后丢弃开头 (断点早于缓冲区的客户端会收到 reset 事件)
+MAX_BUFFER_CHARS = 200_000
+# 结束的生成保留多久 / 最多保留多少个，供断线重连和刷新页面后继续读取
+FINISHED_TTL = 120.0
+MAX_FINISHED = 64
+# 没有新内容时多久发一次注释行保活 (秒)
+KEEPALIVE_INTERVAL = 15.0
+# 断线后浏览器 EventSource 重连的等待时间 (毫秒)
+RECONNECT_MS = 1000
+# 对比模式的结果要等用户挑选，保留得更久 (秒)
+COMPARE_TTL = 1800.0
+# 客户端生成的 stream_id 只允许这些字符 (会原样写进 SSE 的 id 字段)
+_STREAM_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def valid_stream_id(value):
+    return value if value and _STREAM_ID_RE.match(value) else None
+
+
+def parse_event_id(value, stream_id):
+    """Last-Event-ID 形如 "<stream_id>:<字符偏移>"，属于同一个生成时返回偏移，否则返回 0"""
+    if not value:
+        return 0
+    sid, _, offset = value.rpartition(":")
+    if sid != stream_id:
+        return 0
+    try:
+        return max(int(offset), 0)
+    except ValueError:
+        return 0
+
+
+def parse_offsets(value, stream_id, n):
+    """对比模式的 Last-Event-ID 形如 "<stream_id>:<偏移1>.<偏移2>..."，返回各模型的偏移"""
+    sid, _, offsets = (value or "").rpartition(":")
+    try:
+        offsets = [max(int(x), 0) for x in offsets.split(".")]
+    except ValueError:
+        offsets = []
+    return offsets if sid == stream_id and len(offsets) == n else [0] * n
+
+
+class Generation:
+    """一次回复的生成过程：与 HTTP 连接解耦，合并后的文本帧写入有界缓冲区
+
+    事件 id 是文本的字符偏移，客户端带着 Last-Event-ID 重连时从断点继续；
+    多个连接可以同时读取同一个生成，上游只请求一次。
+    """
+
+    def __init__(self, stream_id, chat_id, user_input=None, cond=None):
+        self.id = stream_id
+        self.chat_id = chat_id
+        # 本轮的用户消息，以及它加入对话后的消息数 (生成开始后设置)，供生成期间加载对话时使用
+        self.user_input = user_input
+        self.message_count = None
+        self._parts = []
+        self._starts = []       # 每段文本的起始偏移，与 _parts 一一对应
+        self.base = 0           # 缓冲区里第一段之前已经丢弃的字符数
+        self.length = 0         # 已生成的总字符数
+        self.done = False
+        self.finished_at = None
+        # 上游准入队列里的位置 (从 1 开始)：排队期间由生成线程更新，放行后为 0，没有排过队为 None
+        self.queue = None
+        # 对比模式下同一轮的多个生成共用一个 Condition，读取方可以同时等待所有模型
+        self._cond = cond or threading.Condition()
+        self._wakers = []
+
+    def _notify(self):
+        self._cond.notify_all()
+        wakers, self._wakers = self._wakers, []
+        for wake in wakers:
+            wake()
+
+    def append(self, text):
+        if not text:
+            return
+        with self._cond:
+            self._starts.append(self.length)
+            self._parts.append(text)
+            self.length += len(text)
+            while self.length - self.base > MAX_BUFFER_CHARS and len(self._parts) > 1:
+                self._parts.pop(0)
+                self._starts.pop(0)
+                self.base = self._starts[0]
+            self._notify()
+
+    def set_queue(self, position):
+        """可以直接作为 AIEngine.stream_text 的 on_wait 回调"""
+        with self._cond:
+            if position != self.queue:
+                self.queue = position
+                self._notify()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def read(self, offset):
+        """返回 (offset 之后的文本, 新偏移, 是否已结束, 断点是否早于缓冲区)"""
+        with self._cond:
+            reset = offset < self.base
+            offset = min(max(offset, self.base), self.length)
+            if offset == self.length:
+                return "", offset, self.done, reset
+            i = bisect.bisect_right(self._starts, offset) - 1
+            text = self._parts[i][offset - self._starts[i]:] + "".join(self._parts[i + 1:])
+            return text, self.length, self.done, reset
+
+    def _changed(self, offset, queue):
+        return self.length > offset or self.done or self.queue != queue
+
+    def wait(self, offset, timeout, queue=None):
+        """阻塞到有 offset 之后的新内容、排队位置变化、生成结束或超时"""
+        with self._cond:
+            if not self._changed(offset, queue):
+                self._cond.wait(timeout)
+
+    async def await_change(self, offset, timeout, queue=None):
+        """wait 的异步版本：由写入方通过事件循环唤醒，不占用线程"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._cond:
+            if self._changed(offset, queue):
+                return
+            self._wakers.append(lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # ---------- SSE 输出 ----------
+    def _event_id(self, offset):
+        return f"{self.id}:{offset}"
+
+    def _frames(self, offset, queue):
+        """读取一次缓冲区，返回 (要发送的帧, 新偏移, 是否已结束, 已发送的排队位置)"""
+        position = self.queue
+        text, offset, done, reset = self.read(offset)
+        frames = []
+        if position != queue:
+            queue = position
+            frames.append(format_event({"position": position}, event="queue"))
+        if reset:
+            frames.append(format_event({}, event="reset"))
+        if text:
+            frames.append(format_event({'text': text}, event_id=self._event_id(offset)))
+        if done:
+            frames.append(format_event({}, event="done", event_id=self._event_id(offset)))
+        return frames, offset, done, queue
+
+    def _start_frame(self, offset):
+        return (f"retry: {RECONNECT_MS}\n"
+                + format_event({"stream_id": self.id, "chat_id": self.chat_id}, event="start",
+                               event_id=self._event_id(offset)))
+
+    def events(self, offset=0):
+        """从 offset 开始输出 SSE 帧 (同步生成器)，直到生成结束"""
+        yield self._start_frame(offset)
+        queue = None
+        while True:
+            frames, new_offset, done, queue = self._frames(offset, queue)
+            yield from frames
+            if done:
+                return
+            if new_offset == offset:
+                self.wait(offset, KEEPALIVE_INTERVAL, queue)
+                if not self._changed(offset, queue):
+                    yield ": keepalive\n\n"
+            offset = new_offset
+
+    async def aevents(self, offset=0):
+        """events 的异步版本"""
+        yield self._start_frame(offset)
+        queue = None
+        while True:
+            frames, new_offset, done, queue = self._frames(offset, queue)
+            for frame in frames:
+                yield frame
+            if done:
+                return
+            if new_offset == offset:
+                await self.await_change(offset, KEEPALIVE_INTERVAL, queue)
+                if not self._changed(offset, queue):
+                    yield ": keepalive\n\n"
+            offset = new_offset
+
+
+class Comparison:
+    """对比模式：同一轮用户消息同时发给多个模型，每个模型一个 Generation 缓冲，
+    在一个 SSE 连接里按模型标记交替输出；全部结束后由用户挑选写入历史的回答。
+
+    事件 id 是各模型的字符偏移，断线重连时每个模型从各自的断点继续。
+    """
+
+    def __init__(self, stream_id, chat_id, user_input=None, models=()):
+        self.id = stream_id
+        self.chat_id = chat_id
+        self.user_input = user_input
+        self.models = list(models)
+        self._cond = threading.Condition()
+        self.results = [Generation(stream_id, chat_id, user_input, cond=self._cond) for _ in self.models]
+        # 每个模型的完整回复和耗时统计 (由生成线程写入)
+        self.texts = [""] * len(self.models)
+        self.stats = [{"model": m} for m in self.models]
+        # 发起对比时对话的消息数：挑选回答时用来确认这期间对话没有继续
+        self.base_count = None
+        self.chosen = None
+
+    @property
+    def done(self):
+        return all(g.done for g in self.results)
+
+    @property
+    def finished_at(self):
+        return max((g.finished_at or 0) for g in self.results) if self.done else None
+
+    def _event_id(self, offsets):
+        return f"{self.id}:" + ".".join(str(o) for o in offsets)
+
+    def _changed(self, offsets, reported, queues):
+        return any(g.length > o or (g.done and not r) or g.queue != q
+                   for g, o, r, q in zip(self.results, offsets, reported, queues))
+
+    def events(self, offsets=None):
+        """从各模型的 offsets 开始输出 SSE 帧，直到所有模型结束"""
+        offsets = list(offsets or [0] * len(self.models))
+        reported = [False] * len(self.models)
+        queues = [None] * len(self.models)
+        yield (f"retry: {RECONNECT_MS}\n"
+               + format_event({"stream_id": self.id, "chat_id": self.chat_id, "models": self.models},
+                              event="start", event_id=self._event_id(offsets)))
+        while True:
+            for i, gen in enumerate(self.results):
+                if gen.queue != queues[i]:
+                    queues[i] = gen.queue
+                    yield format_event({"index": i, "position": queues[i]}, event="queue")
+                text, offsets[i], done, _ = gen.read(offsets[i])
+                if text:
+                    yield format_event({"index": i, "model": self.models[i], "text": text},
+                                       event_id=self._event_id(offsets))
+                if done and not reported[i]:
+                    reported[i] = True
+                    yield format_event(dict(self.stats[i], index=i), event="model_done",
+                                       event_id=self._event_id(offsets))
+            if all(reported):
+                yield format_event({"stats": self.stats}, event="done", event_id=self._event_id(offsets))
+                return
+            with self._cond:
+                idle = not self._changed(offsets, reported, queues)
+                if idle:
+                    self._cond.wait(KEEPALIVE_INTERVAL)
+                    idle = not self._changed(offsets, reported, queues)
+            if idle:
+                yield ": keepalive\n\n"
+
+
+class GenerationStore:
+    """进行中和刚结束的生成，按 (chat_id, stream_id) 查找；结束的生成保留 ttl 秒供重连
+
+    stream_id 由客户端生成，只在所属对话内有效：带着别的对话的 chat_id 查不到，不同对话的 id 撞了也互不影响。
+
+    factory 为 Comparison 时用来保存对比模式的多模型生成，create 的额外参数原样传给它。
+    """
+
+    def __init__(self, ttl=FINISHED_TTL, max_finished=MAX_FINISHED, factory=Generation):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.factory = factory
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        now = time.monotonic()
+        finished = [g for g in self._items.values() if g.done]
+        excess = len(finished) - self.max_finished
+        for g in finished:
+            if excess > 0 or now - g.finished_at > self.ttl:
+                del self._items[(g.chat_id, g.id)]
+                excess -= 1
+
+    def create(self, chat_id, stream_id=None, user_input=None, **kwargs):
+        """返回 (生成, 是否新建)；同一个 stream_id 并发请求时只有一个会新建"""
+        with self._lock:
+            self._prune()
+            stream_id = stream_id or uuid.uuid4().hex[:12]
+            gen = self._items.get((chat_id, stream_id))
+            if gen is not None:
+                return gen, False
+            gen = self._items[(chat_id, stream_id)] = self.factory(stream_id, chat_id, user_input, **kwargs)
+            return gen, True
+
+    def get(self, chat_id, stream_id):
+        with self._lock:
+            return self._items.get((chat_id, stream_id)) if chat_id and stream_id else None
+
+    def active_for(self, chat_id):
+        """该对话正在进行的生成 (刷新页面后用来继续显示)"""
+        with self._lock:
+            for gen in reversed(self._items.values()):
+                if gen.chat_id == chat_id and not gen.done:
+                    return gen
+        return None
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for g in self._items.values() if not g.done)
@@ -0,0 +1,143 @@
+import os
+import time
+import sqlite3
+import threading
+
+INDEX_FILENAME = "index.db"
+# 目录 mtime 未变化时，至多每隔这么多秒做一次全量 stat 校验
+REFRESH_INTERVAL = 30
+
+
+class HistoryIndex:
+    """历史对话的元数据索引 (SQLite)
+
+    只保存列表页需要的字段 (id / title / prompt_file / updated_at)，
+    以及对应文件的 mtime 和大小，用来判断索引是否过期。
+    """
+
+    def __init__(self, history_dir, storage):
+        self.history_dir = history_dir
+        self.storage = storage
+        self.db_path = os.path.join(history_dir, INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            " id TEXT PRIMARY KEY,"
+            " title TEXT,"
+            " prompt_file TEXT,"
+            " updated_at TEXT,"
+            " mtime_ns INTEGER,"
+            " size INTEGER,"
+            " valid INTEGER DEFAULT 1)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC)")
+        self._conn.commit()
+        self._dir_mtime = None
+        self._last_refresh = 0.0
+
+    # ---------- 写入 ----------
+    def upsert(self, data, mtime_ns, size):
+        """save_chat 写盘后调用，直接用内存中的数据更新索引"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chats (id, title, prompt_file, updated_at, mtime_ns, size, valid)"
+                " VALUES (?, ?, ?, ?, ?, ?, 1)",
+                (data["id"], data.get("title", "未命名对话"), data.get("prompt_file", "Unknown"),
+                 data.get("updated_at", ""), mtime_ns, size)
+            )
+            self._conn.commit()
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            self._conn.commit()
+
+    # ---------- 增量重建 ----------
+    def refresh(self, force=False):
+        """根据文件 mtime / 大小增量同步索引，只读取发生变化的文件"""
+        try:
+            dir_mtime = os.stat(self.history_dir).st_mtime_ns
+        except OSError:
+            return
+        now = time.monotonic()
+        if (not force and dir_mtime == self._dir_mtime
+                and now - self._last_refresh < REFRESH_INTERVAL):
+            return
+
+        on_disk = self.storage.scan()
+
+        with self._lock:
+            known = {row[0]: (row[1], row[2]) for row in
+                     self._conn.execute("SELECT id, mtime_ns, size FROM chats")}
+
+            for chat_id in known.keys() - on_disk.keys():
+                self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+
+            for chat_id, sig in on_disk.items():
+                if known.get(chat_id) == sig:
+                    continue
+                meta = self._read_meta(chat_id)
+                if meta is None:
+                    # 损坏的文件也记录签名，避免每次都重新解析
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO chats (id, mtime_ns, size, valid) VALUES (?, ?, ?, 0)",
+                        (chat_id, sig[0], sig[1])
+                    )
+                    continue
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO chats (id, title, prompt_file, updated_at, mtime_ns, size, valid)"
+                    " VALUES (?, ?, ?, ?, ?, ?, 1)",
+                    (meta["id"], meta["title"], meta["prompt_file"], meta["updated_at"], sig[0], sig[1])
+                )
+            self._conn.commit()
+
+        self._dir_mtime = dir_mtime
+        self._last_refresh = now
+
+    def _read_meta(self, chat_id):
+        try:
+            meta = self.storage.read_meta(chat_id)
+            if meta is None:
+                return None
+            return {
+                "id": meta["id"],
+                "title": meta.get("title", "未命名对话"),
+                "prompt_file": meta.get("prompt_file", "Unknown"),
+                "updated_at": meta.get("updated_at", "")
+            }
+        except Exception:
+            return None
+
+    # ---------- 查询 ----------
+    def list(self, offset=0, limit=None):
+        """按更新时间倒序返回元数据列表，支持分页"""
+        sql = ("SELECT id, title, prompt_file, updated_at FROM chats"
+               " WHERE valid = 1 ORDER BY updated_at DESC, id LIMIT ? OFFSET ?")
+        with self._lock:
+            rows = self._conn.execute(sql, (-1 if limit is None else int(limit), int(offset))).fetchall()
+        return [{"id": r[0], "title": r[1], "prompt_file": r[2], "updated_at": r[3]} for r in rows]
+
+    def get_many(self, ids):
+        """按 id 批量取元数据，返回 {id: {...}}"""
+        ids = list(ids)
+        result = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT id, title, prompt_file, updated_at FROM chats WHERE valid = 1 AND id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                for r in rows:
+                    result[r[0]] = {"id": r[0], "title": r[1], "prompt_file": r[2], "updated_at": r[3]}
+        return result
+
+    def ids(self):
+        with self._lock:
+            return {r[0] for r in self._conn.execute("SELECT id FROM chats WHERE valid = 1")}
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chats WHERE valid = 1").fetchone()[0]
@@ -1,14 +1,48 @@
 import os
-import json
 import uuid
 import datetime
+import threading
+from src.history_index import HistoryIndex
+from src.search_index import SearchIndex
+from src.storage import STORAGE_BACKENDS
+from src.memory import MemoryIndex, TOP_K, DEFAULT_BUDGET
+from src.metrics import metrics, SIZE_BUCKETS
 
 HISTORY_DIR = "history"
+# 默认使用追加日志存储；旧版 history/*.json 会在读取时自动迁移
+DEFAULT_BACKEND = "journal"
+
+# 历史记录操作的耗时与写入量
+OP_SECONDS = metrics.histogram("history_op_seconds", "HistoryManager 操作耗时", ("op",))
+BYTES_WRITTEN = metrics.counter("history_bytes_written_total", "对话存储写入的字节数", ("op",))
+WRITE_SIZE = metrics.histogram("history_write_bytes", "单次保存写入的字节数", ("op",), buckets=SIZE_BUCKETS)
+
+
+def _record_write(op, written):
+    if written:
+        BYTES_WRITTEN.inc(op, value=written)
+        WRITE_SIZE.observe(written, op)
 
 class HistoryManager:
-    def __init__(self):
+    def __init__(self, backend=DEFAULT_BACKEND, compress=True, memory=False):
         if not os.path.exists(HISTORY_DIR):
             os.makedirs(HISTORY_DIR)
+        # compress：快照按帧压缩 (预置字典由已有对话训练)，未压缩的旧文件照常读取
+        self.storage = STORAGE_BACKENDS[backend](HISTORY_DIR, compress=compress)
+        self.index = HistoryIndex(HISTORY_DIR, self.storage)
+        # 对话内容的全文索引，save_chat 时增量更新；索引建立之前就存在的对话由后台线程补建
+        self.search = SearchIndex(HISTORY_DIR)
+        self._search_backfill = None
+        self._search_failed = set()   # 补建时读取失败的对话，本进程内不再反复尝试
+        # 长期记忆 (可选，需要 numpy)：对话切块后的向量索引，save_chat 时增量更新
+        self.memory = None
+        if memory:
+            try:
+                self.memory = MemoryIndex(HISTORY_DIR)
+                # 开启之前就存在的对话在后台补建，不拖慢启动
+                threading.Thread(target=self._backfill_memory, daemon=True).start()
+            except Exception as e:
+                print(f"❌ 长期记忆不可用: {e}")
 
     def create_new_chat(self, prompt_filename, system_content, greeting):
         """创建一个新的对话记录（仅在内存中创建，不立即存盘）"""
@@ -32,58 +66,133 @@ class HistoryManager:
         return chat_id, data
 
     def save_chat(self, chat_id, data):
-        """保存对话到 JSON"""
-        filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
+        """保存对话（由存储后端决定是整体重写还是只追加新消息）"""
         data["updated_at"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with metrics.timer(OP_SECONDS, "save_chat", span="history.save_chat", chat_id=chat_id):
+            _record_write("save_chat", self.storage.save(chat_id, data))
+            # 同步更新元数据索引，列表页无需再打开对话文件
+            self._reindex(chat_id, data)
+        try:
+            with metrics.timer(OP_SECONDS, "search_update", span="history.search_update"):
+                self.search.update(chat_id, data["messages"])
+        except Exception as e:
+            print(f"❌ 更新搜索索引失败: {e}")
+        if self.memory is not None:
+            try:
+                with metrics.timer(OP_SECONDS, "memory_update", span="history.memory_update"):
+                    self.memory.update(chat_id, data["messages"])
+            except Exception as e:
+                print(f"❌ 更新长期记忆失败: {e}")
 
     def load_chat(self, chat_id):
         """读取指定对话"""
-        filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return None
-
-    def list_all_chats(self):
-        """列出所有历史对话，按时间倒序排列"""
-        chats = []
-        files = [f for f in os.listdir(HISTORY_DIR) if f.endswith('.json')]
-        
-        for f in files:
-            path = os.path.join(HISTORY_DIR, f)
+        with metrics.timer(OP_SECONDS, "load_chat", span="history.load_chat", chat_id=chat_id):
+            return self.storage.load(chat_id)
+
+    def load_window(self, chat_id, before=None, limit=50):
+        """分页读取对话：before 之前的最后 limit 条消息 (不传 before 则为最新一页)，附带 start/total"""
+        if not chat_id:
+            return None
+        with metrics.timer(OP_SECONDS, "load_window", span="history.load_window", chat_id=chat_id):
+            return self.storage.load_window(chat_id, before, limit)
+
+    def _reindex(self, chat_id, meta):
+        sig = self.storage.signature(chat_id)
+        if sig:
+            self.index.upsert(meta, *sig)
+
+    def list_all_chats(self, offset=0, limit=None):
+        """列出所有历史对话，按时间倒序排列（走元数据索引，支持分页）"""
+        with metrics.timer(OP_SECONDS, "list_all_chats", span="history.list_all_chats"):
+            self.index.refresh()
+            return self.index.list(offset, limit)
+
+    def search_chats(self, query, offset=0, limit=20):
+        """全文搜索对话内容，返回带标题和高亮片段的命中列表"""
+        with metrics.timer(OP_SECONDS, "search_chats", span="history.search_chats"):
+            return self._search_chats(query, offset, limit)
+
+    def _search_chats(self, query, offset, limit):
+        self.index.refresh()
+        # 索引建立之前就存在的对话：第一次搜索时交给后台线程补建，这次先返回已索引部分的结果
+        missing = self.index.ids() - self.search.indexed_ids() - self._search_failed
+        if missing and (self._search_backfill is None or not self._search_backfill.is_alive()):
+            self._search_backfill = threading.Thread(target=self._backfill_search, args=(missing,), daemon=True)
+            self._search_backfill.start()
+        hits = self.search.search(query, offset, limit)
+        metas = self.index.get_many({h["chat_id"] for h in hits})
+        results = []
+        for h in hits:
+            meta = metas.get(h["chat_id"])
+            if meta is None: continue
+            h.update(title=meta["title"], updated_at=meta["updated_at"])
+            results.append(h)
+        return results
+
+    def search_backfilling(self):
+        """后台是否还在为旧对话补建搜索索引 (此时搜索结果可能不完整)"""
+        return self._search_backfill is not None and self._search_backfill.is_alive()
+
+    def recall(self, query, exclude=None, top_k=TOP_K, budget=DEFAULT_BUDGET):
+        """长期记忆：从其他对话里取回与 query 相关的片段 (带对话标题)；未开启时返回 None"""
+        if self.memory is None:
+            return None
+        try:
+            with metrics.timer(OP_SECONDS, "recall", span="history.recall"):
+                snippets = self.memory.recall(query, exclude, top_k, budget)
+        except Exception as e:
+            print(f"❌ 读取长期记忆失败: {e}")
+            return None
+        metas = self.index.get_many({s["chat_id"] for s in snippets})
+        for s in snippets:
+            title = (metas.get(s["chat_id"]) or {}).get("title")
+            s["title"] = title if title != "新对话" else None
+        return snippets
+
+    def _backfill_search(self, chat_ids):
+        for chat_id in chat_ids:
             try:
-                with open(path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                    chats.append({
-                        "id": data["id"],
-                        "title": data.get("title", "未命名对话"),
-                        "prompt_file": data.get("prompt_file", "Unknown"),
-                        "updated_at": data.get("updated_at", "")
-                    })
-            except:
-                continue
-        
-        # 按时间倒序排（最近的在前面）
-        chats.sort(key=lambda x: x["updated_at"], reverse=True)
-        return chats
+                data = self.storage.load(chat_id)
+                if not data:
+                    self._search_failed.add(chat_id)
+                    continue
+                self.search.update(chat_id, data.get("messages", []), missing_only=True)
+            except Exception as e:
+                self._search_failed.add(chat_id)
+                print(f"❌ 补建搜索索引失败 ({chat_id}): {e}")
+
+    def _backfill_memory(self):
+        try:
+            self.index.refresh()
+            for chat_id in self.index.ids() - self.memory.indexed_ids():
+                data = self.storage.load(chat_id)
+                if data:
+                    self.memory.update(chat_id, data.get("messages", []))
+        except Exception as e:
+            print(f"❌ 补建长期记忆失败: {e}")
 
     def update_title(self, chat_id, new_title):
-        """更新标题"""
-        data = self.load_chat(chat_id)
-        if data:
-            data["title"] = new_title
-            self.save_chat(chat_id, data)
+        """更新标题（只写元数据，不重写对话内容）"""
+        fields = {
+            "title": new_title,
+            "updated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        with metrics.timer(OP_SECONDS, "update_title", span="history.update_title", chat_id=chat_id):
+            _record_write("update_title", self.storage.update_meta(chat_id, fields))
+            meta = self.storage.read_meta(chat_id)
+            if meta:
+                self._reindex(chat_id, meta)
 # ========== 【新增】删除对话的方法 ==========
     def delete_chat(self, chat_id):
-        """删除指定的对话文件"""
-        filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-                return True
-            except Exception as e:
-                print(f"删除失败: {e}")
-                return False
-        return False
\ No newline at end of file
+        """删除指定对话的所有文件"""
+        try:
+            with metrics.timer(OP_SECONDS, "delete_chat", span="history.delete_chat", chat_id=chat_id):
+                if self.storage.delete(chat_id):
+                    self.index.remove(chat_id)
+                    self.search.remove(chat_id)
+                    if self.memory is not None:
+                        self.memory.remove(chat_id)
+                    return True
+        except Exception as e:
+            print(f"删除失败: {e}")
+        return False
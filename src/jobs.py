@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+from src.metrics import metrics
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 1000
+# 标题批处理：等待这么久收集同时结束的对话，凑够 TITLE_BATCH_SIZE 个立即发送
+TITLE_BATCH_WINDOW = 0.5
+TITLE_BATCH_SIZE = 8
+
+# 后台任务指标：排队等待时间、执行时间、结果
+JOB_WAIT_SECONDS = metrics.histogram("jobs_wait_seconds", "后台任务提交到开始执行的等待时间", ("job",))
+JOB_SECONDS = metrics.histogram("jobs_run_seconds", "后台任务执行耗时", ("job",))
+JOB_RESULTS = metrics.counter("jobs_total", "后台任务数 (result: ok / error / dropped)", ("job", "result"))
+
+
+def _job_name(fn):
+    return getattr(fn, "__qualname__", None) or getattr(fn, "__name__", "job")
+
+
+class JobExecutor:
+    """后台任务执行器：有界队列 + 固定数量的工作线程
+
+    用于标题生成、摘要更新等回合结束后的工作，不阻塞流式响应。
+    同一个 key 的任务在排队或执行期间重复提交会被忽略。
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_queue=DEFAULT_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """提交任务，返回是否入队 (重复的 key 或队列已满时返回 False)"""
+        with self._lock:
+            if key is not None and key in self._keys:
+                return False
+            try:
+                self._queue.put_nowait((key, fn, args, kwargs, time.perf_counter()))
+            except queue.Full:
+                print(f"❌ 后台任务队列已满，丢弃任务: {key}")
+                JOB_RESULTS.inc(_job_name(fn), "dropped")
+                return False
+            if key is not None:
+                self._keys.add(key)
+        return True
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            key, fn, args, kwargs, submitted = item
+            name = _job_name(fn)
+            JOB_WAIT_SECONDS.observe(time.perf_counter() - submitted, name)
+            try:
+                # trace 模式下每个后台任务单独记一份 span
+                with metrics.trace("job", job=name, key=key), metrics.timer(JOB_SECONDS, name):
+                    fn(*args, **kwargs)
+                JOB_RESULTS.inc(name, "ok")
+            except Exception as e:
+                print(f"❌ 后台任务失败 ({key}): {e}")
+                JOB_RESULTS.inc(name, "error")
+            finally:
+                with self._lock:
+                    self._keys.discard(key)
+                self._queue.task_done()
+
+    def join(self):
+        """等待已提交的任务全部完成"""
+        self._queue.join()
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.join()
+        for _ in self._threads:
+            self._queue.put(None)
+
+
+class TitleBatcher:
+    """自动标题的去重与批处理
+
+    同一对话只保留一个待生成的标题；短时间内结束首轮的多个对话合并成一次上游请求。
+    生成结果交给 apply(chat_id, title) 落地。
+    """
+
+    def __init__(self, executor, get_engine, apply, window=TITLE_BATCH_WINDOW, batch_size=TITLE_BATCH_SIZE):
+        self.executor = executor
+        self.get_engine = get_engine
+        self.apply = apply
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, chat_id, user_msg, ai_msg):
+        with self._lock:
+            self._pending[chat_id] = (user_msg, ai_msg)
+            full = len(self._pending) >= self.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.window, self._submit_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self._submit_flush()
+
+    def _submit_flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.executor.submit(None, self.flush)
+
+    def drain(self):
+        """在当前线程处理完所有待生成的标题 (程序退出前调用)"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch = list(self._pending.items())[:self.batch_size]
+            for chat_id, _ in batch:
+                del self._pending[chat_id]
+            remaining = bool(self._pending)
+        if remaining:
+            self._submit_flush()
+        if not batch:
+            return
+        engine = self.get_engine()
+        if engine is None:
+            return
+        titles = engine.generate_titles([pair for _, pair in batch])
+        for (chat_id, _), title in zip(batch, titles):
+            try:
+                self.apply(chat_id, title)
+            except Exception as e:
+                print(f"❌ 保存自动标题失败 ({chat_id}): {e}")
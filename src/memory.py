@@ -0,0 +1,372 @@
+"""长期记忆：把保存过的对话切块、向量化，提问时从其他对话里取回最相关的片段注入上下文
+
+取回分两步：
+1. 向量初筛：片段向量存在 history/memory/vectors.f16 (float16，numpy 内存映射，按块追加)。
+   每块 BLOCK 个片段按“维度优先”存放，哈希向量的查询只有十几个非零维，只需读这几行，
+   10 万个片段也只要几毫秒；
+2. 精排：候选片段按 tf-idf 余弦重新打分 (文档频率表 df.i32 同样是内存映射)，去掉哈希冲突带来的误差。
+
+默认的向量化方式是离线的哈希 n-gram (HashingEmbedder)，不需要网络和模型文件；
+也可以传入任何带 name / dim / embed(texts) 的对象。片段文本和行号在 chunks.db (SQLite)。
+需要 numpy，没装时长期记忆不可用。
+"""
+import os
+import zlib
+import sqlite3
+import threading
+from collections import Counter
+from src.search_index import tokenize
+from src.context_manager import count_tokens
+
+# numpy 在第一次创建 MemoryIndex 时才导入 (load_numpy)，没开启长期记忆的启动不为它付导入时间
+np = None
+
+MEMORY_DIR = "memory"
+VECTORS_FILE = "vectors.f16"
+DF_FILE = "df.i32"
+CHUNKS_DB = "chunks.db"
+DIM = 1024
+# 向量文件每块的片段数：文件按块增长，扩容不需要搬动已有数据
+BLOCK = 4096
+# 文档频率表按特征哈希的低位分桶
+DF_BUCKETS = 1 << 20
+# 切块：每块最多多少字，相邻块重叠多少字；太短的消息 (“好的”) 不值得记
+CHUNK_CHARS = 400
+CHUNK_OVERLAP = 80
+MIN_CHUNK_CHARS = 4
+INDEXED_ROLES = ("user", "assistant")
+# 默认取回的片段数、注入的 token 预算，以及精排后的相似度下限 (tf-idf 余弦)
+TOP_K = 4
+DEFAULT_BUDGET = 600
+MIN_SCORE = 0.1
+# 向量初筛保留多少个候选进入精排
+CANDIDATES = 256
+# 每个片段除正文外的格式开销 (标题、角色标签)
+SNIPPET_OVERHEAD = 12
+# 删除的行超过一半且不少于 COMPACT_MIN 时整理向量文件
+COMPACT_MIN = 4096
+
+
+def load_numpy():
+    """导入 numpy 并返回；没装时返回 None"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+
+def split_chunks(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """把长消息切成有重叠的块，尽量在换行或句号处断开"""
+    text = text.strip()
+    if len(text) <= size:
+        return [text] if len(text) >= MIN_CHUNK_CHARS else []
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(sep, start + size // 2, end) for sep in ("\n", "。", ". ", "！", "？"))
+            if cut > 0:
+                end = cut + 1
+        chunks.append(text[start:end].strip())
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if len(c) >= MIN_CHUNK_CHARS]
+
+
+def features(text):
+    """分词 (中日韩二元组 / 小写单词，与全文搜索相同) 后的 {特征哈希: 词频}"""
+    return Counter(zlib.crc32(t.encode("utf-8")) for t in tokenize(text))
+
+
+def _pack(counts):
+    """特征存进 SQLite：uint32 哈希数组 + uint16 词频数组，精排时不必重新分词"""
+    hashes = np.fromiter(counts.keys(), dtype=np.uint32, count=len(counts))
+    tf = np.fromiter((min(n, 65535) for n in counts.values()), dtype=np.uint16, count=len(counts))
+    return hashes.tobytes() + tf.tobytes()
+
+
+def _unpack(blob):
+    n = len(blob) // 6
+    return (np.frombuffer(blob, dtype=np.uint32, count=n).astype(np.int64),
+            np.frombuffer(blob, dtype=np.uint16, offset=4 * n, count=n).astype(np.float32))
+
+
+class HashingEmbedder:
+    """离线向量化：每个特征带符号地哈希到 dim 维之一，词频取对数后归一化"""
+
+    def __init__(self, dim=DIM):
+        self.dim = int(dim)
+        self.name = f"hash-{self.dim}"
+
+    def _vector(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        counts = features(text)
+        if not counts:
+            return vec
+        hashes = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        np.add.at(vec, hashes % self.dim, np.where(hashes & 0x80000000, weights, -weights))
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def embed(self, texts):
+        """返回 (len(texts), dim) 的 float32 数组，每行已归一化"""
+        return np.stack([self._vector(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+
+
+EMBEDDERS = {"hash": HashingEmbedder}
+
+
+class MemoryIndex:
+    """片段向量索引：save_chat 时增量追加新消息，消息被改写时整段重建该对话 (与 SearchIndex 相同)
+
+    删除对话只把行标记为失效，失效的行多了再整理向量文件；换了向量化方式时清空重建。
+    SQLite 是权威记录：向量写入后、提交前被杀掉的行，下次启动时会被覆盖。
+    """
+
+    def __init__(self, history_dir, embedder=None):
+        if load_numpy() is None:
+            raise RuntimeError("长期记忆需要 numpy (pip install numpy)")
+        self.directory = os.path.join(history_dir, MEMORY_DIR)
+        os.makedirs(self.directory, exist_ok=True)
+        self.embedder = embedder or HashingEmbedder()
+        self._vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        self._df_path = os.path.join(self.directory, DF_FILE)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.directory, CHUNKS_DB), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY,"
+            " chat_id TEXT,"
+            " idx INTEGER,"
+            " role TEXT,"
+            " text TEXT,"
+            " feats BLOB)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_chat ON chunks(chat_id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_chats ("
+            " chat_id TEXT PRIMARY KEY,"
+            " count INTEGER,"
+            " last_content TEXT)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._open()
+
+    # ---------- 向量文件 ----------
+    def _open(self):
+        row = self._conn.execute("SELECT value FROM info WHERE key = 'embedder'").fetchone()
+        signature = f"{self.embedder.name}:{self.embedder.dim}:{BLOCK}"
+        if row is None or row[0] != signature:
+            # 第一次使用或换了向量化方式：旧向量不能混用，清空后由调用方重新补建
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM indexed_chats")
+            self._conn.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('embedder', ?)", (signature,))
+            self._conn.commit()
+            for path in (self._vectors_path, self._df_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        last = self._conn.execute("SELECT MAX(row) FROM chunks").fetchone()[0]
+        self._count = 0 if last is None else last + 1
+        self._map(max(-(-self._count // BLOCK), 1))
+        self._alive = np.zeros(self._blocks * BLOCK, dtype=bool)
+        rows = [r for (r,) in self._conn.execute("SELECT row FROM chunks")]
+        self._alive[rows] = True
+        self._df = self._memmap(self._df_path, np.int32, (DF_BUCKETS,))
+        self._docs = len(rows)
+
+    def _memmap(self, path, dtype, shape):
+        """映射 path (文件不够长时先扩展，新增部分为 0)"""
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+    def _map(self, blocks):
+        self._vectors = self._memmap(self._vectors_path, np.float16, (blocks, self.embedder.dim, BLOCK))
+        self._blocks = blocks
+
+    def _reserve(self, n):
+        blocks = -(-(self._count + n) // BLOCK)
+        if blocks <= self._blocks:
+            return
+        self._vectors.flush()
+        self._map(blocks)
+        alive = np.zeros(blocks * BLOCK, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def _update_df(self, blobs, delta):
+        for blob in blobs:
+            hashes, _ = _unpack(blob)
+            self._df[np.unique(hashes % DF_BUCKETS)] += delta
+        self._docs += delta * len(blobs)
+
+    # ---------- 写入 ----------
+    def update(self, chat_id, messages):
+        """把对话中尚未索引的消息切块、向量化后加入索引"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT count, last_content FROM indexed_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            start = 0
+            if row:
+                count, last_content = row
+                if count <= len(messages) and (count == 0 or (messages[count - 1].get("content") or "") == last_content):
+                    start = count
+                else:
+                    self._delete(chat_id)
+            if start == len(messages) and row:
+                return
+            pending = []
+            for i in range(start, len(messages)):
+                m = messages[i]
+                content = m.get("content") or ""
+                if m.get("role") not in INDEXED_ROLES or not isinstance(content, str):
+                    continue
+                pending.extend((i, m["role"], chunk) for chunk in split_chunks(content))
+            if pending:
+                vectors = self.embedder.embed([text for _, _, text in pending])
+                blobs = [_pack(features(text)) for _, _, text in pending]
+                self._reserve(len(pending))
+                first = self._count
+                for n, vec in enumerate(vectors):
+                    b, col = divmod(first + n, BLOCK)
+                    self._vectors[b, :, col] = vec
+                self._update_df(blobs, 1)
+                self._conn.executemany(
+                    "INSERT INTO chunks (row, chat_id, idx, role, text, feats) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(first + n, chat_id, i, role, text, blob)
+                     for n, ((i, role, text), blob) in enumerate(zip(pending, blobs))])
+                self._alive[first:first + len(pending)] = True
+                self._count += len(pending)
+            last = (messages[-1].get("content") or "") if messages else ""
+            self._conn.execute(
+                "INSERT OR REPLACE INTO indexed_chats (chat_id, count, last_content) VALUES (?, ?, ?)",
+                (chat_id, len(messages), last if isinstance(last, str) else ""))
+            self._conn.commit()
+            self._maybe_compact()
+
+    def _delete(self, chat_id):
+        rows = self._conn.execute("SELECT row, feats FROM chunks WHERE chat_id = ?", (chat_id,)).fetchall()
+        self._alive[[r for r, _ in rows]] = False
+        self._update_df([blob for _, blob in rows], -1)
+        self._conn.execute("DELETE FROM chunks WHERE chat_id = ?", (chat_id,))
+        self._conn.execute("DELETE FROM indexed_chats WHERE chat_id = ?", (chat_id,))
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._delete(chat_id)
+            self._conn.commit()
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        dead = self._count - self._docs
+        if dead >= COMPACT_MIN and dead * 2 > self._count:
+            self._compact()
+
+    def _compact(self):
+        """去掉失效的行：有效行依次前移 (新位置不会超过旧位置，按块顺序搬动不会覆盖还没读的数据)"""
+        rows = self._conn.execute("SELECT row, chat_id, idx, role, text, feats FROM chunks ORDER BY row").fetchall()
+        old = np.array([r[0] for r in rows], dtype=np.int64)
+        for b in range(0, len(old), BLOCK):
+            src = old[b:b + BLOCK]
+            self._vectors[b // BLOCK, :, :len(src)] = self._vectors[src // BLOCK, :, src % BLOCK].T
+        self._vectors.flush()
+        self._conn.execute("DELETE FROM chunks")
+        self._conn.executemany("INSERT INTO chunks (row, chat_id, idx, role, text, feats) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(n,) + tuple(r[1:]) for n, r in enumerate(rows)])
+        self._conn.commit()
+        self._count = len(rows)
+        self._alive[:] = False
+        self._alive[:self._count] = True
+
+    def indexed_ids(self):
+        with self._lock:
+            return {r[0] for r in self._conn.execute("SELECT chat_id FROM indexed_chats")}
+
+    def count(self):
+        with self._lock:
+            return self._docs
+
+    # ---------- 查询 ----------
+    def _weights(self, hashes, tf):
+        """tf-idf 权重 (文档频率在锁内读取)；idf 加 1 平滑，对话很少时常见词也不至于权重为 0"""
+        idf = np.log((self._docs + 1) / (self._df[hashes % DF_BUCKETS].astype(np.float32) + 1)) + 1.0
+        return (1.0 + np.log(tf)) * idf
+
+    def _rerank(self, counts, blobs):
+        """精排：查询和每个候选片段的 tf-idf 余弦，一次向量化算完"""
+        qh = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        order = np.argsort(qh)
+        qh = qh[order]
+        qw = self._weights(qh, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))[order])
+        qw /= np.linalg.norm(qw) or 1.0
+        parts = [_unpack(blob) for blob in blobs]
+        hashes = np.concatenate([h for h, _ in parts])
+        owner = np.repeat(np.arange(len(parts)), [len(h) for h, _ in parts])
+        w = self._weights(hashes, np.concatenate([tf for _, tf in parts]))
+        norms = np.sqrt(np.bincount(owner, w * w, minlength=len(parts)))
+        pos = np.minimum(np.searchsorted(qh, hashes), len(qh) - 1)
+        hit = qh[pos] == hashes
+        dots = np.bincount(owner[hit], w[hit] * qw[pos[hit]], minlength=len(parts))
+        return dots / np.where(norms > 0, norms, 1.0)
+
+    def _candidates(self, q, n, exclude):
+        """向量初筛：只读取查询向量非零的那几维，返回相似度最高的行号"""
+        blocks = -(-n // BLOCK)
+        nz = np.flatnonzero(q)
+        if len(nz) == 0:
+            return []
+        scores = np.tensordot(q[nz], self._vectors[:blocks, nz, :].astype(np.float32), axes=([0], [1]))
+        scores = scores.reshape(-1)[:n]
+        scores[~self._alive[:n]] = -np.inf
+        if exclude:
+            rows = [r for (r,) in self._conn.execute("SELECT row FROM chunks WHERE chat_id = ?", (exclude,))]
+            scores[rows] = -np.inf
+        k = min(CANDIDATES, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(r) for r in top if scores[r] > -np.inf]
+
+    def recall(self, query, exclude=None, top_k=TOP_K, budget=DEFAULT_BUDGET, min_score=MIN_SCORE):
+        """返回与 query 最相关的片段 (按相似度排序)，总 token 数不超过 budget；exclude 为不参与的对话 id"""
+        counts = features(query or "")
+        if not counts or top_k <= 0:
+            return []
+        q = self.embedder.embed([query])[0]
+        with self._lock:
+            n = self._count
+            if n == 0:
+                return []
+            top = self._candidates(q, n, exclude)
+            if not top:
+                return []
+            marks = ",".join("?" * len(top))
+            found = self._conn.execute(
+                f"SELECT row, chat_id, idx, role, text, feats FROM chunks WHERE row IN ({marks})", top).fetchall()
+            if not found:
+                return []
+            scores = self._rerank(counts, [r[5] for r in found])
+        ranked = sorted(((float(score),) + tuple(r[:5]) for score, r in zip(scores, found) if score >= min_score),
+                        key=lambda r: (-r[0], r[1]))
+        results, seen, used = [], set(), 0
+        for score, _, chat_id, idx, role, text in ranked:
+            if text in seen:
+                continue
+            cost = count_tokens(text) + SNIPPET_OVERHEAD
+            if used + cost > budget:
+                continue
+            seen.add(text)
+            used += cost
+            results.append({"chat_id": chat_id, "index": idx, "role": role, "text": text, "score": round(score, 4)})
+            if len(results) >= top_k:
+                break
+        return results
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextvars
+from collections import deque
+
+# 运行模式：off 不记录；basic (默认) 只累计计数器和直方图，开销很小；trace 额外记录每个请求的 span
+METRICS_MODES = ("off", "basic", "trace")
+DEFAULT_MODE = "basic"
+# 内存中保留最近多少个请求的 span，以及导出的默认文件
+TRACE_BUFFER = 500
+TRACE_FILE = "traces.jsonl"
+
+# 直方图分桶：耗时 (秒)、速率 (token/秒)、大小 (字节)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# 当前线程 / 协程正在记录的请求 (Trace)
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """只增不减的计数器，按标签值分别累计"""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, value=1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels_text(self.labels, k)} {_number(v)}" for k, v in sorted(items)]
+
+
+class Histogram:
+    """固定分桶的直方图：每次 observe 只做一次二分查找和一次加锁累加"""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数 (最后一个是 +Inf), 总和, 次数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if not self.registry.enabled:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *label_values):
+        entry = self._values.get(label_values)
+        return entry[2] if entry else 0
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        lines = []
+        for key, counts, total, n in sorted(items):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = 'le="' + _number(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {n}")
+        return lines
+
+
+class Gauge:
+    """渲染时才调用 fn 取值的瞬时指标 (如队列长度)"""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, fn):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        try:
+            return [f"{self.name} {_number(self.fn())}"]
+        except Exception:
+            return []
+
+
+class Trace:
+    """一个请求 (或后台任务) 的 span 记录"""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.duration = None
+        self.spans = []
+
+    def add_span(self, name, start, duration, attrs):
+        self.spans.append({
+            "name": name,
+            "start_ms": round((start - self.t0) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+            **attrs,
+        })
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            **self.attrs,
+            "spans": self.spans,
+        }
+
+
+class _Timer:
+    def __init__(self, registry, histogram, label_values, span, attrs):
+        self.registry = registry
+        self.histogram = histogram
+        self.label_values = label_values
+        self.span = span
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        if self.histogram is not None:
+            self.histogram.observe(elapsed, *self.label_values)
+        if self.span:
+            trace = _current_trace.get()
+            if trace is not None:
+                if exc_type is not None:
+                    self.attrs["error"] = exc_type.__name__
+                trace.add_span(self.span, self.start, elapsed, self.attrs)
+        return False
+
+
+class _TraceScope:
+    def __init__(self, registry, name, attrs):
+        self.registry = registry
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.handle = self.registry.start_trace(self.name, **self.attrs)
+        return self.handle[0] if self.handle else None
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.handle and exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self.handle[0].attrs["error"] = exc_type.__name__
+        self.registry.finish_trace(self.handle)
+        return False
+
+
+class Metrics:
+    """进程内的指标注册表，按 Prometheus 文本格式输出
+
+    basic 模式下只有计数器和直方图 (每次记录一次加锁)；trace 模式下额外把每个请求的
+    span 放进环形缓冲区，可以导出到本地 JSON Lines 文件。
+    """
+
+    def __init__(self, mode=DEFAULT_MODE, trace_file=TRACE_FILE, trace_buffer=TRACE_BUFFER):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=trace_buffer)
+        self.trace_file = trace_file
+        self.configure(mode)
+
+    def configure(self, mode=DEFAULT_MODE, trace_file=None):
+        mode = (mode or DEFAULT_MODE).strip().lower()
+        if mode not in METRICS_MODES:
+            print(f"❌ 未知的指标模式: {mode}，使用 {DEFAULT_MODE}")
+            mode = DEFAULT_MODE
+        self.mode = mode
+        self.enabled = mode != "off"
+        self.tracing = mode == "trace"
+        if trace_file:
+            self.trace_file = trace_file
+
+    # ---------- 注册 ----------
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def gauge(self, name, help, fn):
+        """注册瞬时指标；同名再次注册时替换取值函数 (如引擎重建后)"""
+        with self._lock:
+            self._metrics[name] = Gauge(self, name, help, fn)
+            return self._metrics[name]
+
+    # ---------- 计时与 span ----------
+    def timer(self, histogram, *label_values, span=None, **attrs):
+        """计时上下文：结束时记入 histogram，trace 模式下同时记一个名为 span 的 span"""
+        return _Timer(self, histogram, label_values, span if self.tracing else None, attrs)
+
+    def span(self, name, **attrs):
+        """只记 span、不记直方图的计时上下文"""
+        return _Timer(self, None, (), name if self.tracing else None, attrs)
+
+    def add_span(self, name, start, duration, **attrs):
+        """给当前请求补记一个已经结束的 span (start 为 time.perf_counter() 的值)"""
+        if not self.tracing:
+            return
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, duration, attrs)
+
+    def start_trace(self, name, **attrs):
+        """开始记录一个请求，返回交给 finish_trace 的句柄 (未开启 trace 时返回 None)"""
+        if not self.tracing:
+            return None
+        trace = Trace(name, attrs)
+        return trace, _current_trace.set(trace)
+
+    def finish_trace(self, handle):
+        if not handle:
+            return
+        trace, token = handle
+        trace.duration = time.perf_counter() - trace.t0
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # 在另一个上下文里结束 (如生成器被垃圾回收时关闭)
+            _current_trace.set(None)
+        self._traces.append(trace)
+
+    def trace(self, name, **attrs):
+        """with metrics.trace("名字"): 记录一个请求的全部 span"""
+        return _TraceScope(self, name, attrs)
+
+    def recent_traces(self, limit=50):
+        traces = list(self._traces)[-int(limit):] if limit else list(self._traces)
+        return [t.to_dict() for t in traces]
+
+    def dump_traces(self, path=None):
+        """把缓冲区中的 span 追加写入 JSON Lines 文件并清空缓冲区，返回 (路径, 条数)"""
+        path = path or self.trace_file
+        traces = []
+        while self._traces:
+            try:
+                traces.append(self._traces.popleft())
+            except IndexError:
+                break
+        if traces:
+            with open(path, "a", encoding="utf-8") as f:
+                for t in traces:
+                    f.write(json.dumps(t.to_dict(), ensure_ascii=False) + "\n")
+        return os.path.abspath(path), len(traces)
+
+    # ---------- 输出 ----------
+    def render(self):
+        """Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共享的注册表；模式由配置 MY_METRICS 决定 (见 app.py 的 init_engine)
+metrics = Metrics()
@@ -0,0 +1,119 @@
+import os
+import hashlib
+import threading
+
+# 达到这个长度的 system 消息才存进共享的提示词库，短的直接内联在对话里
+MIN_PROMPT_CHARS = 200
+# 存储中的 system 消息用这个字段记录提示词的哈希，代替 content
+REF_KEY = "prompt_ref"
+# 提示词文件丢失 / 损坏时，内存中的消息用这个内部字段记住哈希，再次保存时原样写回 (不返回给前端)
+MISSING_KEY = "_prompt_missing"
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class PromptStore:
+    """system 提示词按内容的 sha256 命名保存在同一个目录里，对话记录里只写哈希
+
+    同一版本的提示词在磁盘上只存一份；读取过的版本按哈希缓存同一个字符串对象，
+    加载进内存的对话共享它。文件写入后不再修改：角色文件之后被编辑，旧对话仍然引用当时实际使用的内容。
+    """
+
+    def __init__(self, directory, min_chars=MIN_PROMPT_CHARS):
+        self.directory = directory
+        self.min_chars = min_chars
+        self._texts = {}    # 哈希 -> 文本 (共享的字符串对象)
+        self._refs = {}     # 文本 -> 哈希 (已经落盘的版本)
+        self._lock = threading.Lock()
+
+    def _path(self, ref):
+        return os.path.join(self.directory, ref + ".txt")
+
+    def _remember(self, ref, text, stored=True):
+        # stored=False：只共享字符串，还没有写盘 (下次 put 时才写)
+        with self._lock:
+            text = self._texts.setdefault(ref, text)
+            if stored:
+                self._refs[text] = ref
+        return text
+
+    def put(self, text):
+        """保存一个版本的提示词 (已存在时不重复写)，返回哈希"""
+        ref = self._refs.get(text)
+        if ref is not None:
+            return ref
+        ref = prompt_hash(text)
+        path = self._path(ref)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        self._remember(ref, text)
+        return ref
+
+    def get(self, ref):
+        """按哈希取回提示词；从磁盘读取时校验内容与哈希一致"""
+        text = self._texts.get(ref)
+        if text is not None:
+            return text
+        with open(self._path(ref), 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+        if prompt_hash(text) != ref:
+            raise ValueError(f"提示词 {ref[:12]} 的内容与哈希不符")
+        return self._remember(ref, text)
+
+    def _shared(self, message):
+        content = message.get("content")
+        return message.get("role") == "system" and isinstance(content, str) and len(content) >= self.min_chars
+
+    def encode(self, message):
+        """写盘前：较长的 system 消息换成 {"role": "system", "prompt_ref": 哈希}，以 _ 开头的内部字段不落盘"""
+        missing = message.get(MISSING_KEY)
+        if missing and not message.get("content"):
+            return {k: v for k, v in message.items() if k != "content" and not k.startswith("_")} | {REF_KEY: missing}
+        if any(k.startswith("_") for k in message):
+            message = {k: v for k, v in message.items() if not k.startswith("_")}
+        if not self._shared(message):
+            return message
+        encoded = {k: v for k, v in message.items() if k != "content"}
+        encoded[REF_KEY] = self.put(message["content"])
+        return encoded
+
+    def decode(self, message):
+        """读取后 (原地修改)：prompt_ref 换回共享的提示词字符串；返回是否遇到了还内联着的长提示词
+
+        只读不写：内联的旧格式在对话下次保存时才改写成引用。
+        """
+        ref = message.pop(REF_KEY, None)
+        if ref is not None:
+            try:
+                message["content"] = self.get(ref)
+            except (OSError, ValueError) as e:
+                print(f"❌ 读取提示词 {ref[:12]} 失败: {e}")
+                message["content"] = ""
+                message[MISSING_KEY] = ref
+            return False
+        if not self._shared(message):
+            return False
+        # 旧格式：内容内联在对话里，换成共享的字符串
+        text = message["content"]
+        message["content"] = self._remember(prompt_hash(text), text, stored=False)
+        return True
+
+
+def missing_prompt(messages):
+    """对话的 system 提示词文件丢失时返回它的哈希，否则返回 None"""
+    for m in messages:
+        if m.get(MISSING_KEY) and not m.get("content"):
+            return m[MISSING_KEY]
+    return None
+
+
+def missing_prompt_error(ref):
+    return f"❌ 这个对话的角色提示词文件 (prompts/{ref[:12]}…) 丢失或已损坏，请在顶部重新选择角色后再发送。"
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_DIR = "cache"
+# 命中缓存时按这个长度切片回放，前端依然是“打字机”效果
+REPLAY_CHUNK_CHARS = 16
+
+
+def normalize_messages(messages):
+    """归一化消息列表：只保留 role / content，统一换行并去掉首尾空白"""
+    normalized = []
+    for m in messages:
+        content = m.get("content") or ""
+        if isinstance(content, str):
+            content = content.replace("\r\n", "\n").strip()
+        normalized.append({"role": m.get("role"), "content": content})
+    return normalized
+
+
+def replay_chunks(text, size=REPLAY_CHUNK_CHARS):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class ResponseCache:
+    """回复缓存：内存 LRU + 磁盘 (按总大小上限和 TTL 淘汰)
+
+    以 (模型, temperature, max_tokens, 归一化后的消息列表) 的哈希为键，只缓存完整的回复文本。
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_items=256, disk_max_bytes=64 * 1024 * 1024, ttl=7 * 86400):
+        self.cache_dir = cache_dir
+        self.memory_items = int(memory_items)
+        self.disk_max_bytes = int(disk_max_bytes)
+        self.ttl = float(ttl)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(model, temperature, max_tokens, messages):
+        payload = json.dumps({
+            "model": model, "temperature": temperature, "max_tokens": max_tokens,
+            "messages": normalize_messages(messages),
+        }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    # ---------- 读 ----------
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and now - entry.get("created", 0) < self.ttl:
+            with self._lock:
+                self._remember(key, entry["text"], entry["created"])
+                self.stats["disk_hits"] += 1
+            return entry["text"]
+        if entry is not None:
+            self._remove_file(path)
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    # ---------- 写 ----------
+    def put(self, key, text):
+        created = time.time()
+        with self._lock:
+            self._remember(key, text, created)
+            self.stats["stores"] += 1
+        path = self._path(key)
+        data = json.dumps({"text": text, "created": created}, ensure_ascii=False)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"❌ 写入回复缓存失败: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_size()
+            else:
+                self._disk_bytes += len(data.encode('utf-8'))
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._evict_disk()
+
+    def _remember(self, key, text, created):
+        self._memory[key] = (text, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    # ---------- 磁盘淘汰 ----------
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict_disk(self):
+        """先删过期的，再按最旧优先删到上限的 90%"""
+        now = time.time()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * 0.9
+        for mtime, size, path in entries:
+            if total <= target and now - mtime < self.ttl:
+                break
+            self._remove_file(path)
+            total -= size
+            self.stats["evictions"] += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def snapshot(self):
+        """命中率等统计信息"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_items"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
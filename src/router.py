@@ -0,0 +1,531 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+
+from src.client_pool import ClientRegistry
+from src.metrics import metrics
+
+ENDPOINTS_FILE = "endpoints.json"
+# 重试：最多重试次数、退避基数 (秒)、退避上限 (秒)
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.25
+MAX_BACKOFF = 8.0
+# 上游失败后暂停使用的最长时间 (秒)，按连续失败次数指数增长
+MAX_COOLDOWN = 30.0
+# 首字延迟 / 错误率的指数滑动平均系数，以及计算 p95 的样本窗口
+EWMA_ALPHA = 0.2
+TTFT_WINDOW = 200
+# 对冲：样本足够时按 p95 首字延迟触发，样本不足时按默认时间；对冲请求最多占请求数的比例 (外加少量突发)
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 2.0
+HEDGE_MAX_RATIO = 0.2
+HEDGE_BURST = 5
+# 偶尔不选最快的上游，让其他上游的延迟统计保持新鲜
+EXPLORE_RATE = 0.05
+# 可重试的 HTTP 状态码 (以及所有 5xx)
+RETRYABLE_STATUS = {408, 409, 429}
+# endpoints.json 里每个上游可以单独设置的准入限制字段
+ENDPOINT_LIMITS = ("max_concurrency", "rpm", "tpm")
+
+ATTEMPTS = metrics.counter("upstream_attempts_total",
+                           "各上游的请求次数 (result: ok / error / broken / cancelled)", ("endpoint", "result"))
+ENDPOINT_TTFT = metrics.histogram("upstream_ttft_seconds", "各上游的首字延迟", ("endpoint",))
+RETRIES = metrics.counter("upstream_retries_total", "重试次数 (按重试发往的上游)", ("endpoint",))
+HEDGES = metrics.counter("upstream_hedges_total", "对冲请求 (result: sent / won)", ("result",))
+
+
+def is_retryable(e):
+    """连接错误、超时、429、5xx 可以重试 / 换上游；参数错误、鉴权失败等直接返回给用户"""
+    import openai
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500
+    return False
+
+
+def retry_after(e):
+    """错误响应里的 Retry-After (秒)，没有时返回 None"""
+    response = getattr(e, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def response_pieces(response, stream):
+    """把 chat.completions.create 的返回值转换成逐段文本 (兼容流式 / 非流式)"""
+    if stream:
+        for chunk in response:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                yield content
+    else:
+        yield response.choices[0].message.content or ""
+
+
+async def aresponse_pieces(response, stream):
+    if stream:
+        async for chunk in response:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                yield content
+    else:
+        yield response.choices[0].message.content or ""
+
+
+def load_endpoints(path=ENDPOINTS_FILE):
+    """读取上游列表文件 (JSON 数组)，文件不存在时返回 []
+
+    每项: {"name", "base_url", "api_key", "weight": 1, "models": [...], "model_map": {"请求的模型": "上游模型名"},
+          "max_concurrency", "rpm", "tpm"}
+    models 为空表示该上游提供所有模型；后三项是该上游的准入限制 (见 src.scheduler)，不写时沿用 .env 里的设置。
+    """
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        if not isinstance(entries, list):
+            raise ValueError("应为 JSON 数组")
+        return [e for e in entries if isinstance(e, dict) and e.get("base_url")]
+    except Exception as e:
+        print(f"❌ 读取上游列表 {path} 失败: {e}")
+        return []
+
+
+class Endpoint:
+    """一个上游 (base_url + key)，以及它的实时首字延迟、错误率和冷却状态"""
+
+    def __init__(self, name, base_url, api_key, weight=1.0, models=None, model_map=None, limits=None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.update(weight, models, model_map, limits)
+        self._lock = threading.Lock()
+        self.ttfts = deque(maxlen=TTFT_WINDOW)
+        self.ewma = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def update(self, weight=1.0, models=None, model_map=None, limits=None):
+        self.weight = max(float(weight), 0.01)
+        self.models = set(models or ())
+        self.model_map = dict(model_map or {})
+        self.limits = dict(limits or {})
+
+    def serves(self, model):
+        return not self.models or model in self.models or model in self.model_map
+
+    def upstream_model(self, model):
+        return self.model_map.get(model, model)
+
+    def healthy(self, now):
+        return now >= self.cooldown_until
+
+    def score(self):
+        """越小越优先：首字延迟 × 错误率惩罚 ÷ 权重；还没有样本的上游先试一次"""
+        if self.ewma is None:
+            return 0.0
+        return self.ewma * (1 + 4 * self.error_rate) / self.weight
+
+    def record_success(self, ttft):
+        with self._lock:
+            self.ttfts.append(ttft)
+            self.ewma = ttft if self.ewma is None else self.ewma + EWMA_ALPHA * (ttft - self.ewma)
+            self.error_rate *= 1 - EWMA_ALPHA
+            self.failures = 0
+            self.cooldown_until = 0.0
+        ENDPOINT_TTFT.observe(ttft, self.name)
+        ATTEMPTS.inc(self.name, "ok")
+
+    def record_cancelled(self, waited):
+        """对冲落败被取消：已等待的时间是首字延迟的下限，按它更新延迟 (不算错误)"""
+        with self._lock:
+            self.ttfts.append(waited)
+            self.ewma = waited if self.ewma is None else max(self.ewma, waited)
+        ATTEMPTS.inc(self.name, "cancelled")
+
+    def record_failure(self, e, backoff, result="error"):
+        with self._lock:
+            self.error_rate += EWMA_ALPHA * (1 - self.error_rate)
+            self.failures += 1
+            delay = retry_after(e) or backoff * 2 ** (self.failures - 1)
+            self.cooldown_until = time.monotonic() + min(delay, MAX_COOLDOWN)
+        ATTEMPTS.inc(self.name, result)
+
+    def hedge_delay(self, minimum):
+        with self._lock:
+            samples = sorted(self.ttfts)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return max(HEDGE_DEFAULT_DELAY, minimum)
+        return max(samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))], minimum)
+
+    def snapshot(self, now):
+        with self._lock:
+            samples = sorted(self.ttfts)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))] if samples else None
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "healthy": self.healthy(now),
+            "ttft_ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "ttft_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "consecutive_failures": self.failures,
+        }
+
+
+class _Race:
+    """同步对冲时多个请求之间的协调：第一个拿到首字的胜出，其余的响应被关闭"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.done = False
+        self._responses = []
+
+    def track(self, response):
+        with self._lock:
+            if not self.done:
+                self._responses.append(response)
+                return
+        _close(response)
+
+    def finish(self, winner):
+        with self._lock:
+            self.done = True
+            losers = [r for r in self._responses if r is not winner]
+            self._responses = []
+        for r in losers:
+            _close(r)
+
+
+def _close(response):
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+class UpstreamRouter:
+    """多上游路由：为每个请求选择最快的健康上游，可重试错误时退避重试 / 换上游，
+    首字迟迟不来时可选地向另一个上游对冲，先开始输出的一方胜出。
+
+    上游来自 .env 里的主配置 (名为 default) 加上 endpoints.json；只有一个上游且不开启对冲时不启用。
+    """
+
+    def __init__(self, clients=None):
+        self.clients = clients if clients is not None else ClientRegistry()
+        self.endpoints = []
+        self.retries = DEFAULT_RETRIES
+        self.backoff = DEFAULT_BACKOFF
+        self.hedge = False
+        self.hedge_min = 0.0
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._hedges = 0
+
+    @property
+    def enabled(self):
+        return len(self.endpoints) > 1 or (self.hedge and bool(self.endpoints))
+
+    def configure(self, cfg):
+        """按配置快照重建上游列表；同名同地址的上游保留已有的延迟统计"""
+        entries = []
+        if cfg.base_url:
+            entries.append({"name": "default", "base_url": cfg.base_url, "api_key": cfg.api_key})
+        for i, e in enumerate(load_endpoints(cfg.endpoints_file)):
+            if any(x["base_url"] == e["base_url"] and x.get("api_key") == e.get("api_key", cfg.api_key) for x in entries):
+                continue
+            entries.append(dict(e, name=e.get("name") or f"endpoint-{i + 1}", api_key=e.get("api_key", cfg.api_key)))
+        old = {(ep.name, ep.base_url, ep.api_key): ep for ep in self.endpoints}
+        endpoints = []
+        for e in entries:
+            ep = old.get((e["name"], e["base_url"], e["api_key"]))
+            if ep is None:
+                ep = Endpoint(e["name"], e["base_url"], e["api_key"])
+            ep.update(e.get("weight", 1.0), e.get("models"), e.get("model_map"),
+                      {k: e[k] for k in ENDPOINT_LIMITS if k in e})
+            endpoints.append(ep)
+        self.endpoints = endpoints
+        self.retries = max(int(cfg.retry_max), 0)
+        self.backoff = max(float(cfg.retry_backoff_ms), 0.0) / 1000
+        self.hedge = bool(cfg.hedge)
+        self.hedge_min = max(float(cfg.hedge_min_ms), 0.0) / 1000
+
+    # ---------- 选择上游 ----------
+    def plan(self, model):
+        """按优先级排好的候选上游：健康的按得分排序，冷却中的按恢复时间排在最后"""
+        now = time.monotonic()
+        candidates = [ep for ep in self.endpoints if ep.serves(model)]
+        healthy = sorted((ep for ep in candidates if ep.healthy(now)), key=Endpoint.score)
+        if len(healthy) > 1 and random.random() < EXPLORE_RATE:
+            pick = random.choices(healthy, weights=[ep.weight for ep in healthy])[0]
+            healthy.remove(pick)
+            healthy.insert(0, pick)
+        cooling = sorted((ep for ep in candidates if not ep.healthy(now)), key=lambda ep: ep.cooldown_until)
+        return healthy + cooling
+
+    def _start_request(self, model, prefer=None):
+        plan = self.plan(model)
+        if not plan:
+            raise Exception(f"没有配置可以提供模型 {model} 的上游")
+        # 准入控制已经为请求选定了上游 (见 src.scheduler)：先发往它，失败时再按原顺序换上游
+        first = next((ep for ep in plan if ep.name == prefer), None)
+        if first is not None:
+            plan.remove(first)
+            plan.insert(0, first)
+        with self._lock:
+            self._requests += 1
+        return plan
+
+    def _allow_hedge(self):
+        with self._lock:
+            if self._hedges >= HEDGE_MAX_RATIO * self._requests + HEDGE_BURST:
+                return False
+            self._hedges += 1
+        HEDGES.inc("sent")
+        return True
+
+    def _retry_delay(self, rounds, error):
+        """第 rounds 轮重试前的等待时间：指数退避 + 抖动，服务端给了 Retry-After 时以它为准"""
+        hint = retry_after(error)
+        if hint is not None:
+            return min(hint, MAX_BACKOFF)
+        return random.uniform(0, min(self.backoff * 2 ** (rounds - 1), MAX_BACKOFF))
+
+    def _request(self, ep, kwargs):
+        return dict(kwargs, model=ep.upstream_model(kwargs["model"]))
+
+    # ---------- 同步 ----------
+    def open(self, kwargs, stream=True, prefer=None):
+        """发出请求 (含重试 / 对冲)，拿到第一段回复后返回逐段文本的迭代器；prefer 为优先使用的上游名
+
+        已经开始输出之后的错误无法重试，只计入上游的健康统计并向上抛出。
+        """
+        plan = self._start_request(kwargs["model"], prefer)
+        error = None
+        for attempt in range(self.retries + 1):
+            ep = plan[attempt % len(plan)]
+            if attempt:
+                RETRIES.inc(ep.name)
+                # 所有候选都试过一轮之后，再次请求同一个上游前先退避
+                if attempt >= len(plan):
+                    time.sleep(self._retry_delay(attempt // len(plan), error))
+            try:
+                if self.hedge:
+                    ep, first, rest = self._hedged(ep, plan, kwargs, stream)
+                else:
+                    ep, first, rest = self._attempt(ep, kwargs, stream)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+                continue
+            return self._follow(ep, first, rest)
+        raise error
+
+    def _attempt(self, ep, kwargs, stream, race=None):
+        """向一个上游发请求并等到第一段回复，返回 (上游, 第一段文本, 后续文本迭代器)"""
+        start = time.perf_counter()
+        try:
+            client = self.clients.get(ep.api_key, ep.base_url, max_retries=0)
+            response = client.chat.completions.create(**self._request(ep, kwargs))
+            if race is not None and stream:
+                race.track(response)
+            pieces = response_pieces(response, stream)
+            first = next(pieces, "")
+        except Exception as e:
+            if race is not None and race.done:
+                # 对冲落败后被关闭，已由 _hedged 记录
+                pass
+            else:
+                ep.record_failure(e, self.backoff)
+            metrics.add_span("attempt", start, time.perf_counter() - start, endpoint=ep.name,
+                             error=type(e).__name__)
+            raise
+        ep.record_success(time.perf_counter() - start)
+        metrics.add_span("attempt", start, time.perf_counter() - start, endpoint=ep.name)
+        return ep, first, _Pieces(pieces, response if stream else None)
+
+    def _hedged(self, ep, plan, kwargs, stream):
+        """先向 ep 发请求；超过它的 p95 首字延迟还没有回复时，再向下一个候选 (只有一个时仍是它) 发一份"""
+        results = queue.Queue()
+        race = _Race()
+
+        def run(index, target):
+            try:
+                results.put((index, self._attempt(target, kwargs, stream, race), None))
+            except Exception as e:
+                results.put((index, None, e))
+
+        launched = {}
+
+        def launch(index, target):
+            launched[index] = (target, time.perf_counter())
+            # 复制当前上下文，对冲线程里的 span 记到同一个请求上
+            ctx = contextvars.copy_context()
+            threading.Thread(target=ctx.run, args=(run, index, target), daemon=True).start()
+
+        launch(0, ep)
+        running, hedged, error = 1, False, None
+        delay = ep.hedge_delay(self.hedge_min)
+        while running:
+            try:
+                index, result, exc = results.get(timeout=None if hedged else delay)
+            except queue.Empty:
+                hedged = True
+                if self._allow_hedge():
+                    launch(1, next((x for x in plan if x is not ep), ep))
+                    running += 1
+                continue
+            running -= 1
+            target, started = launched.pop(index)
+            if exc is not None:
+                error = exc
+                continue
+            # 胜出：关闭另一个请求 (已经拿到的响应立即关闭，还在等待的拿到后关闭)
+            race.finish(result[2].response)
+            for loser, loser_started in launched.values():
+                loser.record_cancelled(time.perf_counter() - loser_started)
+            if index:
+                HEDGES.inc("won")
+            return result
+        raise error
+
+    def _follow(self, ep, first, rest):
+        if first:
+            yield first
+        try:
+            yield from rest
+        except Exception as e:
+            ep.record_failure(e, self.backoff, "broken")
+            raise
+
+    # ---------- 异步 ----------
+    async def aopen(self, kwargs, stream=True, prefer=None):
+        """open 的异步版本，返回异步迭代器"""
+        plan = self._start_request(kwargs["model"], prefer)
+        error = None
+        for attempt in range(self.retries + 1):
+            ep = plan[attempt % len(plan)]
+            if attempt:
+                RETRIES.inc(ep.name)
+                if attempt >= len(plan):
+                    await asyncio.sleep(self._retry_delay(attempt // len(plan), error))
+            try:
+                if self.hedge:
+                    ep, first, rest = await self._ahedged(ep, plan, kwargs, stream)
+                else:
+                    ep, first, rest = await self._aattempt(ep, kwargs, stream)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+                continue
+            return self._afollow(ep, first, rest)
+        raise error
+
+    async def _aattempt(self, ep, kwargs, stream):
+        start = time.perf_counter()
+        response = None
+        try:
+            client = self.clients.get_async(ep.api_key, ep.base_url, max_retries=0)
+            response = await client.chat.completions.create(**self._request(ep, kwargs))
+            pieces = aresponse_pieces(response, stream)
+            try:
+                first = await pieces.__anext__()
+            except StopAsyncIteration:
+                first = ""
+        except asyncio.CancelledError:
+            # 对冲中落败的请求被取消
+            ep.record_cancelled(time.perf_counter() - start)
+            if response is not None and stream:
+                await response.close()
+            raise
+        except Exception as e:
+            ep.record_failure(e, self.backoff)
+            metrics.add_span("attempt", start, time.perf_counter() - start, endpoint=ep.name,
+                             error=type(e).__name__)
+            raise
+        ep.record_success(time.perf_counter() - start)
+        metrics.add_span("attempt", start, time.perf_counter() - start, endpoint=ep.name)
+        return ep, first, _Pieces(pieces, response if stream else None)
+
+    async def _ahedged(self, ep, plan, kwargs, stream):
+        primary = asyncio.ensure_future(self._aattempt(ep, kwargs, stream))
+        tasks, hedged, error = {primary}, False, None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=None if hedged else ep.hedge_delay(self.hedge_min),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if self._allow_hedge():
+                        backup = next((x for x in plan if x is not ep), ep)
+                        tasks.add(asyncio.ensure_future(self._aattempt(backup, kwargs, stream)))
+                    continue
+                winner = None
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        # 同时完成的另一个请求用不上了
+                        await task.result()[2].aclose()
+                if winner is not None:
+                    if winner is not primary:
+                        HEDGES.inc("won")
+                    return winner.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _afollow(self, ep, first, rest):
+        if first:
+            yield first
+        try:
+            async for piece in rest:
+                yield piece
+        except Exception as e:
+            ep.record_failure(e, self.backoff, "broken")
+            raise
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = {"requests": self._requests, "hedges": self._hedges}
+        stats.update(enabled=self.enabled, hedge=self.hedge, retries=self.retries,
+                     endpoints=[ep.snapshot(now) for ep in self.endpoints])
+        return stats
+
+
+class _Pieces:
+    """第一段之后的文本迭代器，带着底层响应 (流式时) 以便关闭"""
+
+    def __init__(self, pieces, response):
+        self.pieces = pieces
+        self.response = response
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __aiter__(self):
+        return self.pieces.__aiter__()
+
+    async def aclose(self):
+        if self.response is not None:
+            await self.response.close()
@@ -0,0 +1,376 @@
+import time
+import bisect
+import asyncio
+import itertools
+import threading
+from src.metrics import metrics
+
+# 请求优先级：数字越小越先放行 (交互对话 > 标题 / 摘要等后台请求 > 批量处理)
+INTERACTIVE = 0
+BACKGROUND = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", BATCH: "batch"}
+# 没有多上游路由时，.env 里的主上游使用这个名字 (与 UpstreamRouter 一致)
+DEFAULT_ENDPOINT = "default"
+# 排队中的请求至少每隔这么久 (秒) 重新检查一次，限速的令牌补充不依赖其他请求结束
+POLL_INTERVAL = 1.0
+
+QUEUE_WAIT = metrics.histogram("upstream_queue_wait_seconds", "上游请求在准入队列里的等待时间", ("priority",))
+QUEUED = metrics.counter("upstream_queued_total", "需要排队的上游请求数", ("priority",))
+
+
+def parse_model_limits(value):
+    """解析 MY_MODEL_LIMITS："模型=并发:每分钟请求数:每分钟 token 数,..."，后两项可省略，0 表示不限"""
+    limits = {}
+    for item in (value or "").split(","):
+        model, sep, spec = item.strip().rpartition("=")
+        if not sep or not model.strip():
+            continue
+        numbers = [float(x) if x.strip() else 0.0 for x in spec.split(":")][:3]
+        limits[model.strip()] = tuple(numbers + [0.0] * (3 - len(numbers)))
+    return limits
+
+
+class TokenBucket:
+    """每分钟 rate 个令牌的令牌桶，桶容量也是 rate (允许一分钟内的突发)"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.level = self.rate
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.rate, self.level + (now - self._last) * self.rate / 60)
+        self._last = now
+
+    def wait_time(self, amount, now):
+        """还要等多久 (秒) 才够取 amount 个；超过桶容量的请求等桶满即可"""
+        self._refill(now)
+        amount = min(amount, self.rate)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.rate)
+
+    def give(self, amount):
+        self.level = min(self.rate, self.level + amount)
+
+
+class Limit:
+    """一个上游或一个模型的准入限制：并发上限 + 每分钟请求数 / token 数，0 表示不限"""
+
+    def __init__(self, concurrency=0, rpm=0, tpm=0):
+        self.active = 0
+        self.concurrency = 0
+        self.rpm = self.tpm = None
+        self.update(concurrency, rpm, tpm)
+
+    def update(self, concurrency=0, rpm=0, tpm=0):
+        # 限速值没变时保留桶里的余量
+        self.concurrency = max(int(concurrency or 0), 0)
+        if not rpm or rpm <= 0:
+            self.rpm = None
+        elif self.rpm is None or self.rpm.rate != float(rpm):
+            self.rpm = TokenBucket(rpm)
+        if not tpm or tpm <= 0:
+            self.tpm = None
+        elif self.tpm is None or self.tpm.rate != float(tpm):
+            self.tpm = TokenBucket(tpm)
+
+    @property
+    def unlimited(self):
+        return not self.concurrency and self.rpm is None and self.tpm is None
+
+    def wait_time(self, tokens, now):
+        """0 表示可以放行；并发已满时返回 None (等其他请求结束)，否则返回限速需要等待的秒数"""
+        if self.concurrency and self.active >= self.concurrency:
+            return None
+        wait = 0.0
+        if self.rpm is not None:
+            wait = max(wait, self.rpm.wait_time(1, now))
+        if self.tpm is not None:
+            wait = max(wait, self.tpm.wait_time(tokens, now))
+        return wait
+
+    def take(self, tokens):
+        self.active += 1
+        if self.rpm is not None:
+            self.rpm.take(1)
+        if self.tpm is not None:
+            self.tpm.take(tokens)
+
+    def release(self, refund):
+        self.active -= 1
+        if self.tpm is not None and refund > 0:
+            self.tpm.give(refund)
+
+    def snapshot(self):
+        return {
+            "active": self.active,
+            "concurrency": self.concurrency or None,
+            "rpm": self.rpm.rate if self.rpm else None,
+            "rpm_available": round(self.rpm.level, 1) if self.rpm else None,
+            "tpm": self.tpm.rate if self.tpm else None,
+            "tpm_available": round(self.tpm.level) if self.tpm else None,
+        }
+
+
+class Ticket:
+    """已放行的请求：记住占用的限制和预留的 token 数，结束时归还"""
+
+    def __init__(self, endpoint, model, tokens, limits):
+        self.endpoint = endpoint
+        self.model = model
+        self.tokens = tokens
+        self.limits = limits
+        self.released = False
+
+
+class _Waiter:
+    def __init__(self, seq, model, endpoints, tokens, priority):
+        self.key = (priority, seq)
+        self.model = model
+        self.endpoints = endpoints
+        self.tokens = tokens
+        self.priority = priority
+        self.start = time.perf_counter()
+        self.ticket = None
+        self.wake = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class Scheduler:
+    """上游准入控制：按上游和模型限制并发数、每分钟请求数和 token 数，超出时按优先级排队
+
+    交互对话优先于后台请求和批量处理；同优先级先到先得。排在前面的请求等待某个上游 / 模型时，
+    后面的请求不会抢占同一份额度，但可以使用其他空闲的上游。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiters = []
+        self._inflight = 0
+        self._endpoints = {}
+        self._models = {}
+        # 排队中的请求可能因为令牌补充而放行的时刻 (time.monotonic())，None 表示只能等其他请求结束
+        self._retry_at = None
+
+    def configure(self, cfg, endpoints=()):
+        """按配置快照设置限制：主上游用 MY_MAX_CONCURRENCY / MY_RATE_RPM / MY_RATE_TPM，
+        endpoints.json 里的上游可以用 max_concurrency / rpm / tpm 单独覆盖，模型限制来自 MY_MODEL_LIMITS"""
+        default = (cfg.max_concurrency, cfg.rate_rpm, cfg.rate_tpm)
+        specs = {DEFAULT_ENDPOINT: default}
+        for ep in endpoints:
+            extra = getattr(ep, "limits", None) or {}
+            specs[ep.name] = (extra.get("max_concurrency", default[0]), extra.get("rpm", default[1]),
+                              extra.get("tpm", default[2]))
+        with self._lock:
+            self._endpoints = self._rebuild(self._endpoints, specs)
+            self._models = self._rebuild(self._models, parse_model_limits(cfg.model_limits))
+            self._dispatch()
+
+    @staticmethod
+    def _rebuild(old, specs):
+        # 同名的限制原地更新，保留进行中的请求计数；被移除的限制由持有它的 Ticket 归还后自然释放
+        limits = {}
+        for name, spec in specs.items():
+            limit = old.get(name)
+            if limit is None:
+                limit = Limit(*spec)
+            else:
+                limit.update(*spec)
+            limits[name] = limit
+        return limits
+
+    # ---------- 放行 ----------
+    def _limits(self, endpoint, model):
+        limits = [self._endpoints.get(endpoint), self._models.get(model)]
+        return [l for l in limits if l is not None and not l.unlimited]
+
+    def _try(self, waiter, blocked, now):
+        """尝试为 waiter 选一个上游放行；返回 (是否放行, 涉及的限制, 最短的限速等待)"""
+        involved, retry = [], None
+        for endpoint in waiter.endpoints:
+            limits = self._limits(endpoint, waiter.model)
+            involved.extend(limits)
+            if any(id(l) in blocked for l in limits):
+                continue
+            waits = [l.wait_time(waiter.tokens, now) for l in limits]
+            if all(w == 0 for w in waits):
+                for l in limits:
+                    l.take(waiter.tokens)
+                self._inflight += 1
+                waiter.ticket = Ticket(endpoint, waiter.model, waiter.tokens, limits)
+                return True, involved, None
+            if None not in waits:
+                wait = max(waits)
+                retry = wait if retry is None else min(retry, wait)
+        return False, involved, retry
+
+    def _dispatch(self):
+        """按优先级放行能放行的请求 (持有锁时调用)，只唤醒被放行的请求
+
+        其他排队者的位置变化不逐个唤醒 (队列很长时那是每次放行 O(n²) 的开销)，它们最多 POLL_INTERVAL 后自己刷新。
+        """
+        now = time.monotonic()
+        blocked, retry, remaining = set(), None, []
+        for waiter in self._waiters:
+            admitted, involved, wait = self._try(waiter, blocked, now)
+            if admitted:
+                continue
+            remaining.append(waiter)
+            # 后面优先级更低的请求不能抢走它在等的额度
+            blocked.update(id(l) for l in involved)
+            if wait is not None:
+                retry = wait if retry is None else min(retry, wait)
+        woken = [w for w in self._waiters if w.ticket is not None]
+        self._waiters = remaining
+        self._retry_at = now + retry if retry is not None else None
+        for waiter in woken:
+            if waiter.wake is not None:
+                waiter.wake()
+
+    def _enqueue(self, model, endpoints, tokens, priority):
+        waiter = _Waiter(next(self._seq), model, list(endpoints) or [DEFAULT_ENDPOINT], tokens, priority)
+        with self._lock:
+            if not self._waiters:
+                # 没有人排队时直接尝试放行，不进入队列
+                admitted, _, _ = self._try(waiter, set(), time.monotonic())
+                if admitted:
+                    return waiter
+            bisect.insort(self._waiters, waiter)
+            self._dispatch()
+        if waiter.ticket is None:
+            QUEUED.inc(PRIORITY_NAMES[priority])
+        return waiter
+
+    def _position(self, waiter):
+        """返回 (排队位置 (从 1 开始，已放行为 0), 下次重新检查前最多等待的秒数)"""
+        with self._lock:
+            now = time.monotonic()
+            # 只有令牌可能已经补充时才重新放行一轮；并发名额由 release 放行，不需要每个排队者各扫一遍队列
+            if waiter.ticket is None and self._retry_at is not None and now >= self._retry_at:
+                self._dispatch()
+            if waiter.ticket is not None:
+                return 0, None
+            timeout = POLL_INTERVAL
+            if self._retry_at is not None:
+                timeout = min(max(self._retry_at - now, 0.0), POLL_INTERVAL)
+            return bisect.bisect_left(self._waiters, waiter) + 1, timeout
+
+    def _admitted(self, waiter, on_wait, reported):
+        QUEUE_WAIT.observe(time.perf_counter() - waiter.start, PRIORITY_NAMES[waiter.priority])
+        if reported and on_wait is not None:
+            on_wait(0)
+        return waiter.ticket
+
+    def acquire(self, model, endpoints=(), tokens=0, priority=INTERACTIVE, on_wait=None):
+        """阻塞到请求被放行，返回 Ticket；排队期间位置变化时调用 on_wait(位置)，放行时调用 on_wait(0)"""
+        waiter = self._enqueue(model, endpoints, tokens, priority)
+        event = threading.Event()
+        waiter.wake = event.set
+        reported = None
+        try:
+            while True:
+                event.clear()
+                position, timeout = self._position(waiter)
+                if not position:
+                    return self._admitted(waiter, on_wait, reported)
+                if position != reported:
+                    reported = position
+                    if on_wait is not None:
+                        on_wait(position)
+                event.wait(timeout)
+        except BaseException:
+            # 排队期间出错 / 被中断 (on_wait 抛出异常、KeyboardInterrupt)：离开队列，已被放行时归还额度
+            self._abandon(waiter)
+            raise
+
+    async def aacquire(self, model, endpoints=(), tokens=0, priority=INTERACTIVE, on_wait=None):
+        """acquire 的异步版本：由放行方通过事件循环唤醒，不占用线程"""
+        waiter = self._enqueue(model, endpoints, tokens, priority)
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter.wake = lambda: loop.call_soon_threadsafe(event.set)
+        reported = None
+        try:
+            while True:
+                event.clear()
+                position, timeout = self._position(waiter)
+                if not position:
+                    return self._admitted(waiter, on_wait, reported)
+                if position != reported:
+                    reported = position
+                    if on_wait is not None:
+                        on_wait(position)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # 排队期间被取消 (客户端断开) 或出错：离开队列；恰好已被放行时归还额度
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter):
+        """放弃排队：从队列中移除并重新放行一轮 (它可能挡着后面的请求)；已拿到的 Ticket 归还"""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._dispatch()
+        if waiter.ticket is not None:
+            self.release(waiter.ticket)
+
+    def release(self, ticket, used_tokens=None):
+        """请求结束：归还并发名额；used_tokens 小于预留值时把多预留的 token 退回桶里"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            refund = ticket.tokens - used_tokens if used_tokens is not None else 0
+            for limit in ticket.limits:
+                limit.release(refund)
+            self._inflight -= 1
+            if self._waiters:
+                self._dispatch()
+
+    def slot(self, model, endpoints=(), tokens=0, priority=INTERACTIVE):
+        """with scheduler.slot(...) as ticket：非流式请求用的放行上下文"""
+        return _Slot(self, model, endpoints, tokens, priority)
+
+    # ---------- 指标 ----------
+    def depth(self):
+        with self._lock:
+            return len(self._waiters)
+
+    def inflight(self):
+        return self._inflight
+
+    def snapshot(self):
+        with self._lock:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for w in self._waiters:
+                queued[PRIORITY_NAMES[w.priority]] += 1
+            return {
+                "queued": queued,
+                "endpoints": {name: l.snapshot() for name, l in self._endpoints.items()},
+                "models": {name: l.snapshot() for name, l in self._models.items()},
+            }
+
+
+class _Slot:
+    def __init__(self, scheduler, model, endpoints, tokens, priority):
+        self.scheduler = scheduler
+        self.args = (model, endpoints, tokens, priority)
+        self.ticket = None
+
+    def __enter__(self):
+        self.ticket = self.scheduler.acquire(*self.args)
+        return self.ticket
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.ticket)
+        return False
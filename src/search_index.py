@@ -0,0 +1,199 @@
+import os
+import re
+import html
+import sqlite3
+import threading
+
+SEARCH_DB_FILENAME = "search.db"
+# 片段长度：命中位置前后各保留多少个字符
+SNIPPET_RADIUS = 40
+# 只索引用户和 AI 的消息 (system 是角色设定，不参与搜索)
+INDEXED_ROLES = ("user", "assistant")
+
+# 中日韩文字 (不含全角标点，标点作为分隔符)
+_CJK = r'぀-ヿ㐀-䶿一-鿿가-힯'
+_TOKEN_RE = re.compile(rf'[{_CJK}]+|[^\W{_CJK}]+', re.UNICODE)
+_CJK_RUN_RE = re.compile(rf'[{_CJK}]+')
+_QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _split(text):
+    """切成 (片段, 是否中日韩) 序列：中日韩连续字符为一段，其他按单词切分"""
+    for m in _TOKEN_RE.finditer(text):
+        word = m.group(0)
+        yield word, bool(_CJK_RUN_RE.fullmatch(word))
+
+
+def tokenize(text):
+    """索引用分词：中日韩按二元组切分，并补上每段的最后一个字；其他语言按小写单词切分
+
+    例如 "机器学习" -> 机器 器学 学习 习。
+    补上末字后，任意单字一定是某个词元的开头，单字查询可以用前缀匹配。
+    """
+    tokens = []
+    for word, cjk in _split(text or ""):
+        if cjk:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            tokens.append(word[-1])
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def _quote(token):
+    return '"' + token.replace('"', '""') + '"'
+
+
+def build_match(query):
+    """把用户输入转换成 FTS5 查询，返回 (MATCH 表达式, 用于高亮的原始词列表)
+
+    - 空格分隔的多个词之间为 AND
+    - "双引号" 内为短语查询
+    - 以 * 结尾为前缀查询 (如 pyth*)
+    - 中日韩词按二元组组成短语；单个汉字按前缀匹配
+    """
+    clauses, terms = [], []
+    for m in _QUERY_RE.finditer(query or ""):
+        raw = m.group(1) if m.group(1) is not None else m.group(2)
+        prefix = raw.endswith("*")
+        raw = raw.rstrip("*")
+        parts = list(_split(raw))
+        if not parts:
+            continue
+        terms.append(raw)
+        tokens = []
+        for word, cjk in parts:
+            if cjk:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1) if len(word) > 1)
+                if len(word) == 1:
+                    tokens.append(word)
+            else:
+                tokens.append(word.lower())
+        last_single = parts[-1][1] and len(parts[-1][0]) == 1
+        phrase = _quote(" ".join(tokens))
+        if prefix or last_single:
+            phrase += "*"
+        clauses.append(phrase)
+    return " AND ".join(clauses), terms
+
+
+def make_snippet(text, terms, radius=SNIPPET_RADIUS):
+    """截取第一个命中位置附近的片段，HTML 转义后用 <mark> 标出命中的词"""
+    text = text or ""
+    if terms:
+        pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+        first = pattern.search(text)
+    else:
+        pattern, first = None, None
+    start = max(first.start() - radius, 0) if first else 0
+    end = min((first.end() if first else 0) + radius, len(text))
+    piece = text[start:end]
+    out, pos = [], 0
+    if pattern is not None:
+        for m in pattern.finditer(piece):
+            out.append(html.escape(piece[pos:m.start()]))
+            out.append("<mark>" + html.escape(m.group(0)) + "</mark>")
+            pos = m.end()
+    out.append(html.escape(piece[pos:]))
+    return ("…" if start > 0 else "") + "".join(out) + ("…" if end < len(text) else "")
+
+
+class SearchIndex:
+    """对话内容的全文索引 (SQLite FTS5，中日韩按二元组分词)
+
+    save_chat 时增量追加新消息；消息被改写 (数量变少或内容对不上) 时整段重建该对话。
+    """
+
+    def __init__(self, history_dir):
+        self.db_path = os.path.join(history_dir, SEARCH_DB_FILENAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " rowid INTEGER PRIMARY KEY,"
+            " chat_id TEXT,"
+            " idx INTEGER,"
+            " role TEXT,"
+            " content TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, idx)")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(tokens)")
+        # 每个对话已索引的消息数，以及最后一条已索引消息的内容 (用来发现改写)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_chats ("
+            " chat_id TEXT PRIMARY KEY,"
+            " count INTEGER,"
+            " last_content TEXT)"
+        )
+        self._conn.commit()
+
+    # ---------- 写入 ----------
+    def update(self, chat_id, messages, missing_only=False):
+        """把对话中尚未索引的消息加入索引；missing_only 时已经索引过的对话不动 (后台补建用，读到的可能是旧内容)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT count, last_content FROM indexed_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row and missing_only:
+                return
+            start = 0
+            if row:
+                count, last_content = row
+                if count <= len(messages) and (count == 0 or (messages[count - 1].get("content") or "") == last_content):
+                    start = count
+                else:
+                    self._delete(chat_id)
+            if start == len(messages) and row:
+                return
+            for i in range(start, len(messages)):
+                m = messages[i]
+                content = m.get("content") or ""
+                if m.get("role") not in INDEXED_ROLES or not isinstance(content, str) or not content:
+                    continue
+                cur = self._conn.execute(
+                    "INSERT INTO messages (chat_id, idx, role, content) VALUES (?, ?, ?, ?)",
+                    (chat_id, i, m.get("role"), content))
+                self._conn.execute(
+                    "INSERT INTO messages_fts (rowid, tokens) VALUES (?, ?)",
+                    (cur.lastrowid, " ".join(tokenize(content))))
+            last = (messages[-1].get("content") or "") if messages else ""
+            self._conn.execute(
+                "INSERT OR REPLACE INTO indexed_chats (chat_id, count, last_content) VALUES (?, ?, ?)",
+                (chat_id, len(messages), last if isinstance(last, str) else ""))
+            self._conn.commit()
+
+    def _delete(self, chat_id):
+        self._conn.execute(
+            "DELETE FROM messages_fts WHERE rowid IN (SELECT rowid FROM messages WHERE chat_id = ?)", (chat_id,))
+        self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        self._conn.execute("DELETE FROM indexed_chats WHERE chat_id = ?", (chat_id,))
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._delete(chat_id)
+            self._conn.commit()
+
+    def indexed_ids(self):
+        with self._lock:
+            return {r[0] for r in self._conn.execute("SELECT chat_id FROM indexed_chats")}
+
+    # ---------- 查询 ----------
+    def search(self, query, offset=0, limit=20):
+        """返回按相关度 (bm25) 排序的命中消息列表，每条带高亮片段"""
+        match, terms = build_match(query)
+        if not match:
+            return []
+        sql = ("SELECT m.chat_id, m.idx, m.role, m.content, bm25(messages_fts) AS score"
+               " FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid"
+               " WHERE messages_fts MATCH ? ORDER BY score LIMIT ? OFFSET ?")
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, (match, int(limit), int(offset))).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"❌ 搜索语法错误: {e}")
+                return []
+        return [{
+            "chat_id": r[0], "index": r[1], "role": r[2],
+            "snippet": make_snippet(r[3], terms), "score": round(-r[4], 4)
+        } for r in rows]
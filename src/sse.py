@@ -0,0 +1,149 @@
+import json
+import time
+import queue
+import asyncio
+import threading
+import contextvars
+
+# 合并上游增量的默认参数：距上次发送超过这么多毫秒，或积攒的文本超过这么多字节就发送一帧
+DEFAULT_FLUSH_MS = 50
+DEFAULT_FLUSH_BYTES = 1024
+# 读取线程放进队列的结束标记
+_END = object()
+
+
+def format_event(payload, event=None, event_id=None):
+    """一帧 SSE 数据 (字符串)；event 为事件名 (默认 message)，event_id 供客户端断线重连时回传"""
+    head = ""
+    if event_id is not None:
+        head += f"id: {event_id}\n"
+    if event:
+        head += f"event: {event}\n"
+    return f"{head}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class DeltaCoalescer:
+    """把上游逐字返回的增量合并成较少的 SSE 帧
+
+    第一段增量立即发送 (不影响首字延迟)；之后距上次发送不足 flush_ms 的增量先攒着，
+    超过时间或字节阈值时一次发出。flush_ms 为 0 时不合并。
+    """
+
+    def __init__(self, flush_ms=DEFAULT_FLUSH_MS, flush_bytes=DEFAULT_FLUSH_BYTES):
+        self.interval = max(float(flush_ms), 0.0) / 1000
+        self.max_bytes = int(flush_bytes)
+        self._parts = []
+        self._bytes = 0
+        self._last_flush = 0.0
+
+    def add(self, text):
+        """加入一段增量，需要发送时返回合并后的文本，否则返回 None"""
+        self._parts.append(text)
+        self._bytes += len(text.encode('utf-8'))
+        if self._bytes >= self.max_bytes or time.monotonic() - self._last_flush >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """取出攒着的文本 (没有时返回 None)"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._bytes = 0
+        self._last_flush = time.monotonic()
+        return text
+
+    def remaining(self):
+        """距下一次按时间发送还剩多少秒 (没有攒着的文本时返回 None)"""
+        if not self._parts:
+            return None
+        return max(self.interval - (time.monotonic() - self._last_flush), 0.0)
+
+
+def coalesce(chunks, flush_ms=DEFAULT_FLUSH_MS, flush_bytes=DEFAULT_FLUSH_BYTES):
+    """同步版本：上游在单独的读取线程里迭代，停顿期间也按 flush_ms 定时发出攒着的文本
+
+    调用方提前停止读取时，读取线程在收到下一段增量后关闭上游迭代器。
+    """
+    buf = DeltaCoalescer(flush_ms, flush_bytes)
+    if buf.interval <= 0:
+        # 不合并：逐段直接发出，不需要读取线程
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+        return
+    pieces = queue.Queue()
+    stop = threading.Event()
+
+    def read():
+        try:
+            for chunk in chunks:
+                pieces.put((chunk, None))
+                if stop.is_set():
+                    close = getattr(chunks, "close", None)
+                    if close is not None:
+                        close()
+                    return
+        except BaseException as e:
+            pieces.put((_END, e))
+            return
+        pieces.put((_END, None))
+
+    # 读取线程沿用当前的 contextvars (指标 span、路由状态等)
+    threading.Thread(target=contextvars.copy_context().run, args=(read,), daemon=True).start()
+    try:
+        while True:
+            try:
+                chunk, error = pieces.get(timeout=buf.remaining())
+            except queue.Empty:
+                # 等待上游期间到了发送时间
+                text = buf.flush()
+                if text:
+                    yield text
+                continue
+            if chunk is _END:
+                text = buf.flush()
+                if text:
+                    yield text
+                if error is not None:
+                    raise error
+                return
+            text = buf.add(chunk)
+            if text:
+                yield text
+    finally:
+        stop.set()
+
+
+async def acoalesce(chunks, flush_ms=DEFAULT_FLUSH_MS, flush_bytes=DEFAULT_FLUSH_BYTES):
+    """异步版本：上游停顿时按 flush_ms 定时发出攒着的文本"""
+    buf = DeltaCoalescer(flush_ms, flush_bytes)
+    it = chunks.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=buf.remaining())
+            if not done:
+                # 等待上游期间到了发送时间
+                text = buf.flush()
+                if text:
+                    yield text
+                continue
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+            text = buf.add(chunk)
+            if text:
+                yield text
+        text = buf.flush()
+        if text:
+            yield text
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,589 @@
+import os
+import json
+import queue
+import threading
+from src.metrics import metrics
+from src.compression import (DictionaryStore, encode_snapshot, read_footer, read_messages,
+                             train_dictionary, TRAIN_SAMPLE_BYTES, MIN_TRAIN_BYTES)
+from src.prompt_store import PromptStore
+
+# 日志累计超过这些阈值后，后台合并成新的快照
+COMPACT_RECORDS = 64
+COMPACT_BYTES = 256 * 1024
+# 从快照末尾往回读消息时每次读取的块大小
+READ_BLOCK = 64 * 1024
+# 压缩快照使用的预置字典保存在历史目录下的这个子目录
+DICT_DIR = "dicts"
+# 按内容哈希共享的 system 提示词保存在历史目录下的这个子目录
+PROMPT_DIR = "prompts"
+
+
+def _dump_line(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+def _split_meta(data):
+    """把对话数据拆成 元数据 + 消息列表"""
+    return {k: v for k, v in data.items() if k != "messages"}, data.get("messages", [])
+
+
+def _window_bounds(total, before, limit):
+    """before 之前 (不传则到末尾) 的最后 limit 条消息的序号范围 [start, before)"""
+    before = total if before is None else max(0, min(before, total))
+    return max(0, before - max(limit, 1)), before
+
+
+def message_window(data, before=None, limit=50):
+    """从完整对话数据里取一页消息：元数据 + messages (这一页) + start (第一条的序号) + total"""
+    meta, messages = _split_meta(data)
+    start, before = _window_bounds(len(messages), before, limit)
+    return dict(meta, messages=messages[start:before], start=start, total=len(messages))
+
+
+def _read_lines_before(f, pos, n):
+    """从二进制文件的 pos (行首) 往回读 n 个整行，返回 (各行, 第一行的起始偏移)"""
+    if n <= 0:
+        return [], pos
+    end = pos
+    chunks, newlines = [], 0
+    # pos 不在文件开头时，读到的第一段可能不是整行，所以要多读到一个换行符
+    while pos > 0 and newlines <= n:
+        step = min(READ_BLOCK, pos)
+        pos -= step
+        f.seek(pos)
+        block = f.read(step)
+        chunks.append(block)
+        newlines += block.count(b"\n")
+    lines = b"".join(reversed(chunks)).split(b"\n")[:-1][-n:]
+    return lines, end - sum(len(line) + 1 for line in lines)
+
+
+def _atomic_write(path, text):
+    """先写临时文件再 rename，崩溃时不会留下半截文件；返回写入的字节数"""
+    tmp = path + ".tmp"
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(data)
+
+
+# 后台合并快照写入的字节数 (save_chat 等前台写入由 HistoryManager 记录)
+COMPACT_BYTES_WRITTEN = metrics.counter("history_bytes_written_total", "对话存储写入的字节数", ("op",))
+
+
+class JsonFileStorage:
+    """旧的存储方式：每个对话一个格式化的 JSON 文件，每次保存整体重写 (不支持压缩)"""
+
+    def __init__(self, history_dir, compress=False):
+        self.history_dir = history_dir
+
+    def _path(self, chat_id):
+        return os.path.join(self.history_dir, f"{chat_id}.json")
+
+    def save(self, chat_id, data):
+        """整体重写对话文件，返回写入的字节数"""
+        text = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+        with open(self._path(chat_id), 'wb') as f:
+            f.write(text)
+        return len(text)
+
+    def load(self, chat_id):
+        path = self._path(chat_id)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return None
+
+    def load_window(self, chat_id, before=None, limit=50):
+        # 旧格式是一整个 JSON，只能读完再切片
+        data = self.load(chat_id)
+        return message_window(data, before, limit) if data else None
+
+    def update_meta(self, chat_id, fields):
+        data = self.load(chat_id)
+        if data:
+            data.update(fields)
+            return self.save(chat_id, data)
+        return 0
+
+    def delete(self, chat_id):
+        path = self._path(chat_id)
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def read_meta(self, chat_id):
+        data = self.load(chat_id)
+        return _split_meta(data)[0] if data else None
+
+    def signature(self, chat_id):
+        try:
+            st = os.stat(self._path(chat_id))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def scan(self):
+        """返回 {chat_id: (mtime_ns, size)}，只 stat 不读内容"""
+        result = {}
+        with os.scandir(self.history_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    result[entry.name[:-5]] = (st.st_mtime_ns, st.st_size)
+        return result
+
+
+class JournalStorage:
+    """追加日志存储：快照 + 每个对话一个 JSONL 日志
+
+    - <id>.snapshot.jsonl：第一行是元数据头，之后每行一条消息
+    - <id>.journal.jsonl：每轮追加新消息 ({"i": 序号, "m": 消息}) 和元数据 ({"meta": {...}})
+    保存只追加新增的消息，日志过大时由后台线程合并成新快照 (原子 rename)。
+    读取到旧版 <id>.json 时自动迁移。
+
+    compress 时快照写成 <id>.snapshot.z (按帧压缩，见 src/compression.py)；两种快照都能读取，
+    未压缩的快照在下次合并时换成当前格式。
+
+    较长的 system 消息只写 {"role": "system", "prompt_ref": 哈希}，内容存在 prompts/ 下 (见 src/prompt_store.py)；
+    内联着完整提示词的旧对话在下次保存时整体改写 (读取时不写盘)。
+    """
+
+    SNAPSHOT_SUFFIX = ".snapshot.jsonl"
+    COMPRESSED_SUFFIX = ".snapshot.z"
+    JOURNAL_SUFFIX = ".journal.jsonl"
+    LEGACY_SUFFIX = ".json"
+
+    def __init__(self, history_dir, compress=False):
+        self.history_dir = history_dir
+        self.compress = compress
+        # 关闭压缩后也要能读取已经压缩的快照
+        self.dicts = DictionaryStore(os.path.join(history_dir, DICT_DIR))
+        self.prompts = PromptStore(os.path.join(history_dir, PROMPT_DIR))
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        # chat_id -> 已落盘的状态 {"count", "digest", "records", "bytes", "inline": 是否还是内联提示词的旧格式}
+        self._state = {}
+        # chat_id -> (快照的 (mtime_ns, 大小), {消息序号: 该消息在快照里的字节偏移})
+        # 记录读过的分页位置，向前翻页时从上一页的位置接着往回读
+        self._offsets = {}
+        self._pending = set()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._compact_worker, daemon=True).start()
+        if compress and not self.dicts.trained():
+            # 还没有训练过字典：后台用已有对话训练，样本不够时继续用内置种子字典
+            threading.Thread(target=self._train_worker, daemon=True).start()
+
+    # ---------- 路径与锁 ----------
+    def _snapshot_path(self, chat_id):
+        return os.path.join(self.history_dir, chat_id + self.SNAPSHOT_SUFFIX)
+
+    def _compressed_path(self, chat_id):
+        return os.path.join(self.history_dir, chat_id + self.COMPRESSED_SUFFIX)
+
+    def _journal_path(self, chat_id):
+        return os.path.join(self.history_dir, chat_id + self.JOURNAL_SUFFIX)
+
+    def _legacy_path(self, chat_id):
+        return os.path.join(self.history_dir, chat_id + self.LEGACY_SUFFIX)
+
+    def _lock(self, chat_id):
+        with self._locks_guard:
+            lock = self._locks.get(chat_id)
+            if lock is None:
+                lock = self._locks[chat_id] = threading.RLock()
+            return lock
+
+    # ---------- 写入 ----------
+    def save(self, chat_id, data):
+        """保存对话，返回写入的字节数"""
+        with self._lock(chat_id):
+            # 在锁内读取元数据，与并发的 update_meta (如后台写标题) 保持先后顺序
+            meta, messages = _split_meta(data)
+            state = self._state.get(chat_id)
+            if state is None:
+                # 本进程内第一次保存：读一遍磁盘上的状态 (或迁移旧文件)
+                self._load_locked(chat_id)
+                state = self._state.get(chat_id)
+
+            if state is None or state.get("inline") or not self._is_prefix(state, messages):
+                # 新对话、历史消息被改动 (例如切换角色替换了 system)，或者旧格式的对话：整体写快照
+                return self._write_snapshot(chat_id, meta, messages)
+
+            lines = [_dump_line({"i": i, "m": self.prompts.encode(messages[i])})
+                     for i in range(state["count"], len(messages))]
+            lines.append(_dump_line({"meta": meta}))
+            written = self._append(chat_id, state, "".join(lines), len(lines))
+            state.update(self._fingerprint(messages))
+            return written
+
+    def update_meta(self, chat_id, fields):
+        """只追加一条元数据记录，不重写对话内容"""
+        with self._lock(chat_id):
+            if not self._exists(chat_id):
+                return 0
+            state = self._state.get(chat_id)
+            if state is None:
+                self._load_locked(chat_id)
+                state = self._state[chat_id]
+            line = _dump_line({"meta": fields})
+            return self._append(chat_id, state, line, 1)
+
+    def _append(self, chat_id, state, text, n_records):
+        data = text.encode('utf-8')
+        with open(self._journal_path(chat_id), 'ab') as f:
+            f.write(data)
+        state["records"] += n_records
+        state["bytes"] += len(data)
+        if state["records"] >= COMPACT_RECORDS or state["bytes"] >= COMPACT_BYTES:
+            self._schedule_compaction(chat_id)
+        return len(data)
+
+    @staticmethod
+    def _message_key(message):
+        # 只比较角色和内容；消息上的其他字段变化不算改动
+        content = message.get("content")
+        if not isinstance(content, (str, type(None))):
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        return message.get("role"), content
+
+    @classmethod
+    def _digest(cls, messages):
+        # 所有已落盘消息的角色和内容合成一个哈希 (只在本进程内比较)：中间任何一条被改动都能发现，
+        # 又不用为每个读过的对话留着全部内容；字符串的哈希有缓存，重复计算很便宜
+        return hash(tuple(cls._message_key(m) for m in messages))
+
+    @classmethod
+    def _fingerprint(cls, messages):
+        return {"count": len(messages), "digest": cls._digest(messages)}
+
+    @classmethod
+    def _is_prefix(cls, state, messages):
+        count = state["count"]
+        if len(messages) < count:
+            return False
+        return cls._digest(messages[:count]) == state["digest"]
+
+    def _write_snapshot(self, chat_id, meta, messages):
+        header = dict(meta)
+        header["count"] = len(messages)
+        lines = [_dump_line(self.prompts.encode(m)) for m in messages]
+        if self.compress:
+            dict_id, zdict = self.dicts.current()
+            path, other = self._compressed_path(chat_id), self._snapshot_path(chat_id)
+            written = _atomic_write(path, encode_snapshot(header, lines, dict_id, zdict))
+        else:
+            path, other = self._snapshot_path(chat_id), self._compressed_path(chat_id)
+            written = _atomic_write(path, _dump_line({"meta": header}) + "".join(lines))
+        # 快照已包含全部内容，日志和另一种格式的旧快照可以删掉
+        for path in (self._journal_path(chat_id), self._legacy_path(chat_id), other):
+            if os.path.exists(path):
+                os.remove(path)
+        self._state[chat_id] = dict(self._fingerprint(messages), records=0, bytes=0)
+        self._offsets.pop(chat_id, None)
+        return written
+
+    # ---------- 读取 ----------
+    def load(self, chat_id):
+        with self._lock(chat_id):
+            return self._load_locked(chat_id)
+
+    def _decode(self, messages):
+        """把读到的消息里的提示词引用换回内容；返回是否还有内联着长提示词的旧格式消息"""
+        inline = False
+        for m in messages:
+            # 旧版本把 token 数缓存 (_tokens) 写进了消息，读取时去掉，不返回给前端
+            for k in [k for k in m if k.startswith("_")]:
+                del m[k]
+            inline = self.prompts.decode(m) or inline
+        return inline
+
+    def _load_locked(self, chat_id):
+        compressed = self._compressed_path(chat_id)
+        snapshot = self._snapshot_path(chat_id)
+        meta, messages = {}, []
+        if os.path.exists(compressed):
+            with open(compressed, 'rb') as f:
+                footer = read_footer(f)
+                messages = read_messages(f, footer, self.dicts.get(footer["dict"]))
+            meta = footer["meta"]
+            meta.pop("count", None)
+        elif os.path.exists(snapshot):
+            with open(snapshot, 'r', encoding='utf-8') as f:
+                for n, line in enumerate(f):
+                    if n == 0:
+                        meta = json.loads(line)["meta"]
+                        meta.pop("count", None)
+                    else:
+                        messages.append(json.loads(line))
+        else:
+            return self._migrate_legacy(chat_id)
+
+        records, size = self._replay_journal(chat_id, meta, messages)
+        # 还内联着长提示词的旧对话：下次保存时整体改写快照 (读取时不写盘)
+        inline = self._decode(messages)
+        self._state[chat_id] = dict(self._fingerprint(messages), records=records, bytes=size, inline=inline)
+        data = dict(meta)
+        data["messages"] = messages
+        return data
+
+    def _replay_journal(self, chat_id, meta, messages):
+        """把日志尾部重放到快照上，返回 (记录数, 字节数)"""
+        journal = self._journal_path(chat_id)
+        if not os.path.exists(journal):
+            return 0, 0
+        records = 0
+        with open(journal, 'r', encoding='utf-8') as f:
+            text = f.read()
+            size = os.fstat(f.fileno()).st_size
+        # 只按 \n 分行：ensure_ascii=False 写出的 U+2028 等字符 splitlines() 也会当成换行
+        for line in text.split("\n"):
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # 最后一行可能因崩溃只写了一半，直接忽略
+                continue
+            records += 1
+            if "meta" in rec:
+                meta.update(rec["meta"])
+            elif "i" in rec:
+                i = rec["i"]
+                if i < len(messages):
+                    # 合并快照后崩溃可能留下重复记录，按序号覆盖即可
+                    messages[i] = rec["m"]
+                elif i == len(messages):
+                    messages.append(rec["m"])
+        return records, size
+
+    def load_window(self, chat_id, before=None, limit=50):
+        """只读取 before 之前的最后 limit 条消息：从快照末尾往回读，不解析整个对话"""
+        with self._lock(chat_id):
+            compressed = os.path.exists(self._compressed_path(chat_id))
+            if not compressed and not os.path.exists(self._snapshot_path(chat_id)):
+                data = self._migrate_legacy(chat_id)
+                return message_window(data, before, limit) if data else None
+
+            path = self._compressed_path(chat_id) if compressed else self._snapshot_path(chat_id)
+            with open(path, 'rb') as f:
+                if compressed:
+                    # 压缩快照：目录里有每帧的位置，只解压覆盖这一页的帧
+                    footer = read_footer(f)
+                    meta = footer["meta"]
+                else:
+                    meta = json.loads(f.readline())["meta"]
+                count = meta.pop("count")
+                tail, overrides = self._journal_tail(chat_id, meta, count)
+                total = count + len(tail)
+                start, before = _window_bounds(total, before, limit)
+                end = min(before, count)
+                if compressed:
+                    messages = read_messages(f, footer, self.dicts.get(footer["dict"]), start, end)
+                else:
+                    st = os.fstat(f.fileno())
+                    messages = self._read_snapshot(chat_id, f, (st.st_mtime_ns, st.st_size), count, start, end)
+
+            for i in range(start, end):
+                if i in overrides:
+                    messages[i - start] = overrides[i]
+            if before > count:
+                messages.extend(tail[max(start - count, 0):before - count])
+            self._decode(messages)
+            return dict(meta, messages=messages, start=start, total=total)
+
+    def _journal_tail(self, chat_id, meta, count):
+        """日志中的元数据合并进 meta，返回 (快照之后追加的消息, {快照内被覆盖的序号: 消息})"""
+        tail, overrides = [], {}
+        journal = self._journal_path(chat_id)
+        if not os.path.exists(journal):
+            return tail, overrides
+        with open(journal, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if "meta" in rec:
+                    meta.update(rec["meta"])
+                elif "i" in rec:
+                    # 与 _replay_journal 的规则一致
+                    i = rec["i"] - count
+                    if i < 0:
+                        overrides[rec["i"]] = rec["m"]
+                    elif i < len(tail):
+                        tail[i] = rec["m"]
+                    elif i == len(tail):
+                        tail.append(rec["m"])
+        return tail, overrides
+
+    def _read_snapshot(self, chat_id, f, sig, count, start, end):
+        """读取快照中序号 [start, end) 的消息"""
+        if start >= end:
+            return []
+        cached = self._offsets.get(chat_id)
+        marks = cached[1] if cached and cached[0] == sig else {count: sig[1]}
+        # 从 end 之后最近的已知位置往回读
+        k = min(i for i in marks if i >= end)
+        lines, pos = _read_lines_before(f, marks[k], k - start)
+        marks[start] = pos
+        self._offsets[chat_id] = (sig, marks)
+        return [json.loads(line) for line in lines[:end - start]]
+
+    def _migrate_legacy(self, chat_id):
+        legacy = self._legacy_path(chat_id)
+        if not os.path.exists(legacy):
+            return None
+        with open(legacy, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        meta, messages = _split_meta(data)
+        self._write_snapshot(chat_id, meta, messages)
+        self._decode(messages)
+        return data
+
+    def _exists(self, chat_id):
+        return (os.path.exists(self._compressed_path(chat_id))
+                or os.path.exists(self._snapshot_path(chat_id))
+                or os.path.exists(self._legacy_path(chat_id)))
+
+    def read_meta(self, chat_id):
+        """只读快照头和日志中的元数据记录，不解析消息正文"""
+        with self._lock(chat_id):
+            compressed = self._compressed_path(chat_id)
+            snapshot = self._snapshot_path(chat_id)
+            if os.path.exists(compressed):
+                with open(compressed, 'rb') as f:
+                    meta = read_footer(f)["meta"]
+            elif os.path.exists(snapshot):
+                with open(snapshot, 'r', encoding='utf-8') as f:
+                    meta = json.loads(f.readline())["meta"]
+            else:
+                legacy = self._legacy_path(chat_id)
+                if not os.path.exists(legacy):
+                    return None
+                with open(legacy, 'r', encoding='utf-8') as f:
+                    return _split_meta(json.load(f))[0]
+            meta.pop("count", None)
+            journal = self._journal_path(chat_id)
+            if os.path.exists(journal):
+                with open(journal, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if line.startswith('{"meta"'):
+                            try:
+                                meta.update(json.loads(line)["meta"])
+                            except ValueError:
+                                continue
+            return meta
+
+    # ---------- 删除 / 扫描 ----------
+    def delete(self, chat_id):
+        with self._lock(chat_id):
+            removed = False
+            for path in self._paths(chat_id):
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed = True
+            self._state.pop(chat_id, None)
+            self._offsets.pop(chat_id, None)
+            return removed
+
+    def _paths(self, chat_id):
+        return (self._compressed_path(chat_id), self._snapshot_path(chat_id),
+                self._journal_path(chat_id), self._legacy_path(chat_id))
+
+    def _chat_id_of(self, name):
+        for suffix in (self.COMPRESSED_SUFFIX, self.SNAPSHOT_SUFFIX, self.JOURNAL_SUFFIX, self.LEGACY_SUFFIX):
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return None
+
+    def signature(self, chat_id):
+        sig = None
+        for path in self._paths(chat_id):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            sig = (max(sig[0], st.st_mtime_ns), sig[1] + st.st_size) if sig else (st.st_mtime_ns, st.st_size)
+        return sig
+
+    def scan(self):
+        """返回 {chat_id: (最新 mtime_ns, 总大小)}，只 stat 不读内容"""
+        result = {}
+        with os.scandir(self.history_dir) as it:
+            for entry in it:
+                chat_id = self._chat_id_of(entry.name)
+                if chat_id is None:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                prev = result.get(chat_id)
+                result[chat_id] = ((max(prev[0], st.st_mtime_ns), prev[1] + st.st_size)
+                                   if prev else (st.st_mtime_ns, st.st_size))
+        return result
+
+    # ---------- 后台合并 ----------
+    def _schedule_compaction(self, chat_id):
+        with self._locks_guard:
+            if chat_id in self._pending:
+                return
+            self._pending.add(chat_id)
+        self._queue.put(chat_id)
+
+    def _compact_worker(self):
+        while True:
+            chat_id = self._queue.get()
+            with self._locks_guard:
+                self._pending.discard(chat_id)
+            try:
+                self.compact(chat_id)
+            except Exception as e:
+                print(f"❌ 合并对话日志失败 ({chat_id}): {e}")
+
+    def compact(self, chat_id):
+        """把快照 + 日志合并成新快照"""
+        with self._lock(chat_id):
+            data = self._load_locked(chat_id)
+            if data is None:
+                return
+            meta, messages = _split_meta(data)
+            COMPACT_BYTES_WRITTEN.inc("compact", value=self._write_snapshot(chat_id, meta, messages))
+
+    # ---------- 压缩字典 ----------
+    def train_dictionary(self, max_bytes=TRAIN_SAMPLE_BYTES):
+        """用最近的对话训练新的预置字典，之后写入的快照都使用它；样本不足时返回 None"""
+        samples, total = [], 0
+        recent = sorted(self.scan().items(), key=lambda kv: kv[1][0], reverse=True)
+        for chat_id, _ in recent:
+            data = self.load(chat_id)
+            if not data:
+                continue
+            sample = "".join(_dump_line(self.prompts.encode(m)) for m in data.get("messages", [])).encode('utf-8')
+            samples.append(sample[:max_bytes - total])
+            total += len(samples[-1])
+            if total >= max_bytes:
+                break
+        if total < MIN_TRAIN_BYTES:
+            return None
+        return self.dicts.add(train_dictionary(samples))[0]
+
+    def _train_worker(self):
+        try:
+            self.train_dictionary()
+        except Exception as e:
+            print(f"❌ 训练压缩字典失败: {e}")
+
+
+STORAGE_BACKENDS = {
+    "json": JsonFileStorage,
+    "journal": JournalStorage,
+}
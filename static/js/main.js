@@ -7,9 +7,17 @@ const config = {
 };
 let availableThemes = [];
 let allModels = [];
+// 当前标签页打开的对话 id，所有请求显式带上，多个标签页互不干扰
+let currentChatId = null;
 
 const chatBox = document.getElementById('chat-box');
 const inp = document.getElementById('inp');
+// 长对话分页：打开时只取最后一页，滚动到顶部附近时再向前加载
+const MESSAGE_PAGE = 50;
+let oldestLoaded = 0;       // 已显示的第一条消息在对话中的序号，0 表示已经到头
+let loadingOlder = false;
+// 对比模式选中的模型 (为空表示普通模式)
+let compareModels = [];
 
 // marked
 if (typeof marked !== 'undefined') {
@@ -29,6 +37,9 @@ window.onload = async () => {
     await checkApiConfig();
     await loadPrompts();
     loadHistory();
+    // 上次刷新页面时有回复还在生成：重新打开那个对话并接上生成
+    const streamingChat = sessionStorage.getItem('streamingChat');
+    if(streamingChat) loadOld(streamingChat);
     // 只有在配置了 Key 之后才尝试获取模型
     if(document.getElementById('cfg-key').value) fetchModels(true);
 };
@@ -190,7 +201,7 @@ async function fetchModels(silent=false) {
     }
 
     try {
-        const res = await fetch('/api/fetch_models', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ api_key: key, base_url: url })});
+        const res = await fetch('/api/fetch_models', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ api_key: key, base_url: url, refresh: !silent })});
         const data = await res.json();
         if (data.status === 'success') {
             allModels = data.models;
@@ -251,7 +262,7 @@ function renderAvatar(role) {
     return val;
 }
 
-function addMsg(role, text) {
+function buildMsg(role, text) {
     const div = document.createElement('div');
     div.className = `message ${role}`;
     div.innerHTML = `
@@ -263,12 +274,125 @@ function addMsg(role, text) {
             </div>
         </div>
     `;
+    div.querySelectorAll('pre code').forEach(b => hljs.highlightElement(b));
+    return div;
+}
+
+function addMsg(role, text) {
+    const div = buildMsg(role, text);
     chatBox.appendChild(div);
     chatBox.scrollTop = chatBox.scrollHeight;
-    div.querySelectorAll('pre code').forEach(b => hljs.highlightElement(b));
     return div.querySelector('.markdown-body');
 }
 
+// 一页消息渲染成 fragment (跳过对话开头的 system 消息)，start 是这一页第一条的序号
+function renderPage(messages, start) {
+    const frag = document.createDocumentFragment();
+    messages.forEach((m, i) => { if(start + i > 0) frag.appendChild(buildMsg(m.role, m.content)); });
+    return frag;
+}
+
+async function loadOlderMessages() {
+    if(loadingOlder || oldestLoaded <= 0 || !currentChatId) return;
+    loadingOlder = true;
+    const chatId = currentChatId;
+    try {
+        const res = await fetch(`/api/chat_messages?chat_id=${encodeURIComponent(chatId)}&before=${oldestLoaded}&limit=${MESSAGE_PAGE}`);
+        const data = await res.json();
+        if(data.error || chatId !== currentChatId) return;
+        // 插到顶部，并按新增的高度调整滚动位置，保持视口内容不跳动
+        const prevHeight = chatBox.scrollHeight;
+        chatBox.insertBefore(renderPage(data.messages, data.start), chatBox.firstChild);
+        chatBox.scrollTop += chatBox.scrollHeight - prevHeight;
+        oldestLoaded = data.start;
+    } finally {
+        loadingOlder = false;
+    }
+    fillViewport();
+}
+
+// 已加载的消息不够撑出滚动条时继续向前加载，否则用户没法通过滚动触发
+function fillViewport() {
+    if(chatBox.scrollHeight <= chatBox.clientHeight) loadOlderMessages();
+}
+
+chatBox.addEventListener('scroll', () => { if(chatBox.scrollTop < 300) loadOlderMessages(); });
+
+// 流式 Markdown 增量渲染：
+// 已结束的块 (空行分隔的段落、闭合的代码块) 只解析一次并追加到 DOM，代码块在闭合时高亮一次；
+// 每次更新只重新解析末尾尚未结束的那一块，并且合并到下一帧 (requestAnimationFrame) 再渲染。
+function createStreamRenderer(el) {
+    const done = document.createElement('div');
+    const tail = document.createElement('div');
+    el.appendChild(done);
+    el.appendChild(tail);
+    let full = '', committed = 0, scanPos = 0, fence = null, scheduled = false;
+
+    // 从 scanPos 开始逐行扫描完整的行，找到最后一个可以切分的位置
+    function findBoundary() {
+        let boundary = committed;
+        while(true) {
+            const nl = full.indexOf('\n', scanPos);
+            if(nl < 0) break;
+            const line = full.slice(scanPos, nl);
+            scanPos = nl + 1;
+            const m = line.match(/^ {0,3}(`{3,}|~{3,})/);
+            if(fence) {
+                // 代码块闭合：与开头相同的字符、长度不少于开头
+                if(m && m[1][0] === fence[0] && m[1].length >= fence.length && !line.slice(m[0].length).trim()) {
+                    fence = null;
+                    boundary = scanPos;
+                }
+            } else if(m) {
+                fence = m[1];
+            } else if(!line.trim()) {
+                boundary = scanPos;
+            }
+        }
+        return boundary;
+    }
+
+    function commit(upto) {
+        if(upto <= committed) return;
+        const tmp = document.createElement('div');
+        tmp.innerHTML = marked.parse(full.slice(committed, upto));
+        tmp.querySelectorAll('pre code').forEach(b => hljs.highlightElement(b));
+        while(tmp.firstChild) done.appendChild(tmp.firstChild);
+        committed = upto;
+    }
+
+    function render() {
+        scheduled = false;
+        commit(findBoundary());
+        const rest = full.slice(committed);
+        tail.innerHTML = rest ? marked.parse(rest) : '';
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function schedule() {
+        if(scheduled) return;
+        scheduled = true;
+        requestAnimationFrame(render);
+    }
+
+    return {
+        append(text) { full += text; schedule(); },
+        // 错误信息：整体替换已显示的内容
+        replace(text) {
+            full = text; committed = 0; scanPos = 0; fence = null;
+            done.innerHTML = ''; tail.innerHTML = '';
+            schedule();
+        },
+        // 流结束：把剩下的部分一次性提交 (高亮最后一个代码块)
+        finish() {
+            scheduled = false;
+            commit(full.length);
+            tail.innerHTML = '';
+            chatBox.scrollTop = chatBox.scrollHeight;
+        }
+    };
+}
+
 async function sendMsg() {
     const txt = inp.value.trim();
     if(!txt) return;
@@ -278,9 +402,36 @@ async function sendMsg() {
     // 自动调整输入框高度 (确保下次输入时高度重置)
     inp.style.height = '24px'; 
 
+    if(compareModels.length >= 2) return sendCompare(txt);
     const aiDiv = addMsg('assistant', '...');
-    const src = new EventSource(`/api/chat_stream?message=${encodeURIComponent(txt)}`);
-    let full = "", first = true;
+    // stream_id 由前端生成：连接断开后 EventSource 带着 Last-Event-ID 重连，服务端据此接上同一个生成
+    const streamId = newStreamId();
+    openStream(`/api/chat_stream?chat_id=${encodeURIComponent(currentChatId || '')}&stream_id=${streamId}&message=${encodeURIComponent(txt)}`, aiDiv);
+}
+
+function newStreamId() {
+    if(window.crypto && crypto.randomUUID) return crypto.randomUUID().replace(/-/g, '');
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+// 读取一个回复生成的 SSE 流 (新发送的消息，或刷新页面后接上正在进行的生成)
+function openStream(url, aiDiv) {
+    const chatId = currentChatId;
+    const src = new EventSource(url);
+    let first = true, renderer = null, lost = false, ended = false;
+    sessionStorage.setItem('streamingChat', chatId);
+
+    function end() {
+        if(ended) return;
+        ended = true;
+        src.close();
+        sessionStorage.removeItem('streamingChat');
+        if(renderer) renderer.finish();
+        // 缓冲区已丢弃了开头的一部分：从历史记录重新加载完整回复
+        if(lost && currentChatId === chatId) loadOld(chatId);
+        // 流结束后重新加载历史；自动标题在后台生成，稍后再刷新几次
+        loadHistory().then(chats => refreshTitleLater(chats, [1500, 4000]));
+    }
     
     src.onmessage = e => {
         try {
@@ -289,39 +440,153 @@ async function sendMsg() {
             if(first) { 
                 aiDiv.innerHTML = ''; 
                 first = false; 
+                renderer = createStreamRenderer(aiDiv);
                 // 确保聊天记录滚动到底部，特别是当第一块数据来临时
                 chatBox.scrollTop = chatBox.scrollHeight;
             }
             
             // 检查是否有错误信息，如果有则只显示错误
             if (data.error) {
-                full = `❌ ${data.error}`;
-                src.close();
+                renderer.replace(`❌ ${data.error}`);
+                end();
             } else {
-                full += data.text || '';
+                renderer.append(data.text || '');
             }
-            
-            aiDiv.innerHTML = marked.parse(full);
-            aiDiv.querySelectorAll('pre code').forEach(b => hljs.highlightElement(b));
-            chatBox.scrollTop = chatBox.scrollHeight;
         } catch(err){
             // 捕获 JSON 解析错误
             console.error("EventSource data error:", err);
-            src.close();
+            end();
         }
     };
+
+    src.addEventListener('reset', () => { lost = true; });
+    src.addEventListener('done', end);
+    // 上游繁忙时请求在服务端排队：还没开始输出前显示排队位置
+    src.addEventListener('queue', e => {
+        if(first) aiDiv.innerText = queueText(JSON.parse(e.data).position);
+    });
     
     src.onerror = () => { 
-        src.close(); 
-        // 修复：流结束后需要重新加载历史，以更新自动生成的标题
-        loadHistory(); 
+        // 连接中断时 EventSource 会自动重连并从断点继续；只有彻底失败 (如 4xx) 时才结束
+        if(src.readyState === EventSource.CLOSED) end();
+    };
+}
+
+function queueText(position) {
+    return position ? `⏳ 排队中，前面还有 ${position - 1} 个请求...` : '...';
+}
+
+// ============ 多模型对比 ============
+function openCompareModal() {
+    const box = document.getElementById('compare-models');
+    box.innerHTML = '';
+    if(!allModels.length) box.innerHTML = '<p style="opacity:0.7;">请先在设置里点击“获取”拉取模型列表</p>';
+    allModels.forEach(m => {
+        const label = document.createElement('label');
+        const cb = document.createElement('input');
+        cb.type = 'checkbox'; cb.value = m; cb.checked = compareModels.includes(m);
+        label.appendChild(cb);
+        label.appendChild(document.createTextNode(' ' + m));
+        box.appendChild(label);
+    });
+    document.getElementById('compare-modal').style.display = 'flex';
+}
+
+function setCompareModels(models) {
+    compareModels = models;
+    const btn = document.getElementById('compare-btn');
+    btn.innerText = models.length ? `⚖️ 对比 (${models.length})` : '⚖️ 对比';
+    btn.classList.toggle('active', models.length > 0);
+}
+
+function applyCompare() {
+    const models = [...document.querySelectorAll('#compare-models input:checked')].map(cb => cb.value);
+    if(models.length < 2 || models.length > 4) return alert('请选择 2 到 4 个模型');
+    setCompareModels(models);
+    closeModal('compare-modal');
+}
+
+function clearCompare() {
+    setCompareModels([]);
+    closeModal('compare-modal');
+}
+
+// 一条消息同时发给多个模型：一个 SSE 连接里按 index 区分各模型的增量，并排渲染
+function sendCompare(txt) {
+    const chatId = currentChatId;
+    const models = compareModels.slice();
+    const streamId = newStreamId();
+    const body = addMsg('assistant', '');
+    const grid = document.createElement('div');
+    grid.className = 'compare-grid';
+    body.appendChild(grid);
+
+    const cols = models.map((m, i) => {
+        const col = document.createElement('div');
+        col.className = 'compare-col';
+        col.innerHTML = '<div class="compare-head"><b></b><button class="btn-secondary" disabled>采用</button></div><div class="markdown-body">...</div><div class="compare-stats"></div>';
+        col.querySelector('b').textContent = m;
+        col.querySelector('button').onclick = () => chooseCompare(chatId, streamId, i, body);
+        grid.appendChild(col);
+        return {col, renderer: null, el: col.querySelector('.markdown-body')};
+    });
+
+    const url = `/api/compare_stream?chat_id=${encodeURIComponent(chatId || '')}&stream_id=${streamId}`
+        + `&models=${encodeURIComponent(models.join(','))}&message=${encodeURIComponent(txt)}`;
+    const src = new EventSource(url);
+    src.onmessage = e => {
+        const data = JSON.parse(e.data);
+        const c = cols[data.index];
+        if(!c) {
+            // 请求被拒绝 (如模型数量不对)：只有一条不带 index 的错误信息
+            if(data.text) cols[0].el.innerText = data.text;
+            return;
+        }
+        if(!c.renderer) { c.el.innerHTML = ''; c.renderer = createStreamRenderer(c.el); }
+        c.renderer.append(data.text || '');
     };
+    src.addEventListener('queue', e => {
+        const q = JSON.parse(e.data);
+        const c = cols[q.index];
+        if(c && !c.renderer) c.el.innerText = queueText(q.position);
+    });
+    src.addEventListener('model_done', e => {
+        const s = JSON.parse(e.data);
+        const c = cols[s.index];
+        if(c.renderer) c.renderer.finish();
+        c.col.querySelector('.compare-stats').innerText = s.error ? '❌ 请求失败'
+            : `首字 ${s.ttft_ms ?? '-'} ms · 总耗时 ${s.total_ms} ms · ${s.chars_per_sec ?? '-'} 字/秒`;
+        c.col.querySelector('button').disabled = !!s.error;
+    });
+    src.addEventListener('done', () => src.close());
+    src.onerror = () => { if(src.readyState === EventSource.CLOSED) src.close(); };
+}
+
+async function chooseCompare(chatId, streamId, index, body) {
+    const res = await fetch('/api/compare/choose', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({chat_id: chatId, stream_id: streamId, index})});
+    const data = await res.json();
+    if(data.error) return alert(`❌ ${data.error}`);
+    // 只保留选中的回答
+    const chosen = body.querySelectorAll('.compare-col .markdown-body')[index];
+    body.innerHTML = '';
+    while(chosen.firstChild) body.appendChild(chosen.firstChild);
+    if(currentChatId === chatId) loadHistory().then(chats => refreshTitleLater(chats, [1500, 4000]));
+}
+
+// 当前对话的标题还没生成时，按给定的延迟依次重新拉取历史列表
+function refreshTitleLater(chats, delays) {
+    const cur = (chats || []).find(c => c.id === currentChatId);
+    if(!cur || (cur.title && cur.title !== '新对话') || delays.length === 0) return;
+    setTimeout(() => {
+        loadHistory().then(next => refreshTitleLater(next, delays.slice(1)));
+    }, delays[0]);
 }
 
 // 6. 顶部栏即时切换
 async function updateChatSettings(type) {
     const val = document.getElementById(type === 'model' ? 'chat-model-sel' : 'chat-role-sel').value;
     const payload = type === 'model' ? {model: val} : {prompt_file: val};
+    payload.chat_id = currentChatId;
     
     // 尝试更新设置
     const res = await fetch('/api/chat/update_settings', {
@@ -351,6 +616,7 @@ function startChat() {
     
     // 隐藏聊天提示
     chatBox.innerHTML = ''; 
+    oldestLoaded = 0;
 
     fetch('/api/new_chat', {
         method:'POST', 
@@ -360,6 +626,7 @@ function startChat() {
     .then(res => res.json())
     .then(data => {
         closeModal('role-modal');
+        currentChatId = data.chat_id;
         
         // 渲染欢迎语
         addMsg('assistant', data.greeting);
@@ -379,7 +646,7 @@ function startChat() {
 }
 
 async function loadOld(id) {
-    const res = await fetch('/api/load_chat', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({chat_id: id})});
+    const res = await fetch('/api/load_chat', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({chat_id: id, limit: MESSAGE_PAGE})});
     const data = await res.json();
     
     if (data.error) {
@@ -387,6 +654,7 @@ async function loadOld(id) {
         return;
     }
 
+    currentChatId = id;
     chatBox.innerHTML = '';
     document.getElementById('chat-header').style.display = 'flex';
     
@@ -394,8 +662,17 @@ async function loadOld(id) {
     if(data.model) document.getElementById('chat-model-sel').value = data.model;
     if(data.prompt_file) document.getElementById('chat-role-sel').value = data.prompt_file;
     
-    // 渲染所有消息 (跳过第一个 system 消息)
-    data.messages.slice(1).forEach(m => addMsg(m.role, m.content));
+    // 只渲染最新一页 (跳过第一个 system 消息)，更早的消息滚动到顶部时再加载
+    chatBox.appendChild(renderPage(data.messages, data.start));
+    chatBox.scrollTop = chatBox.scrollHeight;
+    oldestLoaded = data.start;
+    // 角色提示词文件丢失：提示用户重新选择角色，发送会被服务器拒绝
+    if(data.warning) addMsg('assistant', data.warning);
+    // 回复还在生成 (例如生成途中刷新了页面)：接上正在进行的生成，从头显示
+    if(data.active_stream) {
+        openStream(`/api/chat_stream?chat_id=${encodeURIComponent(id)}&stream_id=${encodeURIComponent(data.active_stream)}`, addMsg('assistant', '...'));
+    }
+    fillViewport();
 }
 
 async function loadHistory() {
@@ -404,6 +681,9 @@ async function loadHistory() {
         const chats = await res.json();
         const list = document.getElementById('history-list');
         if(!list) return;
+        // 正在显示搜索结果时不覆盖列表
+        const searchBox = document.getElementById('history-search');
+        if(searchBox && searchBox.value.trim()) return chats;
         
         if(chats.length===0) {
             list.innerHTML = '<div style="padding:10px;opacity:0.6">暂无历史</div>';
@@ -420,6 +700,7 @@ async function loadHistory() {
             `).join('');
             // =======================================================
         }
+        return chats;
     } catch(e){
         console.error("加载历史记录失败:", e);
         const list = document.getElementById('history-list');
@@ -427,6 +708,39 @@ async function loadHistory() {
     }
 }
 
+// 历史全文搜索 (输入停顿 250ms 后发起请求)
+let searchTimer = null;
+function onHistorySearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runHistorySearch, 250);
+}
+
+async function runHistorySearch() {
+    const q = document.getElementById('history-search').value.trim();
+    if(!q) { loadHistory(); return; }
+    const list = document.getElementById('history-list');
+    try {
+        const res = await fetch(`/api/history/search?q=${encodeURIComponent(q)}`);
+        const data = await res.json();
+        // 输入已经变化，丢弃过期的结果
+        if(document.getElementById('history-search').value.trim() !== q) return;
+        if(data.results.length === 0) {
+            list.innerHTML = '<div style="padding:10px;opacity:0.6">没有找到相关对话</div>';
+            return;
+        }
+        const esc = t => String(t || '').replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
+        // snippet 已由后端转义并用 <mark> 标出命中词
+        list.innerHTML = data.results.map(r => `
+            <div class="history-item search-hit" onclick="loadOld('${r.chat_id}')">
+                <span class="chat-title">${esc(r.title) || '新对话'}</span>
+                <div class="search-snippet">${r.role === 'user' ? '🗣️' : '🤖'} ${r.snippet}</div>
+            </div>
+        `).join('');
+    } catch(e) {
+        console.error("搜索失败:", e);
+    }
+}
+
 async function deleteChat(id) {
     if(!confirm("确认删除此对话记录？")) return;
     
@@ -442,7 +756,8 @@ async function deleteChat(id) {
         loadHistory();
         
         // 如果删除的是当前打开的对话，清空聊天框并隐藏头部
-        // 这里依赖于后端 history_mgr.py 确保后端 current_chat_id 被清空
+        if (id !== currentChatId) return;
+        currentChatId = null;
         chatBox.innerHTML = '<div style="text-align:center; color:var(--text-secondary); margin-top:10vh;"><h2>My AI Assistant</h2><p>点击左上角“+”开启新对话</p></div>';
         document.getElementById('chat-header').style.display = 'none';
     } else {
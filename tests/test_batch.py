@@ -0,0 +1,52 @@
+import os
+import json
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from src.batch import BatchRunner, read_inputs, run_batch
+
+
+class EchoEngine:
+    def stream_text(self, messages, model_override=None, priority=None):
+        yield messages[-1]["content"]
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, "out.jsonl")
+
+    def _write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_non_object_records(self):
+        """数字、数组等不是对象的 JSON 行按文本处理，不能让读取线程崩掉"""
+        path = self._write("in.jsonl", '2024\n[1, 2]\n"hi"\n{"text": "ok"}\n')
+        summary = BatchRunner(EchoEngine(), None, self.output, workers=2).run(read_inputs(path))
+        self.assertEqual(summary["ok"], 4)
+        with open(self.output, encoding='utf-8') as f:
+            outputs = [json.loads(line)["output"] for line in f]
+        self.assertEqual(outputs, ["2024", "[1, 2]", "hi", "ok"])
+
+    def test_feed_error_releases_workers(self):
+        def items():
+            yield "1", "a", "a"
+            raise RuntimeError("boom")
+        summary = BatchRunner(EchoEngine(), None, self.output, workers=2).run(items())
+        self.assertEqual(summary["ok"], 1)
+        self.assertEqual(summary["input_error"], "boom")
+
+    def test_missing_input(self):
+        with self.assertRaises(OSError):
+            read_inputs(os.path.join(self.dir, "missing.jsonl"))
+        args = SimpleNamespace(input=os.path.join(self.dir, "missing.jsonl"), output=self.output, field=None,
+                               workers=1, rate=0, unordered=False, model=None, template=None)
+        self.assertIsNone(run_batch(EchoEngine(), args))
+
+
+if __name__ == "__main__":
+    unittest.main()
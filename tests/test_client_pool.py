@@ -0,0 +1,55 @@
+import unittest
+
+from benchmarks.common import start_fake_server, stop_process
+from src.client_pool import ClientRegistry
+
+
+class ClientRegistryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake, cls.base_url = start_fake_server(tokens=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_process(cls.fake)
+
+    def setUp(self):
+        self.registry = ClientRegistry()
+        self.addCleanup(self.registry.close)
+
+    def test_clients_reused(self):
+        """同一组 (base_url, api_key) 返回同一个客户端；不同 key 共享同一个连接池"""
+        a = self.registry.get("sk-a", self.base_url)
+        self.assertIs(self.registry.get("sk-a", self.base_url + "/"), a)
+        b = self.registry.get("sk-b", self.base_url)
+        self.assertIsNot(a, b)
+        snap = self.registry.snapshot()
+        self.assertEqual(snap["pools"], 1)
+        self.assertEqual(snap["clients"], 2)
+
+    def test_connections_reused(self):
+        """连续请求走同一条 keep-alive 连接"""
+        for _ in range(3):
+            self.registry.list_models("sk-a", self.base_url, refresh=True)
+        stats = self.registry.snapshot()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["new_connections"], 1)
+        self.assertEqual(stats["reused"], 2)
+
+    def test_models_ttl(self):
+        """模型列表在 ttl 内命中缓存，refresh 或过期后重新获取"""
+        models = self.registry.list_models("sk-a", self.base_url)
+        self.assertTrue(models)
+        self.assertEqual(self.registry.list_models("sk-a", self.base_url), models)
+        self.assertEqual(self.registry.model_stats, {"hits": 1, "misses": 1})
+
+        self.registry.list_models("sk-a", self.base_url, refresh=True)
+        self.assertEqual(self.registry.model_stats["misses"], 2)
+
+        self.registry.models_ttl = 0
+        self.registry.list_models("sk-a", self.base_url)
+        self.assertEqual(self.registry.model_stats, {"hits": 1, "misses": 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
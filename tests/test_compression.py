@@ -0,0 +1,91 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from src.compression import SEED, read_footer
+from src.storage import JournalStorage
+
+WORDS = ["模型", "缓存", "请求", "上游", "对话", "消息", "字典", "压缩", "延迟", "吞吐", "索引", "快照",
+         "python", "async", "stream", "token", "```python\nprint('hi')\n```", "\n- ", "**注意**"]
+
+
+def make_chat(chat_id, rng, turns=40):
+    messages = [{"role": "system", "content": "你是一个简洁的助手。"}]
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": "".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60)))})
+    return {"id": chat_id, "title": f"对话 {chat_id}", "prompt_file": "p.md", "updated_at": "", "messages": messages}
+
+
+class CompressedSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.rng = random.Random(7)
+        # 先用未压缩的存储写一批对话并训练字典 (压缩存储发现已训练过就不再起后台训练线程)
+        plain = JournalStorage(self.dir)
+        for i in range(40):
+            plain.save(f"old{i}", make_chat(f"old{i}", self.rng))
+        self.dict_id = plain.train_dictionary()
+        self.assertIsNotNone(self.dict_id)
+
+    def test_round_trip_with_trained_dictionary(self):
+        store = JournalStorage(self.dir, compress=True)
+        chat = make_chat("c1", self.rng, turns=100)
+        store.save("c1", chat)
+        path = store._compressed_path("c1")
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(store._snapshot_path("c1")))
+        with open(path, 'rb') as f:
+            footer = read_footer(f)
+        self.assertEqual(footer["dict"], self.dict_id)
+        self.assertGreater(len(footer["frames"]), 1)
+
+        reader = JournalStorage(self.dir, compress=True)
+        self.assertEqual(reader.load("c1")["messages"], chat["messages"])
+        # 分页读取只解压需要的帧，结果与整段读取一致
+        page = reader.load_window("c1", 60, 25)
+        self.assertEqual((page["start"], page["total"]), (35, len(chat["messages"])))
+        self.assertEqual(page["messages"], chat["messages"][35:60])
+        self.assertEqual(reader.read_meta("c1")["title"], chat["title"])
+
+    def test_trained_dictionary_beats_seed(self):
+        """训练出的字典比内置种子字典压得更小"""
+        chat = make_chat("c1", self.rng, turns=100)
+        trained = JournalStorage(self.dir, compress=True)
+        trained.save("c1", chat)
+        size_trained = os.path.getsize(trained._compressed_path("c1"))
+
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other, True)
+        seeded = JournalStorage(other, compress=True)
+        self.assertEqual(seeded.dicts.current()[1], "".join(SEED).encode("utf-8"))
+        seeded.save("c1", chat)
+        self.assertLess(size_trained, os.path.getsize(seeded._compressed_path("c1")))
+
+    def test_old_dictionary_still_readable(self):
+        """换了新字典之后，用旧字典写的快照仍然按它记录的字典 id 读取"""
+        store = JournalStorage(self.dir, compress=True)
+        chat = make_chat("c1", self.rng)
+        store.save("c1", chat)
+        store.dicts.add(b"a completely different dictionary" * 100)
+        self.assertNotEqual(store.dicts.current()[0], self.dict_id)
+        self.assertEqual(JournalStorage(self.dir, compress=True).load("c1")["messages"], chat["messages"])
+
+    def test_compaction_converts_plain_snapshot(self):
+        """未压缩的快照在合并日志时改写成压缩格式"""
+        chat = make_chat("c1", self.rng)
+        JournalStorage(self.dir).save("c1", chat)
+        store = JournalStorage(self.dir, compress=True)
+        chat["messages"].append({"role": "user", "content": "再来一条"})
+        store.save("c1", chat)
+        store.compact("c1")
+        self.assertTrue(os.path.exists(store._compressed_path("c1")))
+        self.assertFalse(os.path.exists(store._snapshot_path("c1")))
+        self.assertEqual(JournalStorage(self.dir).load("c1")["messages"], chat["messages"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.config import ConfigService
+
+
+class ConfigServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.env_file = os.path.join(self.dir, ".env")
+        self._write("MY_MODEL_NAME=m1\nMY_MAX_TOKENS=100\n")
+        env = mock.patch.dict(os.environ, {"MY_MODEL_NAME": "from-env", "MY_TEMPERATURE": "0.2"})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _write(self, text, bump=True):
+        with open(self.env_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if bump:
+            # 保证 mtime 与上一次写入不同 (有的文件系统 mtime 精度较低)
+            st = os.stat(self.env_file)
+            os.utime(self.env_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_snapshot_reused_until_file_changes(self):
+        service = ConfigService(self.env_file, check_interval=0)
+        cfg = service.get()
+        # .env 里的值优先于环境变量，.env 没写的才用环境变量
+        self.assertEqual((cfg.model, cfg.max_tokens, cfg.temperature), ("m1", 100, 0.2))
+        self.assertEqual(cfg["model"], "m1")
+        self.assertIs(service.get(), cfg)
+
+        self._write("MY_MODEL_NAME=m2\nMY_MAX_TOKENS=100\n")
+        new = service.get()
+        self.assertIsNot(new, cfg)
+        self.assertEqual(new.model, "m2")
+        # 不再写进 os.environ
+        self.assertEqual(os.environ["MY_MODEL_NAME"], "from-env")
+
+    def test_check_interval(self):
+        """检查间隔内不看文件，invalidate 后立即重新读取"""
+        service = ConfigService(self.env_file, check_interval=60)
+        cfg = service.get()
+        self._write("MY_MODEL_NAME=m2\n")
+        self.assertIs(service.get(), cfg)
+        service.invalidate()
+        self.assertEqual(service.get().model, "m2")
+
+    def test_invalid_value_keeps_old_snapshot(self):
+        service = ConfigService(self.env_file, check_interval=0)
+        cfg = service.get()
+        with mock.patch("builtins.print"):
+            self._write("MY_MODEL_NAME=m2\nMY_MAX_TOKENS=abc\n")
+            self.assertIs(service.get(), cfg)
+
+    def test_missing_file_uses_environment(self):
+        service = ConfigService(os.path.join(self.dir, "missing.env"), check_interval=0)
+        self.assertEqual(service.get().model, "from-env")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+from src.context_manager import message_tokens, count_tokens, MESSAGE_OVERHEAD
+
+
+class MessageTokensTest(unittest.TestCase):
+    def test_does_not_modify_message(self):
+        message = {"role": "user", "content": "hello world"}
+        self.assertEqual(message_tokens(message), count_tokens("hello world") + MESSAGE_OVERHEAD)
+        self.assertEqual(message, {"role": "user", "content": "hello world"})
+
+    def test_same_length_edit_recounts(self):
+        """内容改了但长度不变时不能用旧的计数"""
+        message = {"role": "user", "content": "aaaa aaaa aaaa"}
+        message_tokens(message)
+        message["content"] = "你好你好你好你好你好你好你好"[:len(message["content"])]
+        self.assertEqual(message_tokens(message), count_tokens(message["content"]) + MESSAGE_OVERHEAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.file_loader import PromptRegistry
+
+
+class PromptRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self._write("a.md", "## Greeting: 你好\n你是助手 A")
+
+    def _write(self, name, text, mtime_offset=0):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mtime_offset:
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + mtime_offset))
+
+    def test_parse_and_list(self):
+        registry = PromptRegistry(self.dir)
+        self.assertEqual(registry.list(), ["a.md"])
+        self.assertEqual(registry.get("a.md"), ("你是助手 A", "你好"))
+        self.assertEqual(registry.get("missing.md"), (None, None))
+        # 带路径的文件名不允许
+        self.assertEqual(registry.get("../a.md"), (None, None))
+
+    def test_cached_within_interval(self):
+        """检查间隔内直接用内存中的结果，不看磁盘"""
+        registry = PromptRegistry(self.dir, check_interval=60)
+        registry.get("a.md")
+        self._write("a.md", "## Greeting: 改了\n新内容", mtime_offset=10**9)
+        self.assertEqual(registry.get("a.md"), ("你是助手 A", "你好"))
+
+    def test_reload_on_mtime_change(self):
+        """文件的 mtime / 大小变化后重新解析；没变时沿用缓存"""
+        registry = PromptRegistry(self.dir, check_interval=0)
+        first = registry.get("a.md")
+        self.assertIs(registry.get("a.md")[0], first[0])
+        self._write("a.md", "## Greeting: 改了\n新内容", mtime_offset=10**9)
+        self.assertEqual(registry.get("a.md"), ("新内容", "改了"))
+
+    def test_directory_changes(self):
+        """增删文件后目录 mtime 变化，列表随之更新"""
+        registry = PromptRegistry(self.dir, check_interval=60)
+        registry.list()
+        self._write("b.md", "你是助手 B")
+        os.remove(os.path.join(self.dir, "a.md"))
+        st = os.stat(self.dir)
+        os.utime(self.dir, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(registry.list(), ["b.md"])
+        self.assertEqual(registry.get("b.md"), ("你是助手 B", "✅ 已加载角色: b.md"))
+
+    def test_save_visible_immediately(self):
+        registry = PromptRegistry(self.dir, check_interval=60)
+        registry.list()
+        registry.save("c.md", "## Greeting: 嗨\n你是助手 C")
+        self.assertIn("c.md", registry.list())
+        self.assertEqual(registry.get("c.md"), ("你是助手 C", "嗨"))
+
+
+if __name__ == '__main__':
+    unittest.main()
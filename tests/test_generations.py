@@ -0,0 +1,98 @@
+import json
+import threading
+import unittest
+from unittest import mock
+
+from src.generations import Generation, GenerationStore, parse_event_id, parse_offsets
+
+
+def parse_frames(frames):
+    """把 SSE 帧解析成 (event, id, data) 列表，跳过注释行"""
+    events = []
+    for frame in frames:
+        fields = {}
+        for line in frame.strip().split("\n"):
+            key, sep, value = line.partition(": ")
+            if sep and key in ("event", "id", "data"):
+                fields[key] = value
+        if "data" in fields:
+            events.append((fields.get("event", "message"), fields.get("id"), json.loads(fields["data"])))
+    return events
+
+
+class ResumeOffsetTest(unittest.TestCase):
+    def _finished(self, *parts):
+        gen = Generation("s1", "c1")
+        for part in parts:
+            gen.append(part)
+        gen.finish()
+        return gen
+
+    def test_parse_event_id(self):
+        self.assertEqual(parse_event_id("s1:42", "s1"), 42)
+        self.assertEqual(parse_event_id(None, "s1"), 0)
+        # 别的生成的 id、格式不对、负数都从头开始
+        self.assertEqual(parse_event_id("s2:42", "s1"), 0)
+        self.assertEqual(parse_event_id("s1:abc", "s1"), 0)
+        self.assertEqual(parse_event_id("s1:-3", "s1"), 0)
+        self.assertEqual(parse_offsets("s1:3.7", "s1", 2), [3, 7])
+        self.assertEqual(parse_offsets("s1:3", "s1", 2), [0, 0])
+        self.assertEqual(parse_offsets("s2:3.7", "s1", 2), [0, 0])
+
+    def test_resume_from_offset(self):
+        """带着上次收到的事件 id 重连：只收到之后的文本 (包括从一段的中间接上)"""
+        gen = self._finished("hello", " world", "!")
+        events = parse_frames(gen.events())
+        self.assertEqual(events[0][:2], ("start", "s1:0"))
+        text_events = [e for e in events if e[0] == "message"]
+        self.assertEqual("".join(e[2]["text"] for e in text_events), "hello world!")
+        last_id = text_events[-1][1]
+        self.assertEqual(last_id, "s1:12")
+
+        for offset, expected in ((5, " world!"), (3, "lo world!"), (12, "")):
+            events = parse_frames(gen.events(parse_event_id(f"s1:{offset}", "s1")))
+            self.assertEqual(events[0][1], f"s1:{offset}")
+            self.assertEqual("".join(e[2]["text"] for e in events if e[0] == "message"), expected)
+            self.assertEqual(events[-1][:2], ("done", "s1:12"))
+
+    def test_resume_while_generating(self):
+        """生成还在进行时重连：先补上断点之后已有的文本，再继续收新内容"""
+        gen = Generation("s1", "c1")
+        gen.append("abc")
+        frames = gen.events(1)
+        next(frames)
+        self.assertEqual(parse_frames([next(frames)]), [("message", "s1:3", {"text": "bc"})])
+
+        def produce():
+            gen.append("def")
+            gen.finish()
+        threading.Timer(0.05, produce).start()
+        events = parse_frames(frames)
+        self.assertEqual("".join(e[2]["text"] for e in events if e[0] == "message"), "def")
+        self.assertEqual(events[-1][:2], ("done", "s1:6"))
+
+    def test_offset_before_buffer_resets(self):
+        """断点早于缓冲区 (开头已被丢弃)：先发 reset，再从缓冲区开头发送"""
+        with mock.patch("src.generations.MAX_BUFFER_CHARS", 5):
+            gen = self._finished("abc", "def", "ghi")
+        self.assertEqual(gen.base, 6)
+        events = parse_frames(gen.events(2))
+        kinds = [e[0] for e in events]
+        self.assertEqual(kinds, ["start", "reset", "message", "done"])
+        self.assertEqual(events[2][2]["text"], "ghi")
+
+    def test_store_scoped_to_chat(self):
+        """stream_id 只在所属对话内有效"""
+        store = GenerationStore()
+        gen, created = store.create("c1", "s1", "hi")
+        self.assertTrue(created)
+        self.assertEqual(store.create("c1", "s1", "hi"), (gen, False))
+        self.assertIs(store.get("c1", "s1"), gen)
+        self.assertIsNone(store.get("c2", "s1"))
+        other, created = store.create("c2", "s1", "hi")
+        self.assertTrue(created)
+        self.assertIsNot(other, gen)
+
+
+if __name__ == '__main__':
+    unittest.main()
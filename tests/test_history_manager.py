@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.history_manager import HistoryManager
+
+
+class HistoryManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _save(self, mgr, chat_id, text):
+        data = {"id": chat_id, "title": "新对话", "prompt_file": "p.md", "updated_at": "",
+                "messages": [{"role": "system", "content": "sys"}, {"role": "user", "content": text}]}
+        mgr.save_chat(chat_id, data)
+
+    def test_search_backfill_runs_in_background(self):
+        """搜索索引建立之前的对话：第一次搜索不在请求里补建，由后台线程完成"""
+        mgr = HistoryManager()
+        self._save(mgr, "c1", "苹果派的做法")
+        self._save(mgr, "c2", "香蕉面包")
+        # 模拟旧版本留下的对话：内容在存储里，但还没进搜索索引
+        mgr.search.remove("c2")
+
+        mgr.search_chats("香蕉")
+        mgr._search_backfill.join(5)
+        self.assertFalse(mgr.search_backfilling())
+        self.assertEqual([h["chat_id"] for h in mgr.search_chats("香蕉")], ["c2"])
+
+    def test_unreadable_chat_not_retried(self):
+        mgr = HistoryManager()
+        self._save(mgr, "c1", "苹果派的做法")
+        mgr.search.remove("c1")
+        mgr.storage.load = lambda chat_id: None
+        mgr.search_chats("苹果")
+        mgr._search_backfill.join(5)
+        self.assertIn("c1", mgr._search_failed)
+        backfill = mgr._search_backfill
+        mgr.search_chats("苹果")
+        self.assertIs(mgr._search_backfill, backfill)
+
+
+if __name__ == "__main__":
+    unittest.main()
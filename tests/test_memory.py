@@ -0,0 +1,73 @@
+import shutil
+import tempfile
+import unittest
+
+from src.memory import MemoryIndex, load_numpy
+
+
+def chat(*pairs):
+    messages = [{"role": "system", "content": "你是助手"}]
+    for user, assistant in pairs:
+        messages.append({"role": "user", "content": user})
+        messages.append({"role": "assistant", "content": assistant})
+    return messages
+
+
+@unittest.skipIf(load_numpy() is None, "长期记忆需要 numpy")
+class MemoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.index = self._open()
+        self.index.update("c1", chat(("我家的猫叫团子，喜欢吃三文鱼", "团子真可爱，三文鱼要煮熟再喂")))
+        self.index.update("c2", chat(("Postgres 的 vacuum 什么时候触发", "autovacuum 按死元组比例触发")))
+
+    def _open(self):
+        index = MemoryIndex(self.dir)
+        self.addCleanup(index._conn.close)
+        return index
+
+    def _chats(self, query, **kwargs):
+        return [r["chat_id"] for r in self.index.recall(query, **kwargs)]
+
+    def test_recall(self):
+        self.assertEqual(self._chats("团子喜欢吃什么")[0], "c1")
+        self.assertEqual(self._chats("vacuum 触发条件")[0], "c2")
+        self.assertNotIn("c1", self._chats("团子喜欢吃什么", exclude="c1"))
+        self.assertEqual(self.index.recall("", top_k=4), [])
+
+    def test_upsert_appends_new_messages(self):
+        """追加消息只索引新增的部分"""
+        before = self.index.count()
+        messages = chat(("我家的猫叫团子，喜欢吃三文鱼", "团子真可爱，三文鱼要煮熟再喂"),
+                        ("团子最近掉毛很厉害", "换季掉毛正常，多梳毛"))
+        self.index.update("c1", messages)
+        self.assertEqual(self.index.count(), before + 2)
+        self.index.update("c1", messages)
+        self.assertEqual(self.index.count(), before + 2)
+        self.assertEqual(self._chats("团子掉毛")[0], "c1")
+
+    def test_rewrite_and_remove(self):
+        """对话被改写时整段重建，删除后不再取回"""
+        self.index.update("c1", chat(("我养了一只仓鼠叫豆豆", "仓鼠要注意温度")))
+        texts = [r["text"] for r in self.index.recall("团子 三文鱼", min_score=0)]
+        self.assertFalse(any("团子" in t for t in texts))
+        self.assertEqual(self._chats("豆豆 仓鼠")[0], "c1")
+        self.index.remove("c1")
+        self.assertNotIn("c1", self._chats("豆豆 仓鼠", min_score=0))
+        self.assertEqual(self.index.indexed_ids(), {"c2"})
+
+    def test_budget(self):
+        """取回片段的总 token 数不超过预算"""
+        self.assertEqual(self.index.recall("团子喜欢吃什么", budget=5), [])
+        self.assertEqual(len(self.index.recall("团子 三文鱼 vacuum", top_k=1, min_score=0)), 1)
+
+    def test_persisted(self):
+        """重新打开索引后仍能取回"""
+        self.index = self._open()
+        self.assertEqual(self._chats("团子喜欢吃什么")[0], "c1")
+        self.assertEqual(self.index.indexed_ids(), {"c1", "c2"})
+
+
+if __name__ == '__main__':
+    unittest.main()
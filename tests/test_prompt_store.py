@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import unittest
+
+from src.prompt_store import MISSING_KEY, REF_KEY, missing_prompt
+from src.storage import JournalStorage, PROMPT_DIR
+
+LONG_PROMPT = "你是一个乐于助人的助手。" * 40
+
+
+class PromptStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prompt_dir = os.path.join(self.dir, PROMPT_DIR)
+
+    def _chat(self, chat_id, system=LONG_PROMPT):
+        return {"id": chat_id, "title": "新对话", "prompt_file": "p.md", "updated_at": "",
+                "messages": [{"role": "system", "content": system}, {"role": "user", "content": "hi"}]}
+
+    def _prompt_files(self):
+        return os.listdir(self.prompt_dir) if os.path.isdir(self.prompt_dir) else []
+
+    def _stored_files(self):
+        # 快照 / 日志等对话文件的全部内容
+        text = ""
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    text += f.read().decode('utf-8', 'replace')
+        return text
+
+    def test_dedupe(self):
+        """两个对话使用同一个提示词：磁盘上只有一份，读回后共享同一个字符串对象"""
+        store = JournalStorage(self.dir)
+        store.save("c1", self._chat("c1"))
+        store.save("c2", self._chat("c2"))
+        self.assertEqual(len(self._prompt_files()), 1)
+        self.assertNotIn(LONG_PROMPT, self._stored_files())
+
+        reader = JournalStorage(self.dir)
+        a = reader.load("c1")["messages"][0]["content"]
+        b = reader.load("c2")["messages"][0]["content"]
+        self.assertEqual(a, LONG_PROMPT)
+        self.assertIs(a, b)
+
+    def test_missing_file(self):
+        """提示词文件丢失：内容为空并带内部标记，能检测出来；再次保存时原样写回引用"""
+        store = JournalStorage(self.dir)
+        store.save("c1", self._chat("c1"))
+        for name in self._prompt_files():
+            os.remove(os.path.join(self.prompt_dir, name))
+
+        reader = JournalStorage(self.dir)
+        data = reader.load("c1")
+        system = data["messages"][0]
+        self.assertEqual(system["content"], "")
+        ref = missing_prompt(data["messages"])
+        self.assertIsNotNone(ref)
+        self.assertEqual(system[MISSING_KEY], ref)
+
+        data["messages"].append({"role": "user", "content": "again"})
+        reader.save("c1", data)
+        self.assertNotIn(MISSING_KEY, self._stored_files())
+        self.assertIn(ref, self._stored_files())
+        self.assertEqual(missing_prompt(JournalStorage(self.dir).load("c1")["messages"]), ref)
+
+    def test_legacy_inline_migrated_on_save(self):
+        """旧格式内联的长提示词：读取时不写文件，下次保存时改写成引用"""
+        store = JournalStorage(self.dir)
+        store.save("c1", self._chat("c1"))
+        snapshots = [n for n in os.listdir(self.dir) if os.path.isfile(os.path.join(self.dir, n))]
+        ref = self._prompt_files()[0][:-4]
+        # 把快照里的引用改回内联内容，模拟旧版写下的对话
+        for name in snapshots:
+            path = os.path.join(self.dir, name)
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            text = text.replace(f'"{REF_KEY}":"{ref}"', '"content":' + json.dumps(LONG_PROMPT, ensure_ascii=False))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        os.remove(os.path.join(self.prompt_dir, ref + ".txt"))
+        self.assertIn(LONG_PROMPT, self._stored_files())
+
+        reader = JournalStorage(self.dir)
+        data = reader.load("c1")
+        self.assertEqual(data["messages"][0]["content"], LONG_PROMPT)
+        self.assertEqual(self._prompt_files(), [])
+
+        data["messages"].append({"role": "user", "content": "again"})
+        reader.save("c1", data)
+        self.assertEqual(self._prompt_files(), [ref + ".txt"])
+        self.assertNotIn(LONG_PROMPT, self._stored_files())
+        self.assertEqual(JournalStorage(self.dir).load("c1")["messages"][0]["content"], LONG_PROMPT)
+
+
+if __name__ == '__main__':
+    unittest.main()
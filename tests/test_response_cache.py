@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from src.response_cache import ResponseCache
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def test_key_normalization(self):
+        """换行风格、首尾空白和多余字段不影响键；模型和参数不同则不同"""
+        a = ResponseCache.make_key("m", 0, 100, [{"role": "user", "content": " hi\r\nthere "}])
+        b = ResponseCache.make_key("m", 0, 100, [{"role": "user", "content": "hi\nthere", "_tokens": 3}])
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, ResponseCache.make_key("m2", 0, 100, [{"role": "user", "content": "hi\nthere"}]))
+        self.assertNotEqual(a, ResponseCache.make_key("m", 0.7, 100, [{"role": "user", "content": "hi\nthere"}]))
+
+    def test_ttl(self):
+        """过期的条目在内存和磁盘上都不再命中，磁盘文件被删除"""
+        cache = ResponseCache(self.dir, ttl=60)
+        now = time.time()
+        with mock.patch("src.response_cache.time.time", return_value=now):
+            cache.put("k1", "hello")
+            self.assertEqual(cache.get("k1"), "hello")
+        with mock.patch("src.response_cache.time.time", return_value=now + 59):
+            self.assertEqual(ResponseCache(self.dir, ttl=60).get("k1"), "hello")
+        with mock.patch("src.response_cache.time.time", return_value=now + 61):
+            self.assertIsNone(cache.get("k1"))
+        self.assertFalse(os.path.exists(cache._path("k1")))
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_memory_lru_falls_back_to_disk(self):
+        """内存只保留最近用过的 memory_items 条，挤出去的从磁盘读回"""
+        cache = ResponseCache(self.dir, memory_items=2)
+        for key in ("a", "b", "c"):
+            cache.put(key, key * 3)
+        self.assertNotIn("a", cache._memory)
+        self.assertEqual(cache.get("a"), "aaa")
+        self.assertEqual(cache.stats["disk_hits"], 1)
+        # 读回的 a 成为最近使用，b 被挤出
+        self.assertEqual(list(cache._memory), ["c", "a"])
+        self.assertEqual(cache.get("c"), "ccc")
+        self.assertEqual(cache.stats["memory_hits"], 1)
+
+    def test_disk_eviction(self):
+        """磁盘超过上限时先删最旧的，删到上限的 90%"""
+        cache = ResponseCache(self.dir, disk_max_bytes=1000)
+        base = time.time() - 100
+        for i in range(5):
+            cache.put(f"k{i}", "x" * 150)
+            os.utime(cache._path(f"k{i}"), (base + i, base + i))
+        self.assertEqual(cache.stats["evictions"], 0)
+        cache.put("k5", "x" * 150)
+        self.assertGreater(cache.stats["evictions"], 0)
+        self.assertLessEqual(cache._scan_size(), 900)
+        remaining = {k for k in (f"k{i}" for i in range(6)) if os.path.exists(cache._path(k))}
+        self.assertNotIn("k0", remaining)
+        self.assertIn("k5", remaining)
+        self.assertEqual(cache._disk_bytes, cache._scan_size())
+
+
+if __name__ == '__main__':
+    unittest.main()
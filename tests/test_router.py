@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+import openai
+
+from benchmarks.common import start_fake_server, stop_process
+from src.client_pool import ClientRegistry
+from src.router import UpstreamRouter
+
+REQUEST = {"model": "fake-model", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+
+class UpstreamRouterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.procs = []
+        cls.failing = cls._server(fail_rate=1.0, fail_status=500)
+        cls.rejecting = cls._server(fail_rate=1.0, fail_status=400)
+        cls.slow = cls._server(latency=1.0)
+        cls.fast = cls._server()
+
+    @classmethod
+    def _server(cls, **options):
+        proc, base_url = start_fake_server(tokens=5, **options)
+        cls.procs.append(proc)
+        return base_url
+
+    @classmethod
+    def tearDownClass(cls):
+        for proc in cls.procs:
+            stop_process(proc)
+
+    def _router(self, primary, backup, hedge=False):
+        path = os.path.join(tempfile.mkdtemp(), "endpoints.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump([{"name": "backup", "base_url": backup}], f)
+        cfg = SimpleNamespace(base_url=primary, api_key="sk-fake", endpoints_file=path, retry_max=2,
+                              retry_backoff_ms=1000, hedge=hedge, hedge_min_ms=100)
+        clients = ClientRegistry()
+        self.addCleanup(clients.close)
+        router = UpstreamRouter(clients)
+        router.configure(cfg)
+        return router
+
+    def _endpoint(self, router, name):
+        return next(ep for ep in router.snapshot()["endpoints"] if ep["name"] == name)
+
+    def _warm(self, router, name, ttft=0.05):
+        # 上游有足够的首字延迟样本：对冲按 p95 (这里约 50ms) 触发，而不是默认的 2 秒
+        ep = next(ep for ep in router.endpoints if ep.name == name)
+        for _ in range(30):
+            ep.ttfts.append(ttft)
+        ep.ewma = ttft
+
+    def test_failover(self):
+        """首选的上游返回 5xx：换到下一个上游拿到回复，失败计入首选上游的健康统计"""
+        router = self._router(self.failing, self.fast)
+        text = "".join(router.open(REQUEST, prefer="default"))
+        self.assertTrue(text)
+        self.assertEqual(self._endpoint(router, "default")["consecutive_failures"], 1)
+        self.assertFalse(self._endpoint(router, "default")["healthy"])
+        self.assertEqual(self._endpoint(router, "backup")["consecutive_failures"], 0)
+        # 冷却中的上游排在最后
+        self.assertEqual([ep.name for ep in router.plan("fake-model")], ["backup", "default"])
+
+    def test_client_error_not_retried(self):
+        """400 这类请求本身的错误不换上游重试，直接抛出"""
+        router = self._router(self.rejecting, self.fast)
+        with self.assertRaises(openai.BadRequestError):
+            router.open(REQUEST, prefer="default")
+        self.assertIsNone(self._endpoint(router, "backup")["ttft_ewma_ms"])
+
+    def test_hedge_wins_over_slow_endpoint(self):
+        """首选上游超过 p95 首字延迟还没回复：向另一个上游对冲，先回复的胜出"""
+        router = self._router(self.slow, self.fast, hedge=True)
+        self._warm(router, "default")
+        start = time.perf_counter()
+        text = "".join(router.open(REQUEST, prefer="default"))
+        self.assertTrue(text)
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertEqual(router.snapshot()["hedges"], 1)
+        self.assertIsNotNone(self._endpoint(router, "backup")["ttft_ewma_ms"])
+
+    def test_async_failover_and_hedge(self):
+        async def run(router):
+            try:
+                return "".join([piece async for piece in await router.aopen(REQUEST, prefer="default")])
+            finally:
+                await router.clients.aclose()
+
+        router = self._router(self.failing, self.fast)
+        self.assertTrue(asyncio.run(run(router)))
+        self.assertEqual(self._endpoint(router, "default")["consecutive_failures"], 1)
+
+        router = self._router(self.slow, self.fast, hedge=True)
+        self._warm(router, "default")
+        start = time.perf_counter()
+        self.assertTrue(asyncio.run(run(router)))
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertEqual(router.snapshot()["hedges"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
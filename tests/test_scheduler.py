@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from src.scheduler import BACKGROUND, BATCH, INTERACTIVE, Scheduler
+
+
+def limits(concurrency=0, rpm=0, tpm=0, model_limits=""):
+    return SimpleNamespace(max_concurrency=concurrency, rate_rpm=rpm, rate_tpm=tpm, model_limits=model_limits)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def _queue(self, requests):
+        """依次排队 (model, priority, tokens)，返回按放行顺序排列的序号"""
+        order, lock, threads = [], threading.Lock(), []
+        for i, (model, priority, tokens) in enumerate(requests):
+            def run(i=i, model=model, priority=priority, tokens=tokens):
+                ticket = self.scheduler.acquire(model, tokens=tokens, priority=priority)
+                with lock:
+                    order.append(i)
+                self.scheduler.release(ticket)
+            thread = threading.Thread(target=run)
+            thread.start()
+            threads.append(thread)
+            # 等它进入队列，保证同优先级的先后顺序
+            while self.scheduler.depth() < i + 1:
+                time.sleep(0.001)
+        return order, threads
+
+    def test_priority_order(self):
+        """并发名额空出时按优先级放行，同优先级先到先得"""
+        self.scheduler.configure(limits(concurrency=1))
+        held = self.scheduler.acquire("m")
+        order, threads = self._queue([("m", BATCH, 0), ("m", BACKGROUND, 0), ("m", INTERACTIVE, 0),
+                                      ("m", BACKGROUND, 0), ("m", INTERACTIVE, 0)])
+        self.assertEqual(self.scheduler.snapshot()["queued"], {"interactive": 2, "background": 2, "batch": 1})
+        self.scheduler.release(held)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(order, [2, 4, 1, 3, 0])
+
+    def test_concurrency_limit(self):
+        """同时放行的请求数不超过上游和模型的并发上限"""
+        self.scheduler.configure(limits(concurrency=3, model_limits="small=1"))
+        active, peak, lock = {"m": 0, "small": 0}, {"m": 0, "small": 0}, threading.Lock()
+
+        def run(model):
+            with self.scheduler.slot(model):
+                with lock:
+                    active[model] += 1
+                    peak[model] = max(peak[model], active[model])
+                time.sleep(0.02)
+                with lock:
+                    active[model] -= 1
+        threads = [threading.Thread(target=run, args=("small" if i % 2 else "m",)) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(peak["small"], 1)
+        self.assertLessEqual(peak["m"] + peak["small"], 3)
+        self.assertEqual(self.scheduler.inflight(), 0)
+
+    def test_token_limit(self):
+        """每分钟 token 数用完时排队；结束时退回多预留的 token 后放行"""
+        self.scheduler.configure(limits(tpm=600))
+        first = self.scheduler.acquire("m", tokens=500)
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.scheduler.acquire("m", tokens=300)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(got, [])
+        self.assertEqual(self.scheduler.depth(), 1)
+        # 实际只用了 100 个：退回 400，桶里够 300 了
+        self.scheduler.release(first, used_tokens=100)
+        waiter.join(2)
+        self.assertEqual(len(got), 1)
+        self.scheduler.release(got[0])
+
+    def test_busy_endpoint_skipped(self):
+        """排在前面的请求等着的上游满了，后面的请求可以用其他空闲的上游"""
+        self.scheduler.configure(limits(concurrency=1), [SimpleNamespace(name="b", limits={})])
+        held = self.scheduler.acquire("m", ["default"])
+        self.assertEqual(self.scheduler.acquire("m", ["default", "b"]).endpoint, "b")
+
+    def test_interrupted_acquire_leaves_queue(self):
+        """排队中被中断 (KeyboardInterrupt)：离开队列，后面的请求照常放行"""
+        self.scheduler.configure(limits(concurrency=1))
+        held = self.scheduler.acquire("m")
+
+        def interrupt(position):
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            self.scheduler.acquire("m", on_wait=interrupt)
+        self.assertEqual(self.scheduler.depth(), 0)
+
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.scheduler.acquire("m")))
+        waiter.start()
+        time.sleep(0.05)
+        self.scheduler.release(held)
+        waiter.join(2)
+        self.assertEqual(len(got), 1)
+
+    def test_admitted_then_interrupted_releases_ticket(self):
+        """放行时的 on_wait(0) 抛出异常：已拿到的名额归还"""
+        self.scheduler.configure(limits(concurrency=1))
+        held = self.scheduler.acquire("m")
+
+        def on_wait(position):
+            if position == 0:
+                raise KeyboardInterrupt
+        threading.Timer(0.05, self.scheduler.release, (held,)).start()
+        with self.assertRaises(KeyboardInterrupt):
+            self.scheduler.acquire("m", on_wait=on_wait)
+        self.assertEqual(self.scheduler.inflight(), 0)
+        self.assertEqual(self.scheduler.snapshot()["endpoints"]["default"]["active"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
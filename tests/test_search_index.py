@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+import unittest
+
+from src.search_index import SearchIndex, build_match, tokenize
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = SearchIndex(self.dir)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.addCleanup(self.index._conn.close)
+        self.index.update("c1", [
+            {"role": "system", "content": "机器学习专家"},
+            {"role": "user", "content": "怎么入门机器学习？"},
+            {"role": "assistant", "content": "先学 Python 和线性代数，再看 scikit-learn。"},
+        ])
+        self.index.update("c2", [
+            {"role": "user", "content": "学习机器人的控制算法"},
+            {"role": "assistant", "content": "Pythonic code reads well."},
+        ])
+
+    def _hits(self, query):
+        return sorted((r["chat_id"], r["index"]) for r in self.index.search(query))
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("机器学习"), ["机器", "器学", "学习", "习"])
+        self.assertEqual(tokenize("用 Python 写"), ["用", "python", "写"])
+
+    def test_bigram_query(self):
+        """中文词按二元组组成短语匹配：不会因为两个字分开出现就命中"""
+        self.assertEqual(self._hits("机器学习"), [("c1", 1)])
+        self.assertEqual(self._hits("机器"), [("c1", 1), ("c2", 0)])
+        # system 消息不参与搜索
+        self.assertNotIn(("c1", 0), self._hits("专家"))
+
+    def test_single_character(self):
+        """单个汉字按前缀匹配，出现在词尾也能找到"""
+        self.assertEqual(self._hits("习"), [("c1", 1), ("c2", 0)])
+        self.assertEqual(self._hits("数"), [("c1", 2)])
+
+    def test_phrase_query(self):
+        """双引号内按短语匹配，空格分隔的多个词之间为 AND"""
+        self.assertEqual(self._hits('"scikit learn"'), [("c1", 2)])
+        self.assertEqual(self._hits('"learn scikit"'), [])
+        self.assertEqual(self._hits("机器 控制"), [("c2", 0)])
+
+    def test_prefix_query(self):
+        """以 * 结尾为前缀查询；不带 * 时只匹配整个单词"""
+        self.assertEqual(self._hits("pyth*"), [("c1", 2), ("c2", 1)])
+        self.assertEqual(self._hits("python"), [("c1", 2)])
+        self.assertEqual(build_match("pyth*"), ('"pyth"*', ["pyth"]))
+
+    def test_snippet_highlight(self):
+        hit = self.index.search("线性代数")[0]
+        self.assertIn("<mark>线性代数</mark>", hit["snippet"])
+
+    def test_rewrite_reindexes(self):
+        """对话被改写 (最后一条内容对不上) 时整段重建，旧内容搜不到"""
+        self.index.update("c2", [{"role": "user", "content": "今天天气不错"}])
+        self.assertEqual(self._hits("机器人"), [])
+        self.assertEqual(self._hits("天气"), [("c2", 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import time
+import unittest
+
+from src.sse import coalesce, format_event
+
+
+def slow_chunks(pieces):
+    for delay, text in pieces:
+        time.sleep(delay)
+        yield text
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_flushes_during_upstream_stall(self):
+        """上游停顿时攒着的文本按 flush_ms 发出，不等下一段增量"""
+        start = time.monotonic()
+        seen = []
+        for text in coalesce(slow_chunks([(0, "a"), (0, "b"), (0.5, "c")]), flush_ms=50):
+            seen.append((text, time.monotonic() - start))
+        self.assertEqual("".join(t for t, _ in seen), "abc")
+        self.assertEqual(seen[1][0], "b")
+        self.assertLess(seen[1][1], 0.3)
+
+    def test_error_after_buffered_text(self):
+        def broken():
+            yield "a"
+            yield "b"
+            raise RuntimeError("boom")
+        out = []
+        with self.assertRaises(RuntimeError):
+            for text in coalesce(broken(), flush_ms=1000):
+                out.append(text)
+        self.assertEqual("".join(out), "ab")
+
+    def test_early_close_stops_upstream(self):
+        closed = []
+
+        def upstream():
+            try:
+                while True:
+                    time.sleep(0.01)
+                    yield "x"
+            finally:
+                closed.append(True)
+        gen = coalesce(upstream(), flush_ms=10)
+        next(gen)
+        gen.close()
+        time.sleep(0.1)
+        self.assertEqual(closed, [True])
+
+    def test_format_event(self):
+        self.assertEqual(format_event({"text": "你好"}, event="queue", event_id="s:1"),
+                         'id: s:1\nevent: queue\ndata: {"text": "你好"}\n\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+from src.storage import JournalStorage
+
+
+class JournalStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def _chat(self, messages):
+        return {"id": "c1", "title": "新对话", "prompt_file": "p.md", "updated_at": "", "messages": list(messages)}
+
+    def test_line_separator_in_content(self):
+        """内容里的 U+2028 / U+2029 / U+0085 不能把日志记录拆成两行"""
+        store = JournalStorage(self.dir)
+        messages = [{"role": "system", "content": "sys"}]
+        store.save("c1", self._chat(messages))
+        for text in ("a\u2028b", "c\u2029d", "e\u0085f", "plain"):
+            messages.append({"role": "user", "content": text})
+            store.save("c1", self._chat(messages))
+        self.assertTrue(os.path.exists(store._journal_path("c1")))
+
+        expected = [m["content"] for m in messages]
+        loaded = JournalStorage(self.dir).load("c1")
+        self.assertEqual([m["content"] for m in loaded["messages"]], expected)
+        window = JournalStorage(self.dir).load_window("c1", None, 50)
+        self.assertEqual(window["total"], len(messages))
+        self.assertEqual([m["content"] for m in window["messages"]], expected)
+
+    def test_internal_fields_not_persisted(self):
+        """以 _ 开头的内部字段 (旧版的 _tokens 缓存) 不写盘，读回时也去掉"""
+        store = JournalStorage(self.dir)
+        messages = [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi", "_tokens": [2, 5]}]
+        store.save("c1", self._chat(messages))
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    self.assertNotIn(b"_tokens", f.read())
+        loaded = JournalStorage(self.dir).load("c1")
+        self.assertEqual(loaded["messages"][1], {"role": "user", "content": "hi"})
+
+    def test_middle_edit_is_saved(self):
+        """改动中间的消息再追加一条：不能只追加新消息而丢掉改动"""
+        store = JournalStorage(self.dir)
+        messages = [{"role": "system", "content": "sys"}]
+        for i in range(4):
+            messages.append({"role": "user", "content": f"m{i}"})
+            store.save("c1", self._chat(messages))
+        messages[1]["content"] = "edited"
+        messages.append({"role": "assistant", "content": "new"})
+        store.save("c1", self._chat(messages))
+        loaded = JournalStorage(self.dir).load("c1")
+        self.assertEqual([m["content"] for m in loaded["messages"]], ["sys", "edited", "m1", "m2", "m3", "new"])
+
+    def test_journal_size_counts_bytes(self):
+        store = JournalStorage(self.dir)
+        messages = [{"role": "system", "content": "sys"}]
+        store.save("c1", self._chat(messages))
+        messages.append({"role": "user", "content": "你好" * 100})
+        store.save("c1", self._chat(messages))
+        size = os.path.getsize(store._journal_path("c1"))
+        self.assertEqual(store._state["c1"]["bytes"], size)
+        reloaded = JournalStorage(self.dir)
+        reloaded.load("c1")
+        self.assertEqual(reloaded._state["c1"]["bytes"], size)
+
+
+if __name__ == "__main__":
+    unittest.main()